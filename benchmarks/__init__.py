@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+性能基准脚本，在项目根目录下以模块方式运行，例如：python -m benchmarks.listing
+"""
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite并发读写基准：多个进程(相当于gunicorn的同步worker)同时读取文章列表、发表评论，对比SQLite默认设置和BLUELOG_SQLITE_PRAGMAS
+    python -m benchmarks.concurrency --workers 4 --seconds 10 --write-ratio 0.2
+default使用SQLite默认的回滚日志和Flask-SQLAlchemy默认的NullPool，tuned使用配置中的PRAGMA和连接池
+报告每秒完成的读、写操作数，失败的操作数(database is locked)和延迟的p95
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool
+
+from sqlalchemy.exc import OperationalError
+
+from benchmarks.listing import seed
+from bluelog import create_app
+from bluelog.extensions import db, sqlite_profile
+from bluelog.models import Post, Comment
+from bluelog.queries import post_listing
+from bluelog.settings import BaseConfig
+
+PROFILES = {
+    'default': {},
+    'tuned': BaseConfig.BLUELOG_SQLITE_PRAGMAS,
+}
+
+
+def make_app(path, pragmas):
+    app = create_app('testing')
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + path,
+        BLUELOG_SQLITE_PRAGMAS=pragmas,
+        BLUELOG_QUERY_BUDGET_RAISE=False,
+        BLUELOG_PAGE_CACHE=None,
+    )
+    sqlite_profile.init_app(app)
+    app.logger.disabled = True
+    return app
+
+
+def read(posts):
+    post_listing().order_by(Post.timestamp.desc(), Post.id.desc()).limit(10).all()
+    db.session.get_bind().execute('SELECT COUNT(*) FROM comment WHERE post_id = ?', random.randint(1, posts))
+
+
+def write(posts):
+    db.session.add(Comment(author='Benchmark', email='bench@example.com', body='Concurrent comment.',
+                           reviewed=True, post_id=random.randint(1, posts)))
+    db.session.commit()
+
+
+def worker(job):
+    path, pragmas, posts, seconds, write_ratio = job
+    random.seed(os.getpid())
+    app = make_app(path, pragmas)
+    counts = dict(reads=0, writes=0, errors=0)
+    latencies = []
+    with app.app_context():
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            writing = random.random() < write_ratio
+            start = time.perf_counter()
+            try:
+                (write if writing else read)(posts)
+            except OperationalError:
+                db.session.rollback()
+                counts['errors'] += 1
+                continue
+            finally:
+                db.session.remove()
+            latencies.append(time.perf_counter() - start)
+            counts['writes' if writing else 'reads'] += 1
+    return counts, latencies
+
+
+def run_profile(name, args, workdir):
+    path = os.path.join(workdir, '%s.db' % name)
+    with make_app(path, PROFILES[name]).app_context():
+        db.create_all()
+        seed(args.posts, 2000)
+        db.engine.dispose()     # 不把父进程的连接带进worker进程
+
+    jobs = [(path, PROFILES[name], args.posts, args.seconds, args.write_ratio)] * args.workers
+    with Pool(args.workers) as pool:
+        results = pool.map(worker, jobs)
+    totals = dict(reads=0, writes=0, errors=0)
+    latencies = []
+    for counts, worker_latencies in results:
+        for key, value in counts.items():
+            totals[key] += value
+        latencies.extend(worker_latencies)
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else float('nan')
+    print('%-10s %12.1f %12.1f %10d %10.2f' % (name, totals['reads'] / args.seconds, totals['writes'] / args.seconds,
+                                               totals['errors'], p95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='Worker processes, default is 4.')
+    parser.add_argument('--seconds', type=float, default=5, help='Duration of each run, default is 5.')
+    parser.add_argument('--write-ratio', type=float, default=0.2, help='Share of writes, default is 0.2.')
+    parser.add_argument('--posts', type=int, default=1000, help='Quantity of posts, default is 1000.')
+    parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=['default', 'tuned'])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bluelog-concurrency-')
+    try:
+        print('%-10s %12s %12s %10s %10s' % ('profile', 'reads/sec', 'writes/sec', 'errors', 'p95 ms'))
+        for name in args.profiles:
+            run_profile(name, args, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
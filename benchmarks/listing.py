@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+文章列表查询基准：对比加载完整Post对象和只查询列表字段两种方式的吞吐量(rows/sec)与内存峰值
+    python -m benchmarks.listing --posts 5000 --repeat 20
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from bluelog import create_app
+from bluelog.content import render_post
+from bluelog.extensions import db
+from bluelog.models import Post, Category
+from bluelog.queries import post_listing
+
+
+def seed(posts, body_size):
+    category = Category.__table__
+    post = Post.__table__
+    db.session.execute(category.insert(), [dict(id=i, name='Category %d' % i) for i in range(1, 11)])
+    body = '<p>%s</p>' % ('lorem ipsum dolor sit amet ' * (body_size // 27 + 1))[:body_size]
+    fields = render_post(body)
+    base = datetime(2018, 1, 1)
+    db.session.execute(post.insert(), [dict(fields, title='Post %d' % i, body=body, category_id=i % 10 + 1,
+                                            timestamp=base + timedelta(minutes=i)) for i in range(posts)])
+    db.session.commit()
+
+
+def orm_listing():
+    # 与原来的模板用法一致：访问标题、摘要和分类名(分类通过关系属性懒加载)
+    return [(post.title, post.excerpt, post.timestamp, post.category.name)
+            for post in Post.query.order_by(Post.timestamp.desc(), Post.id.desc())]
+
+
+def projected_listing():
+    return [(post.title, post.excerpt, post.timestamp, post.category_name)
+            for post in post_listing().order_by(Post.timestamp.desc(), Post.id.desc())]
+
+
+def measure(loader, repeat):
+    rows = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rows += len(loader())
+        db.session.remove()     # 每轮使用新的会话，避免identity map中已有的对象影响结果
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    loader()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.session.remove()
+    return rows / elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--posts', type=int, default=2000, help='Quantity of posts, default is 2000.')
+    parser.add_argument('--body-size', type=int, default=5000, help='Length of each post body, default is 5000.')
+    parser.add_argument('--repeat', type=int, default=10, help='Rounds per loader, default is 10.')
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        seed(args.posts, args.body_size)
+        print('%-12s %14s %14s' % ('loader', 'rows/sec', 'peak KiB'))
+        for name, loader in ('orm', orm_listing), ('projected', projected_listing):
+            rate, peak = measure(loader, args.repeat)
+            print('%-12s %14.0f %14.1f' % (name, rate, peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+路由基准：按不同规模生成数据库，通过app.test_client()请求blog、admin、auth蓝本下的每个路由
+    python -m benchmarks.routes --scales 1000 100000 --requests 50 --output results.json
+    python -m benchmarks.routes --scales 1000 --compare results.json
+每个路由报告延迟的p50/p95/p99、平均每个请求的查询数和tracemalloc内存峰值，结果可以保存为JSON，用于比较不同提交
+数据库使用临时目录中的SQLite文件，评论数按文章数的比例生成；默认关闭整页缓存，测量的是视图本身的开销
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import url_for, current_app
+from sqlalchemy import event
+
+from bluelog import create_app
+from bluelog.content import render_post
+from bluelog.extensions import db
+from bluelog.models import Admin, Category, Post, Comment, Link, path_segment
+from bluelog.pagination import encode_cursor
+from bluelog.search import reindex
+from bluelog.uploads import save_upload
+
+PASSWORD = 'benchmark'
+PIXEL = b'GIF89a\x01\x00\x01\x00\x00\x00\x00;'
+BATCH_SIZE = 10000
+
+# client: guest(匿名访客)、admin(已登录)、fresh(每次请求使用新的匿名客户端)、fresh_admin(每次请求使用新登录的客户端)
+# setup在计时之外执行，返回值作为url和data函数的参数，用于删除等会改变数据的请求
+Route = namedtuple('Route', 'name endpoint method url data client setup')
+Route.__new__.__defaults__ = ('GET', None, None, 'guest', None)
+
+
+def _last_id(model):
+    return db.session.query(db.func.max(model.id)).scalar()
+
+
+def _deep_page(app):
+    # 第一个游标翻页的页面，游标与第BLUELOG_KEYSET_OFFSET_PAGES页上"下一页"链接中的after参数相同
+    pages, per_page = app.config['BLUELOG_KEYSET_OFFSET_PAGES'], app.config['BLUELOG_POST_PER_PAGE']
+    last = db.session.query(Post.timestamp, Post.id).order_by(Post.timestamp.desc(), Post.id.desc()) \
+        .offset(pages * per_page - 1).first()
+    return pages + 1, last and encode_cursor(last)
+
+
+def _upload_pixel(ids):
+    # 上传的文件按内容哈希保存，返回get_image使用的相对路径(ab/cd/<哈希>.gif)
+    config = current_app.config
+    return save_upload(io.BytesIO(PIXEL), config['BLUELOG_UPLOAD_PATH'], config['BLUELOG_UPLOAD_MAX_BYTES'],
+                       config['BLUELOG_ALLOWED_IMAGE_EXTENSIONS'])
+
+
+def _create(model, **fields):
+    instance = model(**fields)
+    db.session.add(instance)
+    db.session.commit()
+    return instance.id
+
+
+ROUTES = [
+    Route('blog.index', 'blog.index'),
+    Route('blog.index cursor', 'blog.index',
+          url=lambda ids, value: dict(page=ids['deep_page'], after=ids['deep_cursor'])),
+    Route('blog.about', 'blog.about'),
+    Route('blog.show_category', 'blog.show_category', url=lambda ids, value: dict(category_id=1)),
+    Route('blog.show_post', 'blog.show_post', url=lambda ids, value: dict(post_id=ids['post'])),
+    Route('blog.show_post thread', 'blog.show_post', url=lambda ids, value: dict(post_id=ids['post'], view='thread')),
+    Route('blog.show_post comment', 'blog.show_post', 'POST', url=lambda ids, value: dict(post_id=ids['post']),
+          data=lambda ids, value: dict(author='Guest', email='guest@example.com', body='A comment.'),
+          client='fresh'),
+    Route('blog.search', 'blog.search', url=lambda ids, value: dict(q='lorem')),
+    Route('blog.reply_comment', 'blog.reply_comment', url=lambda ids, value: dict(comment_id=ids['comment'])),
+    Route('blog.change_theme', 'blog.change_theme', url=lambda ids, value: dict(theme_name='black_swan')),
+    Route('auth.login', 'auth.login', client='fresh'),
+    Route('auth.login submit', 'auth.login', 'POST', client='fresh',
+          data=lambda ids, value: dict(username='admin', password=PASSWORD)),
+    Route('auth.logout', 'auth.logout', client='fresh_admin'),
+    Route('admin.settings', 'admin.settings', client='admin'),
+    Route('admin.settings submit', 'admin.settings', 'POST', client='admin',
+          data=lambda ids, value: dict(name='Admin', blog_title='Bluelog', blog_sub_title='Benchmark', about='About')),
+    Route('admin.manage_post', 'admin.manage_post', client='admin'),
+    Route('admin.new_post', 'admin.new_post', client='admin'),
+    Route('admin.new_post submit', 'admin.new_post', 'POST', client='admin',
+          data=lambda ids, value: dict(title='New post', category=1, body='<p>%s</p>' % ('lorem ipsum ' * 300))),
+    Route('admin.edit_post', 'admin.edit_post', url=lambda ids, value: dict(post_id=ids['post']), client='admin'),
+    Route('admin.edit_post submit', 'admin.edit_post', 'POST', url=lambda ids, value: dict(post_id=ids['post']),
+          data=lambda ids, value: dict(title='Edited post', category=1, body='<p>%s</p>' % ('dolor sit ' * 300)),
+          client='admin'),
+    Route('admin.delete_post', 'admin.delete_post', 'POST', url=lambda ids, value: dict(post_id=value),
+          client='admin', setup=lambda ids: _create(Post, title='Doomed', body='<p>Bye</p>', category_id=1)),
+    Route('admin.set_comment', 'admin.set_comment', 'POST', url=lambda ids, value: dict(post_id=ids['post']),
+          client='admin'),
+    Route('admin.manage_comment', 'admin.manage_comment', client='admin'),
+    Route('admin.manage_comment unread', 'admin.manage_comment', url=lambda ids, value: dict(filter='unread'),
+          client='admin'),
+    Route('admin.approve_comment', 'admin.approve_comment', 'POST', url=lambda ids, value: dict(comment_id=value),
+          client='admin', setup=lambda ids: _create(Comment, author='Guest', email='guest@example.com', body='Hi',
+                                                    post_id=ids['post'], reviewed=False)),
+    Route('admin.delete_comment', 'admin.delete_comment', 'POST', url=lambda ids, value: dict(comment_id=value),
+          client='admin', setup=lambda ids: _create(Comment, author='Guest', email='guest@example.com', body='Hi',
+                                                    post_id=ids['post'], reviewed=True)),
+    Route('admin.manage_category', 'admin.manage_category', client='admin'),
+    Route('admin.new_category', 'admin.new_category', client='admin'),
+    Route('admin.new_category submit', 'admin.new_category', 'POST', client='admin',
+          data=lambda ids, value: dict(name='Category %f' % time.time())),
+    Route('admin.edit_category', 'admin.edit_category', url=lambda ids, value: dict(category_id=2), client='admin'),
+    Route('admin.edit_category submit', 'admin.edit_category', 'POST', url=lambda ids, value: dict(category_id=2),
+          data=lambda ids, value: dict(name='Category %f' % time.time()), client='admin'),
+    Route('admin.delete_category', 'admin.delete_category', 'POST', url=lambda ids, value: dict(category_id=value),
+          client='admin', setup=lambda ids: _create(Category, name='Doomed %f' % time.time())),
+    Route('admin.manage_link', 'admin.manage_link', client='admin'),
+    Route('admin.new_link', 'admin.new_link', client='admin'),
+    Route('admin.new_link submit', 'admin.new_link', 'POST', client='admin',
+          data=lambda ids, value: dict(name='Link', url='https://example.com')),
+    Route('admin.edit_link', 'admin.edit_link', url=lambda ids, value: dict(link_id=1), client='admin'),
+    Route('admin.edit_link submit', 'admin.edit_link', 'POST', url=lambda ids, value: dict(link_id=1),
+          data=lambda ids, value: dict(name='GitHub', url='https://github.com'), client='admin'),
+    Route('admin.delete_link', 'admin.delete_link', 'POST', url=lambda ids, value: dict(link_id=value),
+          client='admin', setup=lambda ids: _create(Link, name='Doomed', url='https://example.com')),
+    Route('admin.slow_queries', 'admin.slow_queries', client='admin'),
+    Route('admin.upload_image', 'admin.upload_image', 'POST', client='admin',
+          data=lambda ids, value: dict(upload=(io.BytesIO(PIXEL), 'pixel.gif'))),
+    Route('admin.get_image', 'admin.get_image', url=lambda ids, value: dict(filename=value), setup=_upload_pixel),
+]
+
+
+def seed(posts, comment_ratio, categories=10):
+    """用批量INSERT生成数据：posts篇文章，每篇文章comment_ratio条评论(其中十分之一为回复，二十分之一未审核)"""
+    admin = Admin(username='admin', blog_title='Bluelog', blog_sub_title='Benchmark', name='Admin', about='About')
+    admin.set_password(PASSWORD)
+    db.session.add(admin)
+    db.session.add(Link(name='GitHub', url='https://github.com'))
+    db.session.commit()
+
+    # 计数字段在生成数据时直接算出，不使用recount()：它的相关子查询在大数据量下很慢
+    db.session.execute(Category.__table__.insert(), [
+        dict(id=i, name='Default' if i == 1 else 'Category %d' % i, post_count=len(range(i - 1, posts, categories)))
+        for i in range(1, categories + 1)])
+    body = '<p>%s</p>' % ('lorem ipsum dolor sit amet consectetur ' * 60)
+    fields = render_post(body)
+    base = datetime(2018, 1, 1)
+    batch_posts = max(BATCH_SIZE // (comment_ratio + 1), 1)
+    for start in range(0, posts, batch_posts):
+        post_rows, comment_rows = [], []
+        paths = {}  # 本批评论的物化路径，回复的是同一篇文章的上一条评论，总在同一批中
+        for p in range(start, min(start + batch_posts, posts)):
+            post_id = p + 1
+            reviewed = 0
+            for i in range(p * comment_ratio, post_id * comment_ratio):
+                replied_id = i if i % 10 == 9 and i % comment_ratio else None   # 回复同一篇文章的上一条评论
+                paths[i + 1] = paths.get(replied_id, '') + path_segment(i + 1)
+                comment_rows.append(dict(
+                    id=i + 1, author='Guest %d' % i, email='guest%d@example.com' % i, body='Comment %d' % i,
+                    post_id=post_id, replied_id=replied_id, path=paths[i + 1], reviewed=i % 20 != 0,
+                    timestamp=base + timedelta(minutes=post_id, seconds=i % comment_ratio)))
+                reviewed += i % 20 != 0
+            post_rows.append(dict(fields, id=post_id, title='Post %d' % p, body=body, category_id=p % categories + 1,
+                                  timestamp=base + timedelta(minutes=p), comment_count=reviewed))
+        db.session.execute(Post.__table__.insert(), post_rows)
+        if comment_rows:
+            db.session.execute(Comment.__table__.insert(), comment_rows)
+    db.session.commit()
+    reindex()
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))]
+
+
+class Runner(object):
+
+    def __init__(self, app, ids, requests, memory_requests):
+        self.app = app
+        self.ids = ids
+        self.requests = requests
+        self.memory_requests = memory_requests
+        self.queries = 0
+        self.guest = app.test_client()
+        self.admin = self.login(app.test_client())
+
+    def login(self, client):
+        with self.app.test_request_context():
+            path = url_for('auth.login')
+        response = client.post(path, data=dict(username='admin', password=PASSWORD))
+        assert response.status_code == 302, 'Login failed'
+        return client
+
+    def client(self, kind):
+        if kind == 'fresh':
+            return self.app.test_client()
+        if kind == 'fresh_admin':
+            return self.login(self.app.test_client())
+        return getattr(self, kind)
+
+    def request(self, route):
+        """执行一次请求，返回(秒, 查询数, 状态码)；准备工作不计时"""
+        value = None
+        if route.setup is not None:
+            with self.app.app_context():
+                value = route.setup(self.ids)
+        client = self.client(route.client)
+        with self.app.test_request_context():
+            path = url_for(route.endpoint, **(route.url(self.ids, value) if route.url else {}))
+        data = route.data(self.ids, value) if route.data else None
+        queries = self.queries
+        start = time.perf_counter()
+        response = client.open(path, method=route.method, data=data)
+        elapsed = time.perf_counter() - start
+        response.close()
+        return elapsed, self.queries - queries, response.status_code
+
+    def run(self, route):
+        self.request(route)     # 预热：填充上下文缓存、编译模板
+        timings, queries, statuses = [], 0, set()
+        for _ in range(self.requests):
+            elapsed, count, status = self.request(route)
+            timings.append(elapsed)
+            queries += count
+            statuses.add(status)
+
+        tracemalloc.start()
+        peak = 0
+        for _ in range(self.memory_requests):
+            tracemalloc.reset_peak()
+            self.request(route)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+        return dict(p50=percentile(timings, 50) * 1000, p95=percentile(timings, 95) * 1000,
+                    p99=percentile(timings, 99) * 1000, queries=queries / float(self.requests),
+                    peak_kib=peak / 1024.0, status=sorted(statuses))
+
+    def count_query(self, *args):
+        self.queries += 1
+
+
+def check_coverage(app):
+    covered = set(route.endpoint for route in ROUTES)
+    missing = sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                     if rule.endpoint.split('.')[0] in ('blog', 'admin', 'auth') and rule.endpoint not in covered)
+    if missing:
+        print('Routes without a benchmark: %s' % ', '.join(missing), file=sys.stderr)
+
+
+def run_scale(posts, args, workdir):
+    app = create_app('testing')
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(workdir, 'bench-%d.db' % posts),
+        BLUELOG_PAGE_CACHE=args.page_cache and 'memory' or None,
+        BLUELOG_QUERY_BUDGET_RAISE=False,   # 大数据量下超出预算只记录，不中断基准
+        BLUELOG_UPLOAD_PATH=workdir,
+        MAIL_SUPPRESS_SEND=True,
+    )
+    app.extensions['page_cache'].init_app(app)
+    app.logger.disabled = True
+    check_coverage(app)
+
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        seed(posts, args.comment_ratio)
+        seed_seconds = time.perf_counter() - start
+        ids = dict(post=_last_id(Post), comment=_last_id(Comment))
+        ids['deep_page'], ids['deep_cursor'] = _deep_page(app)
+        engine = db.engine
+
+    runner = Runner(app, ids, args.requests, args.memory_requests)
+    event.listen(engine, 'before_cursor_execute', runner.count_query)
+    results = {}
+    print('\n%d posts, %d comments (seeded in %.1fs)' % (posts, posts * args.comment_ratio, seed_seconds))
+    print('%-30s %9s %9s %9s %8s %10s  %s' % ('route', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'peak KiB', 'status'))
+    for route in ROUTES:
+        if args.only and not any(name in route.name for name in args.only):
+            continue
+        result = results[route.name] = runner.run(route)
+        print('%-30s %9.2f %9.2f %9.2f %8.1f %10.1f  %s' % (
+            route.name, result['p50'], result['p95'], result['p99'], result['queries'], result['peak_kib'],
+            ','.join(str(status) for status in result['status'])))
+    event.remove(engine, 'before_cursor_execute', runner.count_query)
+    engine.dispose()
+    return dict(posts=posts, comments=posts * args.comment_ratio, seed_seconds=seed_seconds, routes=results)
+
+
+def compare(previous, current):
+    """打印与之前结果的p95差异"""
+    print('\nCompared with %s:' % previous.get('commit'))
+    for scale, result in current['scales'].items():
+        old_routes = previous.get('scales', {}).get(scale, {}).get('routes', {})
+        for name, route in result['routes'].items():
+            if name in old_routes and old_routes[name]['p95']:
+                change = (route['p95'] - old_routes[name]['p95']) / old_routes[name]['p95'] * 100
+                print('%8s %-30s p95 %9.2f -> %9.2f ms (%+.1f%%)' % (
+                    scale, name, old_routes[name]['p95'], route['p95'], change))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000],
+                        help='Quantities of posts to seed, default is 1000 10000.')
+    parser.add_argument('--comment-ratio', type=int, default=10, help='Comments per post, default is 10.')
+    parser.add_argument('--requests', type=int, default=30, help='Timed requests per route, default is 30.')
+    parser.add_argument('--memory-requests', type=int, default=3,
+                        help='Requests per route traced with tracemalloc, default is 3.')
+    parser.add_argument('--page-cache', action='store_true', help='Enable the page cache for anonymous pages.')
+    parser.add_argument('--only', nargs='+', help='Only run routes whose names contain one of these strings.')
+    parser.add_argument('--output', help='Save results to this JSON file.')
+    parser.add_argument('--compare', help='Compare p95 latency with a previous JSON result.')
+    args = parser.parse_args()
+
+    report = dict(commit=git_commit(), timestamp=datetime.utcnow().isoformat(), python=platform.python_version(),
+                  sqlite=sqlite3.sqlite_version, args=vars(args), scales={})
+    workdir = tempfile.mkdtemp(prefix='bluelog-bench-')
+    try:
+        for posts in args.scales:
+            report['scales'][str(posts)] = run_scale(posts, args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('\nSaved results to %s' % args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,20 +8,28 @@
 """
 import logging
 import os
-from logging.handlers import SMTPHandler, RotatingFileHandler
 
 import click
-from flask import Flask, render_template, request
+from flask import Flask, render_template
 from flask_login import current_user
-from flask_sqlalchemy import get_debug_queries
 from flask_wtf.csrf import CSRFError
 
+from bluelog.advisor import advise
 from bluelog.blueprints.admin import admin_bp
 from bluelog.blueprints.auth import auth_bp
 from bluelog.blueprints.blog import blog_bp
-from bluelog.extensions import bootstrap, db, login_manager, csrf, ckeditor, mail, moment, toolbar, migrate
-from bluelog.models import Admin, Post, Category, Comment, Link
+from bluelog.caching import snapshot
+from bluelog.emails import run_mail_worker
+from bluelog.extensions import bootstrap, db, login_manager, csrf, ckeditor, mail, moment, toolbar, migrate, \
+    context_cache, page_cache, query_budget, query_sampler, metrics, sqlite_profile, database_router, login_guard, \
+    comment_spool
+from bluelog.logs import CompressedRotatingFileHandler, DigestMailHandler, start_queue_logging
+from bluelog.models import Admin, Post, Category, Comment, Link, recount as recount_counters, rerender_posts, \
+    iter_post_bodies
+from bluelog.routing import snapshot_replica
+from bluelog.search import reindex as reindex_search, highlight
 from bluelog.settings import config
+from bluelog.uploads import find_references, find_orphans, remove_uploads
 
 basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))   # 返回脚本文件路径
 
@@ -38,45 +46,56 @@ def create_app(config_name=None):   # 定义工厂函数,设置配置名为空
     register_extensions(app)    # 注册拓展（拓展初始化）
     register_blueprints(app)    # 注册蓝本(蓝图)
     register_commands(app)  # 注册自定义shell命令
+    register_maintenance_commands(app)  # 注册计数、渲染和搜索索引重建命令
+    register_mail_commands(app)     # 注册邮件队列命令
+    register_database_commands(app)     # 注册索引顾问、副本快照命令
+    register_upload_commands(app)   # 注册上传文件清理命令
+    register_spool_commands(app)    # 注册评论写入队列命令
     register_errors(app)    # 注册错误处理函数
     register_shell_context(app)  # 注册shell上下文处理函数
     register_template_context(app)  # 注册模板上下文处理函数
-    register_request_handlers(app)  # 不知道是啥...
     return app  # 返回程序实例
 
 
 def register_logging(app):  # 注册日志处理器函数(略)
-    class RequestFormatter(logging.Formatter):
+    if app.debug or app.testing:
+        return
 
-        def format(self, record):
-            record.url = request.url
-            record.remote_addr = request.remote_addr
-            return super(RequestFormatter, self).format(record)
-
-    request_formatter = RequestFormatter(
+    # 请求信息在请求线程中由队列处理器记录到日志记录上，后台线程中的格式化器直接读取
+    request_formatter = logging.Formatter(
         '[%(asctime)s] %(remote_addr)s requested %(url)s\n'
         '%(levelname)s in %(module)s: %(message)s'
     )
 
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    file_handler = RotatingFileHandler(os.path.join(basedir, 'logs/bluelog.log'),
-                                       maxBytes=10 * 1024 * 1024, backupCount=10)
+    # 轮转出来的旧日志文件在后台压缩为.gz
+    file_handler = CompressedRotatingFileHandler(os.path.join(basedir, 'logs/bluelog.log'),
+                                                 maxBytes=10 * 1024 * 1024, backupCount=10)
     file_handler.setFormatter(formatter)
     file_handler.setLevel(logging.INFO)
-
-    mail_handler = SMTPHandler(
-        mailhost=app.config['MAIL_SERVER'],
-        fromaddr=app.config['MAIL_USERNAME'],
-        toaddrs=['ADMIN_EMAIL'],
-        subject='Bluelog Application Error',
-        credentials=(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD']))
-    mail_handler.setLevel(logging.ERROR)
-    mail_handler.setFormatter(request_formatter)
-
-    if not app.debug:
-        app.logger.addHandler(mail_handler)
-        app.logger.addHandler(file_handler)
+    handlers = [file_handler]
+
+    if app.config['MAIL_SERVER']:
+        credentials = None
+        if app.config['MAIL_USERNAME']:
+            credentials = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        # 相同的错误在时间窗口内只发送一封邮件，重复次数汇总为摘要邮件
+        mail_handler = DigestMailHandler(
+            mailhost=app.config['MAIL_SERVER'],
+            port=app.config['MAIL_PORT'],
+            fromaddr=app.config['MAIL_USERNAME'],
+            toaddrs=[app.config['BLUELOG_EMAIL']],
+            subject='Bluelog Application Error',
+            credentials=credentials,
+            use_ssl=app.config['MAIL_USE_SSL'],
+            window=app.config['BLUELOG_ERROR_MAIL_WINDOW'])
+        mail_handler.setLevel(logging.ERROR)
+        mail_handler.setFormatter(request_formatter)
+        handlers.append(mail_handler)
+
+    # 请求线程只把日志记录放入队列，写文件和发送邮件由后台线程完成
+    app.extensions['log_listener'] = start_queue_logging(app.logger, handlers, app.config['BLUELOG_LOG_QUEUE_SIZE'])
 
 
 def register_extensions(app):   # 注册拓展初始化
@@ -84,6 +103,8 @@ def register_extensions(app):   # 注册拓展初始化
     # init_app()方法用于支持分离拓展的实例化和初始化操作
     bootstrap.init_app(app)
     db.init_app(app)
+    sqlite_profile.init_app(app)    # SQLite连接的PRAGMA和连接池，需要在创建引擎之前初始化
+    database_router.init_app(app)   # 读写分离
     login_manager.init_app(app)
     csrf.init_app(app)
     ckeditor.init_app(app)
@@ -91,6 +112,13 @@ def register_extensions(app):   # 注册拓展初始化
     moment.init_app(app)
     toolbar.init_app(app)
     migrate.init_app(app, db)
+    context_cache.init_app(app)
+    page_cache.init_app(app)
+    query_budget.init_app(app)
+    query_sampler.init_app(app)
+    metrics.init_app(app)
+    login_guard.init_app(app)   # 登录的密码验证线程池和失败次数限制
+    comment_spool.init_app(app)     # 匿名评论写入队列，需要在metrics之后初始化
 
 
 def register_blueprints(app):   # 注册蓝图
@@ -103,18 +131,41 @@ def register_blueprints(app):   # 注册蓝图
 def register_shell_context(app):    # 注册shell上下文
     @app.shell_context_processor    # shell上下文处理装饰器
     def make_shell_context():   # 设置上下文
-        return dict(db=db, Admin=Admin, Post=Post, Category=Category, Comment=Comment)
+        return dict(db=db, Admin=Admin, Post=Post, Category=Category, Comment=Comment, context_cache=context_cache,
+                    page_cache=page_cache)
         # 等同于return {'db':db, 'Admin':Admin, 'Post':Post, 'Category':Category, 'Comment':Comment}
 
+
 def register_template_context(app):  # 注册模板上下文
+    app.add_template_filter(highlight)  # 搜索结果高亮
+
+    # 以下数据每个页面都会用到，通过context_cache跨请求缓存，相关模型提交修改后自动失效
+    # 缓存的是脱离会话的快照，模板中只能访问列属性和附加的统计字段
+    @context_cache.memoize('admin', 'Admin')
+    def load_admin():
+        return snapshot(Admin.query.first())  # query.first()返回查询的第一条记录
+
+    @context_cache.memoize('categories', 'Category', 'Post')
+    def load_categories():
+        # 按Category.name排序,分类下的文章数直接读取post_count字段
+        return [snapshot(category) for category in Category.query.order_by(Category.name).all()]
+
+    @context_cache.memoize('links', 'Link')
+    def load_links():
+        return [snapshot(link) for link in Link.query.order_by(Link.name).all()]
+
+    @context_cache.memoize('unread_comments', 'Comment')
+    def load_unread_comments():
+        # filter_by过滤器，使用指定规则(参数)，返回新的查询对象,的个数(.count)
+        return Comment.query.filter_by(reviewed=False).count()
+
     @app.context_processor  # 上下文装饰器
     def make_template_context():    # 设置模板上下文
-        admin = Admin.query.first()  # query.first()返回查询的第一条记录
-        categories = Category.query.order_by(Category.name).all()   # 按Category.name排序,返回包含所有查询记录的列表
-        links = Link.query.order_by(Link.name).all()
+        admin = context_cache.get('admin')
+        categories = context_cache.get('categories')
+        links = context_cache.get('links')
         if current_user.is_authenticated:   # Flask_LOGIN模块, 判断登录状态
-            # filter_by过滤器，使用指定规则(参数)，返回新的查询对象,的个数(.count)
-            unread_comments = Comment.query.filter_by(reviewed=False).count()   # 未读评论
+            unread_comments = context_cache.get('unread_comments')   # 未读评论
         else:
             unread_comments = None
         return dict(
@@ -189,13 +240,19 @@ def register_commands(app):  # 注册自定义命令
         click.echo('Done.')
 
     @app.cli.command()
-    @click.option('--category', default=10, help='Quantity of categories, default is 10.')
-    @click.option('--post', default=50, help='Quantity of posts, default is 50.')
-    @click.option('--comment', default=500, help='Quantity of comments, default is 500.')
-    def forge(category, post, comment):
+    @click.option('--category', type=int, help='Quantity of categories, default depends on --scale.')
+    @click.option('--post', type=int, help='Quantity of posts, default depends on --scale.')
+    @click.option('--comment', type=int, help='Quantity of comments, default depends on --scale.')
+    @click.option('--scale', type=click.Choice(['small', 'medium', 'large']), default='small',
+                  help='Preset quantities: small (10/50/500), medium (20/5k/50k), large (50/100k/1M).')
+    @click.option('--seed', type=int, help='Random seed, the same seed always generates the same data.')
+    @click.option('--workers', default=1, help='Processes generating fake text in parallel, default is 1.')
+    def forge(category, post, comment, scale, seed, workers):
         """创建模拟数据"""
-        from bluelog.fakes import fake_admin, fake_categories, fake_posts, fake_comments, fake_links
+        from bluelog.fakes import fake_admin, fake_categories, fake_posts, fake_comments, fake_links, \
+            generator_map, progress_reporter, resolve_counts
 
+        category, post, comment = resolve_counts(scale, category, post, comment)
         db.drop_all()
         db.create_all()
 
@@ -203,27 +260,116 @@ def register_commands(app):  # 注册自定义命令
         fake_admin()
 
         click.echo('Generating %d categories...' % category)
-        fake_categories(category)
+        fake_categories(category, seed)
 
-        click.echo('Generating %d posts...' % post)
-        fake_posts(post)
+        with generator_map(workers) as map_func:
+            click.echo('Generating %d posts...' % post)
+            fake_posts(post, seed, map_func, progress_reporter())
 
-        click.echo('Generating %d comments...' % comment)
-        fake_comments(comment)
+            click.echo('Generating %d comments...' % comment)
+            fake_comments(comment, seed, map_func, progress_reporter())
 
         click.echo('Generating links...')
         fake_links()
 
+        click.echo('Rebuilding the search index...')
+        reindex_search()
+        page_cache.invalidate('*')  # 批量插入不会触发缓存失效
+        context_cache.clear()
         click.echo('Done.')
 
 
-def register_request_handlers(app):  # 注册请求捕获函数
-    @app.after_request  # 请求钩子,未抛出异常，则在每个请求结束后运行后续代码，after_request钩子应用场景为进行数据库操作如更新，删除
-    def query_profiler(response):
-        for q in get_debug_queries():
-            if q.duration >= app.config['BLUELOG_SLOW_QUERY_THRESHOLD']:
-                app.logger.warning(
-                    'Slow query: Duration: %fs\n Context: %s\nQuery: %s\n '
-                    % (q.duration, q.context, q.statement)
-                )
-        return response
+def register_maintenance_commands(app):  # 注册计数、渲染和搜索索引重建命令
+    @app.cli.command()
+    def recount():
+        """重新统计分类文章数和文章评论数"""
+        click.echo('Recounting posts and comments...')
+        recount_counters()
+        context_cache.clear()   # 直接执行的UPDATE语句不会触发缓存失效
+        click.echo('Done.')
+
+    @app.cli.command()
+    @click.option('--batch-size', default=100, help='Quantity of posts per batch, default is 100.')
+    def rerender(batch_size):
+        """重新生成文章的过滤HTML、纯文本、摘要和字数"""
+        click.echo('Rendering posts...')
+        count = rerender_posts(batch_size)
+        page_cache.invalidate('*')  # 批量UPDATE不会触发缓存失效
+        click.echo('Rendered %d posts.' % count)
+
+    @app.cli.command()
+    @click.option('--batch-size', default=500, help='Quantity of rows per batch, default is 500.')
+    def reindex(batch_size):
+        """重建文章和评论的全文搜索索引"""
+        click.echo('Rebuilding the search index...')
+        posts, comments = reindex_search(batch_size)
+        click.echo('Indexed %d posts and %d comments.' % (posts, comments))
+
+
+def register_mail_commands(app):  # 注册邮件队列命令
+    @app.cli.command('mail-worker')
+    @click.option('--once', is_flag=True, help='Send one batch and exit.')
+    @click.option('--batch-size', type=int, help='Quantity of mails per batch.')
+    @click.option('--interval', default=5.0, help='Seconds to wait when the queue is empty, default is 5.')
+    def mail_worker(once, batch_size, interval):
+        """发送邮件队列中的邮件，可以同时运行多个进程"""
+        def report(counts):
+            click.echo('Sent %d, retry %d, failed %d. Queue: %d pending, %d failed.' % counts)
+
+        try:
+            run_mail_worker(batch_size, interval, once, report)
+        except KeyboardInterrupt:
+            click.echo('Stopped.')
+
+
+def register_upload_commands(app):    # 注册上传文件清理命令
+    @app.cli.command('uploads-gc')
+    @click.option('--delete', is_flag=True, help='Delete the unreferenced files instead of only listing them.')
+    @click.option('--grace-hours', default=24.0, help='Keep files modified within this many hours, default is 24.')
+    @click.option('--batch-size', default=500, help='Quantity of posts per batch, default is 500.')
+    def uploads_gc(delete, grace_hours, batch_size):
+        """找出(或删除)没有被任何文章引用的上传文件"""
+        directory = app.config['BLUELOG_UPLOAD_PATH']
+        references = find_references(iter_post_bodies(batch_size))
+        orphans = find_orphans(directory, references, grace_hours * 3600)
+        for filename in orphans:
+            click.echo(filename)
+        if delete:
+            remove_uploads(directory, orphans)
+        click.echo('%s %d unreferenced files.' % ('Deleted' if delete else 'Found', len(orphans)))
+
+
+def register_spool_commands(app):  # 注册评论写入队列命令
+    @app.cli.command('flush-comments')
+    @click.option('--retry-failed', is_flag=True, help='Also retry the comments that failed to be written before.')
+    def flush_comments(retry_failed):
+        """把评论写入队列中的评论写入数据库，包括已经退出的进程留下的队列文件"""
+        if not comment_spool.enabled:
+            raise click.ClickException('BLUELOG_COMMENT_SPOOL is not set.')
+        if retry_failed:
+            click.echo('Retrying %d failed files.' % comment_spool.retry_failed())
+        click.echo('Flushed %d comments.' % comment_spool.flush())
+
+
+def register_database_commands(app):  # 注册索引顾问、副本快照命令
+    @app.cli.command('index-advisor')
+    @click.option('--all', 'show_all', is_flag=True, help='Show the plans of statements without problems too.')
+    def index_advisor(show_all):
+        """请求主要页面，检查其中的查询是否有全表扫描或临时B树排序"""
+        findings = advise(app)
+        for finding in findings:
+            if finding.problems or show_all:
+                click.echo('GET %s\n  %s' % (finding.url, ' '.join(finding.statement.split())))
+                click.echo('\n'.join('    ' + line for line in finding.plan.splitlines()))
+                click.echo(''.join('  ! %s\n' % problem for problem in finding.problems))
+        click.echo('%d of %d statements need attention.' % (sum(1 for finding in findings if finding.problems),
+                                                            len(findings)))
+
+    @app.cli.command('replica-snapshot')
+    def replica_snapshot():
+        """把SQLite主库复制到只读副本文件，可以用cron定期执行"""
+        if database_router.replica_bind(app) is None:
+            raise click.ClickException('No %r bind in SQLALCHEMY_BINDS.' % app.config['BLUELOG_REPLICA_BIND'])
+        primary, replica = snapshot_replica(app)
+        page_cache.invalidate('*')  # 提交时失效的页面可能已经按旧的副本重新缓存
+        click.echo('Copied %s to %s.' % (primary, replica))
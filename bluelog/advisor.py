@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+索引顾问
+    用测试客户端以管理员身份请求主要页面(包括用游标翻到后面的页面)，记录这些请求发出的SELECT语句，
+    按语句形状去重后逐条执行EXPLAIN QUERY PLAN，报告全表扫描(SCAN 表名，没有使用索引)、
+    带筛选条件却只能按排序列的索引扫描整张表再逐行过滤的语句，以及排序、分组无法利用索引而建立的临时B树(USE TEMP B-TREE)
+    语句和参数都来自真实的视图，修改查询后不需要同步维护一份语句清单；只支持SQLite
+"""
+from collections import namedtuple, OrderedDict
+
+from flask import url_for
+from flask_login import FlaskLoginClient
+from sqlalchemy import event
+
+from bluelog.extensions import db, context_cache
+from bluelog.models import Admin, Post, Comment
+from bluelog.pagination import encode_cursor
+from bluelog.profiling import explain, statement_shape
+
+# 按设计只有少量行的表，全表扫描和排序不报告
+SMALL_TABLES = {'admin', 'category', 'link'}
+
+Finding = namedtuple('Finding', 'url statement plan problems')
+
+
+def advisor_pages():
+    """返回要请求的(端点, 参数)列表；文章页选评论最多的文章，没有数据时跳过相应页面"""
+    pages = [('blog.index', {}), ('blog.index', {'page': 2}), ('blog.search', {'q': 'the'}),
+             ('admin.manage_post', {}), ('admin.manage_category', {}), ('admin.manage_link', {})]
+    pages.extend(('admin.manage_comment', {'filter': rule}) for rule in ('all', 'unread', 'admin'))
+    post = Post.query.order_by(Post.comment_count.desc()).first()
+    if post is not None:
+        pages.extend([
+            ('blog.index', {'after': encode_cursor([post.timestamp, post.id])}),
+            ('blog.show_category', {'category_id': post.category_id}),
+            ('blog.show_post', {'post_id': post.id}),
+            ('blog.show_post', {'post_id': post.id, 'view': 'thread'}),
+        ])
+    comment = Comment.query.order_by(Comment.id).first()
+    if comment is not None:
+        pages.append(('admin.manage_comment', {'after': encode_cursor([comment.timestamp, comment.id])}))
+    return pages
+
+
+def capture_statements(app, pages):
+    """请求页面，返回{语句形状: (url, 语句, 参数)}，同一形状只保留第一次出现的语句"""
+    statements = OrderedDict()
+    current = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.setdefault(statement_shape(statement), (current['url'], statement, parameters))
+
+    client = FlaskLoginClient(app, app.response_class, user=Admin.query.first())
+    context_cache.clear()   # 模板上下文中缓存的查询(比如未读评论数)也要重新执行一次
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        for endpoint, values in pages:
+            with app.test_request_context():
+                current['url'] = url_for(endpoint, **values)
+            client.get(current['url'])
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    return statements
+
+
+def _scan_problem(words, large_tables, filtered):
+    if words[0] != 'SCAN' or words[1] not in large_tables:
+        return None
+    if len(words) == 2:
+        return 'full table scan on %s' % words[1]
+    if filtered and words[2] == 'USING' and 'INDEX' in words:
+        # 条件列没有可用的索引，只能按排序列的索引顺序逐行扫描再过滤
+        return 'full scan of %s through index %s' % (words[1], words[-1])
+    return None
+
+
+def plan_problems(statement, plan, tables):
+    """
+    从EXPLAIN QUERY PLAN的输出中找出全表扫描、带WHERE条件的语句按索引逐行扫描整张表，以及临时B树
+    只读取小表，或按全文搜索的相关度(计算出来的值，无法建立索引)排序时，临时B树不报告
+    """
+    large_tables = tables - SMALL_TABLES
+    details = [line.split() for line in plan.splitlines()]
+    problems = [_scan_problem(words, large_tables, 'WHERE' in statement.split()) for words in details]
+    read = set(words[1] for words in details if words[0] in ('SCAN', 'SEARCH'))
+    if read & large_tables and 'VIRTUAL TABLE' not in plan:
+        problems.extend(' '.join(words).lower() for words in details if words[:3] == ['USE', 'TEMP', 'B-TREE'])
+    return [problem for problem in problems if problem]
+
+
+def advise(app):
+    """返回所有语句的Finding列表，problems为空表示该语句能完全利用索引"""
+    statements = capture_statements(app, advisor_pages())
+    tables = set(db.metadata.tables)
+    connection = db.engine.raw_connection()
+    try:
+        findings = []
+        for url, statement, parameters in statements.values():
+            plan = explain(connection, statement, parameters)
+            findings.append(Finding(url, statement, plan, plan_problems(statement, plan, tables)))
+    finally:
+        connection.close()
+    return findings
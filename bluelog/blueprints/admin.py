@@ -5,16 +5,21 @@
     :copyright: © 2018 Grey Li <withlihui@gmail.com>
     :license: MIT, see LICENSE for more details.
 """
-import os
+
+from datetime import datetime, timedelta
 
 from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, send_from_directory
 from flask_login import login_required, current_user
 from flask_ckeditor import upload_success, upload_fail
 
-from bluelog.extensions import db
+from bluelog.extensions import db, query_budget, query_sampler, context_cache
 from bluelog.forms import SettingForm, PostForm, CategoryForm, LinkForm
-from bluelog.models import Post, Category, Comment, Link
-from bluelog.utils import redirect_back, allowed_file
+from bluelog.models import Admin, Post, Category, Comment, Link
+from bluelog.moderation import comment_selection, approve_comments, delete_comments, delete_posts
+from bluelog.pagination import keyset_paginate
+from bluelog.queries import manage_post_listing
+from bluelog.uploads import UploadError, process_upload, resolve_image
+from bluelog.utils import redirect_back
 
 
 admin_bp = Blueprint('admin', __name__)
@@ -26,11 +31,12 @@ admin_bp = Blueprint('admin', __name__)
 def settings():
     form = SettingForm()
     if form.validate_on_submit():
-        current_user.name = form.name.data
-        current_user.blog_title = form.blog_title.data
-        current_user.blog_sub_title = form.blog_sub_title.data
-        current_user.about = form.about.data
-        db.session.commit()
+        admin = Admin.query.get_or_404(current_user.id)     # current_user是缓存的只读身份，修改时查询管理员记录
+        admin.name = form.name.data
+        admin.blog_title = form.blog_title.data
+        admin.blog_sub_title = form.blog_sub_title.data
+        admin.about = form.about.data
+        db.session.commit()     # 提交后缓存的管理员快照失效
         flash('设置已更新', 'success')
         return redirect(url_for('blog.index'))
     # 从数据库中获取用户name,blog_title,blog_sub_title,about等属性,初始化显示到对应表单输入框内
@@ -44,13 +50,13 @@ def settings():
 # 管理文章
 @admin_bp.route('/post/manage')
 @login_required
+@query_budget.limit(10)
 def manage_post():
-    page = request.args.get('page', 1, type=int)
     # 从配置变量中获取per_page，实例化分页对象pagination
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['BLUELOG_MANAGE_POST_PER_PAGE'])
+    pagination = keyset_paginate(manage_post_listing(), Post.timestamp, Post.id,
+                                 per_page=current_app.config['BLUELOG_MANAGE_POST_PER_PAGE'])
     posts = pagination.items
-    return render_template('admin/manage_post.html', page=page, pagination=pagination, posts=posts)
+    return render_template('admin/manage_post.html', page=pagination.page, pagination=pagination, posts=posts)
 
 
 # 新建文章
@@ -105,6 +111,18 @@ def delete_post(post_id):
     return redirect_back()
 
 
+# 批量删除文章，文章的评论一起删除
+@admin_bp.route('/post/bulk-delete', methods=['POST'])
+@login_required
+def bulk_delete_posts():
+    ids = request.form.getlist('ids', type=int)
+    if not ids:
+        flash('No posts selected.', 'warning')
+        return redirect_back()
+    flash('%d posts deleted.' % delete_posts(ids), 'success')
+    return redirect_back()
+
+
 # 评论
 @admin_bp.route('/post/<int:post_id>/set-comment', methods=['POST'])
 @login_required
@@ -123,10 +141,10 @@ def set_comment(post_id):
 # 管理评论
 @admin_bp.route('/comment/manage')
 @login_required
+@query_budget.limit(10)
 def manage_comment():
     # 管理评论界面筛选，评论划分为all,unreviewed(未读),admin(管理员评论),查询字符串查询对应过滤器filter，默认值为all
     filter_rule = request.args.get('filter', 'all')  # 'all', 'unreviewed', 'admin'
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLUELOG_COMMENT_PER_PAGE']
     # unread则返回未读comments
     if filter_rule == 'unread':
@@ -138,9 +156,15 @@ def manage_comment():
     else:
         filtered_comments = Comment.query
 
-    pagination = filtered_comments.order_by(Comment.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = keyset_paginate(filtered_comments, Comment.timestamp, Comment.id, per_page=per_page)
     comments = pagination.items
-    return render_template('admin/manage_comment.html', comments=comments, pagination=pagination)
+    # 键集分页不统计总数：已审核的评论数是各文章评论计数之和，再加上未读评论数
+    comment_total = None
+    if filter_rule not in ('unread', 'admin'):
+        reviewed = db.session.query(db.func.coalesce(db.func.sum(Post.comment_count), 0)).scalar()
+        comment_total = reviewed + context_cache.get('unread_comments')
+    return render_template('admin/manage_comment.html', comments=comments, pagination=pagination,
+                           comment_total=comment_total)
 
 
 # 审核评论
@@ -158,16 +182,42 @@ def approve_comment(comment_id):
 @admin_bp.route('/comment/<int:comment_id>/delete', methods=['POST'])
 @login_required
 def delete_comment(comment_id):
-    comment = Comment.query.get_or_404(comment_id)
-    db.session.delete(comment)
-    db.session.commit()
+    Comment.query.get_or_404(comment_id)
+    delete_comments(comment_selection(ids=[comment_id]))   # 按路径前缀一次删除评论及其所有回复
     flash('评论已删除', 'success')
     return redirect_back()
 
 
+def _bulk_comment_selection():
+    # 勾选的评论id列表优先，否则按天数选出较早的未读评论
+    ids = request.form.getlist('ids', type=int)
+    if ids:
+        return comment_selection(ids=ids)
+    days = request.form.get('older_than', type=int)
+    if days is not None and days >= 0:
+        return comment_selection(unread_before=datetime.utcnow() - timedelta(days=days))
+    return None
+
+
+# 批量审核、删除评论，删除时评论的回复一起删除
+@admin_bp.route('/comment/bulk', methods=['POST'])
+@login_required
+def bulk_comments():
+    action = request.form.get('action')
+    selection = _bulk_comment_selection()
+    if action not in ('approve', 'delete') or selection is None:
+        flash('No comments selected.', 'warning')
+    elif action == 'approve':
+        flash('%d条评论已审核' % approve_comments(selection), 'success')
+    else:
+        flash('%d条评论已删除' % delete_comments(selection), 'success')
+    return redirect_back()
+
+
 # 管理分类
 @admin_bp.route('/category/manage')
 @login_required
+@query_budget.limit(10)
 def manage_category():
     return render_template('admin/manage_category.html')
 
@@ -224,6 +274,7 @@ def delete_category(category_id):
 # 链接管理
 @admin_bp.route('/link/manage')
 @login_required
+@query_budget.limit(10)
 def manage_link():
     return render_template('admin/manage_link.html')
 
@@ -272,25 +323,45 @@ def delete_link(link_id):
     return redirect(url_for('.manage_link'))
 
 
+# 慢查询，按语句形状汇总采样到的慢查询，总耗时最多的在前
+@admin_bp.route('/slow-queries', methods=['GET', 'POST'])
+@login_required
+def slow_queries():
+    if request.method == 'POST':
+        query_sampler.clear()
+        flash('Slow queries cleared.', 'success')
+        return redirect(url_for('.slow_queries'))
+    return render_template('admin/slow_queries.html', stats=query_sampler.top(),
+                           sample_rate=query_sampler.sample_rate, threshold=query_sampler.threshold)
+
+
 # 获取图片路径
 @admin_bp.route('/uploads/<path:filename>')
 def get_image(filename):
-    return send_from_directory(current_app.config['BLUELOG_UPLOAD_PATH'], filename)
+    directory = current_app.config['BLUELOG_UPLOAD_PATH']
+    accept_webp = request.accept_mimetypes['image/webp'] > 0
+    filename, immutable = resolve_image(directory, filename, accept_webp)
+    response = send_from_directory(directory, filename)
+    response.vary.add('Accept')
+    if immutable:   # 内容寻址的文件名对应的内容永远不变，浏览器和CDN不必重新验证
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['BLUELOG_UPLOAD_CACHE_SECONDS']
+        response.cache_control.immutable = True
+    return response
 
 
 # 上传图片
 @admin_bp.route('/upload', methods=['POST'])
+@login_required
 def upload_image():
     f = request.files.get('upload')
-    # 若不符合规定文件名
-    if not allowed_file(f.filename):
+    if f is None:
         return upload_fail('Image only!')
-    f.save(os.path.join(current_app.config['BLUELOG_UPLOAD_PATH'], f.filename))
+    try:
+        # 按文件内容判断类型并使用随机文件名，不使用客户端提供的文件名
+        filename = process_upload(f.stream, request.content_length, current_app.config)
+    except UploadError as e:
+        return upload_fail(str(e))
     # 设置图片url规则
-    url = url_for('.get_image', filename=f.filename)
-    return upload_success(url, f.filename)
-
-
-
-
-
+    url = url_for('.get_image', filename=filename)
+    return upload_success(url, filename)
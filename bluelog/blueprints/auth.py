@@ -5,9 +5,10 @@
     :copyright: © 2018 Grey Li <withlihui@gmail.com>
     :license: MIT, see LICENSE for more details.
 """
-from flask import render_template, flash, redirect, url_for, Blueprint
+from flask import render_template, flash, redirect, url_for, request, Blueprint
 from flask_login import login_user, logout_user, login_required, current_user
 
+from bluelog.extensions import login_guard
 from bluelog.forms import LoginForm
 from bluelog.models import Admin
 from bluelog.utils import redirect_back
@@ -15,6 +16,13 @@ from bluelog.utils import redirect_back
 # 创建蓝图实例
 auth_bp = Blueprint('auth', __name__)
 
+# 登录失败的结果 -> (提示信息, 类别, 状态码)
+LOGIN_FAILURES = {
+    'failure': ('用户名或密码错误。', 'warning', 200),
+    'throttled': ('登录失败次数过多，请稍后再试。', 'warning', 429),
+    'busy': ('登录请求过多，请稍后再试。', 'warning', 503),
+}
+
 
 # 登录页面
 @auth_bp.route('/login', methods=['GET', 'POST'])
@@ -27,20 +35,20 @@ def login():
     form = LoginForm()
     # 表单提交并验证通过
     if form.validate_on_submit():
-        username = form.username.data
-        password = form.password.data
-        remember = form.remember.data
-        # 从数据库中查询出Admin对象，判断username的值，并使用Admin类中的validate_password()方法验证密码
+        # 从数据库中查询出Admin对象，在登录线程池中验证用户名和密码；失败次数过多或验证队列已满时不再验证
         admin = Admin.query.first()
         if admin:
-            if username == admin.username and admin.validate_password(password):
+            result = login_guard.attempt(request.remote_addr, admin.username, admin.password_hash,
+                                         form.username.data, form.password.data)
+            if result == 'success':
                 # 通过验证就调用login_user()方法登录用户，传入admin对象和remember字段的值作为参数
-                login_user(admin, remember)
+                login_user(admin, form.remember.data)
                 flash('欢迎回来！', 'info')
                 return redirect_back()  # 重定向回上一个页面
-            flash('用户名或密码错误。', 'warning')
-        else:
-            flash('还没有注册账户！', 'warning')
+            message, category, status = LOGIN_FAILURES[result]
+            flash(message, category)
+            return render_template('auth/login.html', form=form), status
+        flash('还没有注册账户！', 'warning')
     return render_template('auth/login.html', form=form)
 
 
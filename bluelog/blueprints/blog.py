@@ -5,13 +5,18 @@
     :使用蓝本可以将程序模块化，蓝本下的所有路由设置不同的URL前缀或子域名
     :蓝本一般在子包中创建，使用包管理蓝本允许你设置蓝本独有的静态文件和模板，并在蓝本内对各类函数分模块存储
 """
+from datetime import datetime
+
 from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, abort, make_response
 from flask_login import current_user
 
 from bluelog.emails import send_new_comment_email, send_new_reply_email
-from bluelog.extensions import db
+from bluelog.extensions import db, page_cache, query_budget, comment_spool
 from bluelog.forms import CommentForm, AdminCommentForm
 from bluelog.models import Post, Category, Comment
+from bluelog.pagination import keyset_paginate
+from bluelog.queries import post_listing, comment_threads
+from bluelog.search import search_available, paginate_search
 from bluelog.utils import redirect_back
 
 # 用flask下的Blueprint创建蓝本实例
@@ -20,44 +25,113 @@ blog_bp = Blueprint('blog', __name__)
 
 # 博客默认页面
 @blog_bp.route('/')
+@page_cache.cached('index')     # 匿名访客整页缓存，相关数据提交修改后按标签失效
+@query_budget.limit(10)     # 每个请求最多10条查询，超出或出现N+1查询时记录警告(测试中抛出异常)
 # 获取分页记录
 def index():
-    page = request.args.get('page', 1, type=int)    # 从查询字符串获取当前页数，默认值为1
     per_page = current_app.config['BLUELOG_POST_PER_PAGE']  # 从配置变量获取每页文章数量
-    # 调用查询方法paginate()会返回一个Pagination类实例，它包含分页信息，我们称为分页对象,order_by()以文章时间排序
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(page, per_page=per_page)   # 分页对象
+    # keyset_paginate()从查询字符串读取页码或游标，按(timestamp, id)倒序定位，返回与Pagination接口兼容的分页对象
+    # post_listing()只查询列表需要的字段，不加载文章正文
+    pagination = keyset_paginate(post_listing(), Post.timestamp, Post.id, per_page=per_page)   # 分页对象
     posts = pagination.items    # 当前页数的记录列表，pagination对象调用items属性以列表形式返回对应页数的记录
     return render_template('blog/index.html', pagination=pagination, posts=posts)   # 模板渲染
 
 
 # 关于页面
 @blog_bp.route('/about')
+@page_cache.cached('about')
 def about():
     return render_template('blog/about.html')
 
 
 # 分类页面显示
 @blog_bp.route('/category/<int:category_id>')
+@page_cache.cached('category:{category_id}')
+@query_budget.limit(10)
 def show_category(category_id):
     category = Category.query.get_or_404(category_id)   # get_or_404()方法查询指定id的记录
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLUELOG_POST_PER_PAGE']  # 从配置变量获取每页文章数
-    # with_parent(category)查询方法传入分类对象，最终筛选出属于该分类的所有文章记录(返回查询对象)
-    pagination = Post.query.with_parent(category).order_by(Post.timestamp.desc()).paginate(page, per_page)
+    # 筛选出属于该分类的所有文章记录(返回查询对象)
+    pagination = keyset_paginate(post_listing().filter(Post.category_id == category.id),
+                                 Post.timestamp, Post.id, per_page=per_page)
     posts = pagination.items    # pagination对象调用items属性以列表形式返回对应页数的记录
     return render_template('blog/category.html', category=category, pagination=pagination, posts=posts)
 
 
+def _comment_page(post, threaded):
+    """返回文章一页评论的(分页对象, 评论列表, 层级)；树形显示时按顶层评论分页，层级为None表示平铺显示"""
+    per_page = current_app.config['BLUELOG_COMMENT_PER_PAGE']   # 从配置变量获取每页评论数
+    # with_parent()传入模型类实例作为参数,返回和这个实例相关的对象,filter_by()使用指定规则过滤记录,评论按时间正序排列
+    query = Comment.query.with_parent(post).filter_by(reviewed=True)
+    if threaded:
+        query = query.filter(Comment.replied_id.is_(None))
+    else:
+        query = query.options(db.joinedload(Comment.replied))  # 同一条语句取出被回复的评论，模板中不再逐条懒加载
+    pagination = keyset_paginate(query, Comment.timestamp, Comment.id, per_page=per_page, descending=False)
+    comments = pagination.items  # pagination对象调用items属性以列表形式返回对应页数的记录
+    if not threaded:
+        return pagination, comments, None
+    return (pagination,) + comment_threads(comments)
+
+
+def _publish_comment(post, replied_id, fields, from_admin, reviewed):
+    # 实例化Comment类,传入相应参数
+    comment = Comment(post=post, replied_id=replied_id, from_admin=from_admin, reviewed=reviewed, **fields)
+    db.session.add(comment)  # 添加到数据库会话
+    if replied_id:
+        send_new_reply_email(Comment.query.get(replied_id))   # 新回复提醒(合并成摘要邮件)
+    if not from_admin:
+        send_new_comment_email(post)  # 审核提醒
+    db.session.commit()  # 评论和提醒一起提交到数据库
+
+
+@comment_spool.writer
+def write_spooled_comments(records):
+    """把评论写入队列中的一批匿名评论和对应的提醒在一个事务中写入数据库，返回写入的条数
+    跳过文章或被回复的评论已经删除的评论，以及已经写入过的评论(写入后、删除队列文件前崩溃时会重新读取)"""
+    # 不修改传入的记录，写入失败时队列会把同一批记录拆开重试
+    records = [dict(record, timestamp=datetime.fromisoformat(record['timestamp'])) for record in records]
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(set(r['post_id'] for r in records)))}
+    replied = {comment.id: comment for comment in
+               Comment.query.filter(Comment.id.in_(set(r['replied_id'] for r in records) - {None}))}
+    replied[None] = None
+    written = set(db.session.query(Comment.post_id, Comment.timestamp, Comment.email, Comment.body)
+                  .filter(Comment.timestamp.in_(set(r['timestamp'] for r in records))))
+    comments = []
+    for record in records:
+        key = (record['post_id'], record['timestamp'], record['email'], record['body'])
+        if record['post_id'] in posts and record['replied_id'] in replied and key not in written:
+            written.add(key)
+            comments.append((record['url_root'], Comment(
+                author=record['author'], email=record['email'], site=record['site'], body=record['body'],
+                timestamp=record['timestamp'], post=posts[record['post_id']], replied_id=record['replied_id'])))
+    try:
+        db.session.add_all(comment for url_root, comment in comments)
+        _notify_spooled_comments(comments, replied)
+        db.session.commit()
+    except Exception:   # 回滚后同一个应用上下文中还可以继续写入其他队列文件
+        db.session.rollback()
+        raise
+    return len(comments)
+
+
+def _notify_spooled_comments(comments, replied):
+    # 提醒中的链接使用提交评论的请求的域名
+    for url_root in set(url_root for url_root, comment in comments):
+        with current_app.test_request_context(base_url=url_root):
+            for comment in (comment for root, comment in comments if root == url_root):
+                if comment.replied_id:
+                    send_new_reply_email(replied[comment.replied_id])
+                send_new_comment_email(comment.post)
+
+
 # 文章正文显示
 @blog_bp.route('/post/<int:post_id>', methods=['GET', 'POST'])
+@page_cache.cached('post:{post_id}')   # 只缓存GET请求，提交评论的POST请求不受影响
+@query_budget.limit(15)
 def show_post(post_id):
     post = Post.query.get_or_404(post_id)   # get_or_404()方法查询指定id的记录
-    page = request.args.get('page', 1, type=int)    # 查询参数获取page页码
-    per_page = current_app.config['BLUELOG_COMMENT_PER_PAGE']   # 从配置变量获取每页评论数
-    # with_parent()传入模型类实例作为参数,返回和这个实例相关的对象,filter_by()使用指定规则过滤记录,order_by()根据制定规则排序
-    pagination = Comment.query.with_parent(post).filter_by(reviewed=True).order_by(Comment.timestamp.asc()).paginate(
-        page, per_page)  # 分页对象，这里的with_parent(post)方法获取文章所属的评论
-    comments = pagination.items  # pagination对象调用items属性以列表形式返回对应页数的记录
+    pagination, comments, depths = _comment_page(post, threaded=request.args.get('view') == 'thread')
 
     # 判断当前用户认证状态，渲染对应评论表单
     if current_user.is_authenticated:
@@ -76,28 +150,37 @@ def show_post(post_id):
 
     # 如果表单提交并通过验证
     if form.validate_on_submit():
-        author = form.author.data
-        email = form.email.data
-        site = form.site.data
-        body = form.body.data
-        # 实例化Comment类,传入相应参数
-        comment = Comment(
-            author=author, email=email, site=site, body=body,
-            from_admin=from_admin, post=post, reviewed=reviewed)
         replied_id = request.args.get('reply')
         if replied_id:
-            replied_comment = Comment.query.get_or_404(replied_id)  # 获取回复记录
-            comment.replied = replied_comment   # 恢复记录赋值给comment.replied
-            send_new_reply_email(replied_comment)   # 发送新回复提醒邮件
-        db.session.add(comment)  # 添加到数据库会话
-        db.session.commit()  # 提交到数据库
+            replied_id = Comment.query.get_or_404(replied_id).id    # 被回复的评论必须存在
+        fields = dict(author=form.author.data, email=form.email.data, site=form.site.data, body=form.body.data)
+        if from_admin or not comment_spool.enabled:
+            _publish_comment(post, replied_id, fields, from_admin, reviewed)
+        else:
+            # 匿名评论写入本地队列后立即返回，由后台线程批量写入数据库
+            comment_spool.append(dict(fields, post_id=post.id, replied_id=replied_id,
+                                      timestamp=datetime.utcnow().isoformat(), url_root=request.url_root))
         if current_user.is_authenticated:  # 管理员的回复
             flash('Comment published.', 'success')
         else:   # 匿名用户发布评论提示
             flash('Thanks, your comment will be published after reviewed.', 'info')
-            send_new_comment_email(post)  # 发送审核提醒邮件
         return redirect(url_for('.show_post', post_id=post_id))  # 重定向到.show_post
-    return render_template('blog/post.html', post=post, pagination=pagination, form=form, comments=comments)
+    return render_template('blog/post.html', post=post, pagination=pagination, form=form, comments=comments,
+                           depths=depths)
+
+
+# 搜索文章和评论
+@blog_bp.route('/search')
+@query_budget.limit(10)
+def search():
+    keywords = request.args.get('q', '').strip()
+    if not keywords:
+        flash('Enter keyword about post or comment.', 'warning')
+        return redirect_back()
+    if not search_available():
+        return render_template('blog/search.html', keywords=keywords, pagination=None, results=[])
+    pagination = paginate_search(keywords, current_app.config['BLUELOG_SEARCH_RESULT_PER_PAGE'])
+    return render_template('blog/search.html', keywords=keywords, pagination=pagination, results=pagination.items)
 
 
 # 显示回复评论标记
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""
+缓存层
+    模板上下文中的管理员信息、分类列表、链接列表、未读评论数在每个页面(包括错误页面)都会查询一次，
+    而这些数据很少变化，因此把它们缓存在进程内，跨请求复用
+    通过SQLAlchemy会话事件记录每次flush中发生变化的模型，在commit之后让依赖这些模型的缓存失效
+    缓存的是脱离会话的快照(命名元组)而不是ORM对象，避免跨请求访问已关闭会话的实例
+    PageCache为匿名访客缓存整个页面，模型实例通过cache_tags()给出受影响的页面标签，提交后按标签失效
+    配置了只读副本时，提交后副本同步之前从副本读到的数据不写入缓存(见routing.py)
+"""
+import hashlib
+import itertools
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import namedtuple, OrderedDict
+from functools import wraps
+
+from flask import request, session, g, current_app, make_response
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.orm import Session
+
+_CHANGES_KEY = 'bluelog_changed_models'
+_commit_handlers = []
+
+
+def on_models_committed(handler):
+    """注册提交回调，handler接收本次提交中发生变化的模型类名及页面缓存标签组成的集合"""
+    _commit_handlers.append(handler)
+    return handler
+
+
+def _pending_changes(session):
+    return session.info.setdefault(_CHANGES_KEY, set())
+
+
+# flush之后new/dirty/deleted仍然保持flush之前的状态，可以据此得到本次写入涉及的模型
+# 只有集合关系变化(比如文章下新增了一条评论)的对象本身没有被修改，不计入
+@event.listens_for(Session, 'after_flush')
+def _record_flushed_models(session, flush_context):
+    changes = _pending_changes(session)
+    dirty = (instance for instance in session.dirty if session.is_modified(instance, include_collections=False))
+    for instance in itertools.chain(session.new, dirty, session.deleted):
+        changes.add(type(instance).__name__)
+        if hasattr(instance, 'cache_tags'):
+            changes.update(instance.cache_tags())
+
+
+# query.update()/query.delete()批量操作不经过flush，无法得知具体影响了哪些行，页面缓存全部失效
+@event.listens_for(Session, 'after_bulk_update')
+def _record_bulk_update(update_context):
+    _pending_changes(update_context.session).update((update_context.mapper.class_.__name__, '*'))
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def _record_bulk_delete(delete_context):
+    _pending_changes(delete_context.session).update((delete_context.mapper.class_.__name__, '*'))
+
+
+@event.listens_for(Session, 'after_commit')
+def _dispatch_committed_models(session):
+    changes = session.info.pop(_CHANGES_KEY, None)
+    if changes:
+        for handler in _commit_handlers:
+            handler(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending_changes(session):
+    session.info.pop(_CHANGES_KEY, None)
+
+
+_snapshot_types = {}
+
+
+def snapshot(instance, **extra):
+    """把ORM实例的列属性复制为不可变的命名元组，extra用于附加额外字段(比如统计值)"""
+    if instance is None:
+        return None
+    model = type(instance)
+    fields = tuple(attr.key for attr in sa_inspect(model).column_attrs) + tuple(sorted(extra))
+    snapshot_type = _snapshot_types.get((model, fields))
+    if snapshot_type is None:
+        snapshot_type = _snapshot_types[(model, fields)] = namedtuple(model.__name__ + 'Snapshot', fields)
+    values = dict((key, getattr(instance, key)) for key in fields if key not in extra)
+    values.update(extra)
+    return snapshot_type(**values)
+
+
+def _stale_replica_read():
+    # 本进程刚提交过修改时，从副本读到的可能是提交之前的数据
+    router = current_app.extensions.get('database_router')
+    return router is not None and router.reading_replica() and router.recently_committed()
+
+
+class ContextCache(object):
+    """进程内的模板上下文缓存，按键注册加载函数及其依赖的模型"""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._loaders = {}  # 键 -> (加载函数, 依赖的模型类名)
+        self._values = {}  # 键 -> (值, 过期时间)
+        self._generation = 0  # 每次失效递增，避免把失效前加载的旧值写回缓存
+        self.enabled = True
+        self.timeout = None
+        self.hits = 0
+        self.misses = 0
+        on_models_committed(self._on_models_committed)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_CONTEXT_CACHE', True)
+        app.config.setdefault('BLUELOG_CONTEXT_CACHE_TIMEOUT', None)
+        self.enabled = app.config['BLUELOG_CONTEXT_CACHE']
+        # 多个worker进程各自持有缓存，其他进程的写入只能依靠过期时间同步
+        self.timeout = app.config['BLUELOG_CONTEXT_CACHE_TIMEOUT']
+        self.clear()
+        app.extensions['context_cache'] = self
+
+    def memoize(self, key, *models):
+        """装饰器，注册key对应的加载函数，models为该数据依赖的模型类名"""
+        def decorator(loader):
+            self._loaders[key] = (loader, frozenset(models))
+            return loader
+        return decorator
+
+    def get(self, key):
+        loader = self._loaders[key][0]
+        if not self.enabled:
+            return loader()
+        now = time.time()
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation
+        value = loader()
+        if _stale_replica_read():
+            return value
+        with self._lock:
+            if generation == self._generation:
+                expires = now + self.timeout if self.timeout else None
+                self._values[key] = (value, expires)
+        return value
+
+    def invalidate(self, *models):
+        """删除依赖指定模型的缓存项"""
+        models = set(models)
+        with self._lock:
+            self._generation += 1
+            for key, (loader, depends_on) in self._loaders.items():
+                if depends_on & models:
+                    self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._values.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._values))
+
+    def _on_models_committed(self, models):
+        self.invalidate(*models)
+
+
+CachedPage = namedtuple('CachedPage', 'body content_type csrf')
+
+_CSRF_PLACEHOLDER = b'__bluelog_csrf_token__'
+
+
+class MemoryBackend(object):
+    """进程内LRU缓存，总字节数超过max_bytes时淘汰最久未使用的页面"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # 键 -> (页面, 标签, 过期时间)
+        self._tags = {}  # 标签 -> 键集合
+        self._invalidated = {}  # 标签 -> 最近一次失效的时间
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] is not None and entry[2] <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, page, tags, timeout):
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (page, tags, expires)
+            self.size += len(page.body)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidated_within(self, tags, seconds):
+        """tags中是否有标签在最近seconds秒内失效过"""
+        deadline = time.time() - seconds
+        with self._lock:
+            return any(self._invalidated.get(tag, 0) > deadline for tag in tags)
+
+    def invalidate(self, tags):
+        now = time.time()
+        with self._lock:
+            for tag in tags:
+                self._invalidated[tag] = now
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._invalidated['*'] = time.time()
+            self.size = 0
+
+    def _remove(self, key):
+        page, tags, expires = self._entries.pop(key)
+        self.size -= len(page.body)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class FileSystemBackend(object):
+    """磁盘缓存，多个gunicorn worker进程共享同一个目录
+    每个标签对应一个版本文件，失效时只需改写版本号；读取页面时比较保存时记录的标签版本，不一致即视为失效
+    扫描整个目录淘汰旧页面的代价与页面数成正比，每个进程每写入prune_every个页面才扫描一次，
+    所以页面数最多暂时超出max_entries(进程数 × prune_every)个
+    """
+
+    def __init__(self, cache_dir, max_entries=2000, prune_every=None):
+        self.cache_dir = cache_dir
+        self.tag_dir = os.path.join(cache_dir, 'tags')
+        self.max_entries = max_entries
+        self.prune_every = prune_every or max(max_entries // 10, 1)
+        self._writes = itertools.count(1)   # next()在GIL下是原子操作，多个请求线程不会重复计数
+        os.makedirs(self.tag_dir, exist_ok=True)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                page, versions, expires = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if (expires is not None and expires <= time.time()) or \
+                any(self._version(tag) != version for tag, version in versions.items()):
+            self._unlink(path)
+            return None
+        return page
+
+    def set(self, key, page, tags, timeout):
+        expires = time.time() + timeout if timeout else None
+        versions = dict((tag, self._version(tag)) for tag in set(tags) | {'*'})
+        self._write(self._path(key), pickle.dumps((page, versions, expires), pickle.HIGHEST_PROTOCOL))
+        if next(self._writes) % self.prune_every == 0:
+            self._prune()
+
+    def invalidated_within(self, tags, seconds):
+        """tags中是否有标签在最近seconds秒内失效过(任何进程)，按版本文件的修改时间判断"""
+        deadline = time.time() - seconds
+        for tag in tags:
+            try:
+                if os.stat(self._tag_path(tag)).st_mtime > deadline:
+                    return True
+            except OSError:
+                continue
+        return False
+
+    def invalidate(self, tags):
+        for tag in tags:
+            self._write(self._tag_path(tag), uuid.uuid4().hex.encode())
+
+    def clear(self):
+        self.invalidate(['*'])
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _tag_path(self, tag):
+        return os.path.join(self.tag_dir, hashlib.sha1(tag.encode('utf-8')).hexdigest())
+
+    def _version(self, tag):
+        try:
+            with open(self._tag_path(tag), 'rb') as f:
+                return f.read()
+        except OSError:
+            return b''
+
+    def _write(self, path, data):
+        # 先写临时文件再原子替换，其他进程不会读到写了一半的文件
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _prune(self):
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file()]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            self._unlink(entry.path)
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class PageCache(object):
+    """匿名访客的整页缓存，缓存键由路径、查询字符串和主题cookie组成"""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.timeout = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        on_models_committed(self._on_models_committed)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_PAGE_CACHE', None)
+        app.config.setdefault('BLUELOG_PAGE_CACHE_TIMEOUT', 300)
+        backend = app.config['BLUELOG_PAGE_CACHE']
+        if backend == 'memory':
+            self.backend = MemoryBackend(app.config.get('BLUELOG_PAGE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+        elif backend == 'filesystem':
+            self.backend = FileSystemBackend(app.config['BLUELOG_PAGE_CACHE_DIR'])
+        else:
+            self.backend = None
+        self.timeout = app.config['BLUELOG_PAGE_CACHE_TIMEOUT']
+        with self._lock:
+            self.hits = self.misses = 0
+        app.extensions['page_cache'] = self
+
+    def cached(self, *tags):
+        """视图装饰器，tags中可以使用视图参数，比如 'post:{post_id}' """
+        def decorator(view):
+            @wraps(view)
+            def decorated(*args, **kwargs):
+                if not self._cacheable():
+                    response = make_response(view(*args, **kwargs))
+                    response.headers['X-Page-Cache'] = 'BYPASS'
+                    return response
+                key = self._make_key()
+                page = self.backend.get(key)
+                if page is not None:
+                    with self._lock:
+                        self.hits += 1
+                    return self._make_response(page, 'HIT')
+                with self._lock:
+                    self.misses += 1
+                response = make_response(view(*args, **kwargs))
+                page_tags = [tag.format(**kwargs) for tag in tags]
+                if response.status_code == 200 and not response.direct_passthrough and not self._stale(page_tags):
+                    self.backend.set(key, self._make_page(response), page_tags, self.timeout)
+                response.headers['X-Page-Cache'] = 'MISS'
+                return response
+            return decorated
+        return decorator
+
+    def invalidate(self, *tags):
+        if self.backend is not None:
+            if '*' in tags:
+                self.backend.clear()
+            else:
+                self.backend.invalidate(tags)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses)
+
+    def _stale(self, tags):
+        # 页面的标签刚失效时，副本可能还没有同步这次修改，从副本读到的页面不缓存
+        router = current_app.extensions.get('database_router')
+        return router is not None and router.reading_replica() and \
+            self.backend.invalidated_within(tags + ['*'], router.replica_lag())
+
+    def _cacheable(self):
+        # 登录用户、有待显示的闪现消息时页面内容因人而异，不使用缓存
+        return self.backend is not None and request.method == 'GET' and \
+            not current_user.is_authenticated and '_flashes' not in session
+
+    @staticmethod
+    def _make_key():
+        return '%s|%s' % (request.full_path, request.cookies.get('theme', 'perfect_blue'))
+
+    @staticmethod
+    def _make_page(response):
+        body = response.get_data()
+        # CSRF令牌与会话绑定，保存时替换为占位符，命中时再为当前访客生成
+        token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+        csrf = bool(token) and token.encode() in body
+        if csrf:
+            body = body.replace(token.encode(), _CSRF_PLACEHOLDER)
+        return CachedPage(body, response.headers.get('Content-Type'), csrf)
+
+    def _make_response(self, page, status):
+        body = page.body
+        if page.csrf:
+            body = body.replace(_CSRF_PLACEHOLDER, generate_csrf().encode())
+        response = current_app.response_class(body, content_type=page.content_type)
+        response.headers['X-Page-Cache'] = status
+        return response
+
+    def _on_models_committed(self, tags):
+        self.invalidate(*tags)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+文章正文渲染
+    文章正文由富文本编辑器生成HTML，保存时一次性计算出过滤后的HTML、纯文本、摘要、字数和阅读时间并存入数据库，
+    列表页和文章页直接读取这些字段，不必在每次渲染模板时对正文执行striptags、truncate等过滤器
+    HTML过滤使用标准库HTMLParser按白名单保留标签和属性，去掉脚本、事件属性和javascript:链接
+"""
+import math
+import re
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+from bluelog.uploads import responsive_image_attrs
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'code', 'del', 'div', 'em', 'figcaption', 'figure',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'kbd', 'li', 'ol', 'p', 'pre', 's', 'small',
+    'span', 'strike', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul',
+}
+ALLOWED_ATTRIBUTES = {
+    '*': {'class', 'style', 'title'},
+    'a': {'href', 'target', 'rel'},
+    'img': {'src', 'alt', 'width', 'height'},
+    'ol': {'start'},
+    'td': {'colspan', 'rowspan'},
+    'th': {'colspan', 'rowspan'},
+}
+# CKEditor用内联样式设置对齐和图片尺寸，只保留这些与排版相关的样式
+ALLOWED_STYLES = {
+    'text-align', 'width', 'height', 'float', 'margin', 'margin-left', 'margin-right',
+    'color', 'background-color', 'font-size', 'font-weight', 'font-style', 'text-decoration',
+}
+ALLOWED_SCHEMES = {'', 'http', 'https', 'mailto'}
+VOID_TAGS = {'br', 'hr', 'img'}
+DROPPED_CONTENT_TAGS = {'script', 'style', 'iframe', 'object', 'embed', 'noscript', 'template'}
+BLOCK_TAGS = {
+    'blockquote', 'br', 'caption', 'div', 'figcaption', 'figure', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'hr', 'li', 'p', 'pre', 'tr',
+}
+
+EXCERPT_LENGTH = 255
+WORDS_PER_MINUTE = 300
+_CJK = '㐀-䶿一-鿿豈-﫿'
+# 中日韩文字按单字计数，其他文字按连续的字母数字计数
+_WORD_RE = re.compile(r'[%s]|[^\W%s]+' % (_CJK, _CJK))
+
+
+class _Renderer(HTMLParser):
+    """一次解析同时输出过滤后的HTML和纯文本"""
+
+    def __init__(self):
+        super(_Renderer, self).__init__(convert_charrefs=True)
+        self.html = []
+        self.text = []
+        self.open_tags = []
+        self.skip_depth = 0     # 位于script等标签内部时，其中的内容全部丢弃
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_CONTENT_TAGS:
+            self.skip_depth += 1
+            return
+        if self.skip_depth:
+            return
+        if tag in BLOCK_TAGS:
+            self.text.append('\n')
+        if tag not in ALLOWED_TAGS:
+            return
+        self.html.append('<%s%s>' % (tag, ''.join(' %s="%s"' % (name, escape(value))
+                                                  for name, value in self._attrs(tag, attrs))))
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in DROPPED_CONTENT_TAGS:
+            self.skip_depth -= 1
+        elif tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_CONTENT_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+            return
+        if self.skip_depth:
+            return
+        if tag in BLOCK_TAGS:
+            self.text.append('\n')
+        # 忽略多余的结束标签，缺少的结束标签自动补全，保证输出的HTML不会破坏页面结构
+        if tag in self.open_tags:
+            while self.open_tags:
+                open_tag = self.open_tags.pop()
+                self.html.append('</%s>' % open_tag)
+                if open_tag == tag:
+                    break
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.html.append(escape(data, quote=False))
+            self.text.append(data)
+
+    def close(self):
+        super(_Renderer, self).close()
+        while self.open_tags:
+            self.html.append('</%s>' % self.open_tags.pop())
+
+    def _attrs(self, tag, attrs):
+        cleaned = list(self._clean_attrs(tag, attrs))
+        if tag == 'img':    # 上传图片的显示版本加上srcset，浏览器按屏幕宽度选择合适的版本
+            cleaned.extend(responsive_image_attrs(dict(cleaned).get('src')))
+        return cleaned
+
+    @staticmethod
+    def _clean_attrs(tag, attrs):
+        allowed = ALLOWED_ATTRIBUTES['*'] | ALLOWED_ATTRIBUTES.get(tag, set())
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name in ('href', 'src'):
+                if _url_scheme(value) not in ALLOWED_SCHEMES:
+                    continue
+            elif name == 'style':
+                value = _clean_style(value)
+                if not value:
+                    continue
+            yield name, value
+
+
+def _url_scheme(url):
+    # 去掉空白和控制字符后再检查协议，防止"java\tscript:"之类的写法绕过；无法解析的URL(如"http://[x")返回None
+    try:
+        return urlparse(re.sub(r'[\x00-\x20]', '', url)).scheme.lower()
+    except ValueError:
+        return None
+
+
+def _clean_style(style):
+    declarations = []
+    for declaration in style.split(';'):
+        prop, _, value = declaration.partition(':')
+        prop, value = prop.strip().lower(), value.strip()
+        if prop in ALLOWED_STYLES and value and not re.search(r'url\s*\(|expression|[<>"\\]', value, re.I):
+            declarations.append('%s: %s' % (prop, value))
+    return '; '.join(declarations)
+
+
+def truncate(text, length=EXCERPT_LENGTH, end='...', leeway=5):
+    """与Jinja2的truncate过滤器行为一致，尽量在单词边界处截断"""
+    if len(text) <= length + leeway:
+        return text
+    return text[:length - len(end)].rsplit(' ', 1)[0] + end
+
+
+def render_post(body):
+    """返回文章正文的派生字段：body_html, body_text, excerpt, word_count, reading_time"""
+    renderer = _Renderer()
+    renderer.feed(body or '')
+    renderer.close()
+
+    lines = (' '.join(line.split()) for line in ''.join(renderer.text).splitlines())
+    body_text = '\n'.join(line for line in lines if line)
+    word_count = len(_WORD_RE.findall(body_text))
+    return dict(
+        body_html=''.join(renderer.html),
+        body_text=body_text,
+        excerpt=truncate(' '.join(body_text.split())),
+        word_count=word_count,
+        reading_time=int(math.ceil(word_count / float(WORDS_PER_MINUTE))),
+    )
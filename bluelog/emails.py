@@ -5,47 +5,175 @@
     :copyright: © 2018 Grey Li <withlihui@gmail.com>
     :license: MIT, see LICENSE for more details.
 """
-# 多线程模块
-from threading import Thread
+import smtplib
+import time
+import uuid
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
 
 from flask import url_for, current_app
 from flask_mail import Message
+from markupsafe import escape
 
-from bluelog.extensions import mail
+from bluelog.extensions import db, mail
+from bluelog.models import QueuedMail, Notification
 
+FOOTER = '<p><small style="color: #868e96">Do not reply this email.</small></p>'
+# 只有一条提醒时仍然发送原来的单条提醒邮件：种类 -> (主题, 正文开头)
+SINGLE_MAILS = {
+    'comment': ('New comment', 'New comment in post <i>%s</i>, click the link below to check:'),
+    'reply': ('New reply', 'New reply for the comment you left in post <i>%s</i>, click the link below to check: '),
+}
+KIND_NAMES = {'comment': ('new comment', 'new comments'), 'reply': ('new reply', 'new replies')}
 
-# 异步发送邮件
-def _send_async_mail(app, message):
-    # 使用with调用app.app_context()手动激活程序上下文
-    with app.app_context():
-        mail.send(message)
 
-
-# 发送邮件函数
+# 发送邮件函数：邮件先写入数据库中的邮件队列，由flask mail-worker进程发送，程序重启也不会丢失
+# 请求处理过程中不再为每封邮件创建线程和SMTP连接
 def send_mail(subject, to, html):
-    app = current_app._get_current_object()
-    message = Message(subject, recipients=[to], html=html)
-    # 创建新线程实例
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    # 开始此线程
-    thr.start()
-    return thr
+    message = QueuedMail(subject=subject, recipient=to, html=html)
+    db.session.add(message)
+    db.session.commit()
+    return message
+
+
+def queue_depth():
+    """返回(等待发送数, 发送失败数)"""
+    counts = dict(db.session.query(QueuedMail.status, db.func.count(QueuedMail.id)).group_by(QueuedMail.status))
+    return counts.get('pending', 0), counts.get('failed', 0)
+
+
+def _claim(batch_size, now):
+    # 用一条UPDATE语句领取一批到期的邮件，并把下次发送时间推后一个租期：
+    # 多个worker同时运行时不会领到同一封邮件，worker中途退出时邮件会在租期结束后被重新领取
+    table = QueuedMail.__table__
+    due = db.and_(table.c.status == 'pending', table.c.next_attempt <= now)
+    ids = db.select([table.c.id]).where(due).order_by(table.c.id).limit(batch_size)
+    token = uuid.uuid4().hex
+    lease = timedelta(seconds=current_app.config['BLUELOG_MAIL_LEASE'])
+    db.session.execute(table.update().where(db.and_(table.c.id.in_(ids), due))
+                       .values(claim=token, next_attempt=now + lease))
+    db.session.commit()
+    return QueuedMail.query.filter_by(claim=token).order_by(QueuedMail.id).all()
+
+
+def _retry_later(message, error, now):
+    message.attempts += 1
+    message.claim = None
+    message.last_error = repr(error)
+    if message.attempts >= current_app.config['BLUELOG_MAIL_MAX_ATTEMPTS']:
+        message.status = 'failed'
+        current_app.logger.error('Giving up mail to %s: %r' % (message.recipient, error))
+        return 'failed'
+    # 指数退避：每次失败后等待时间加倍
+    delay = current_app.config['BLUELOG_MAIL_RETRY_DELAY'] * 2 ** (message.attempts - 1)
+    message.next_attempt = now + timedelta(seconds=delay)
+    current_app.logger.warning('Mail to %s failed, retry in %ds: %r' % (message.recipient, delay, error))
+    return 'retry'
+
+
+def _send(connection, message, now):
+    try:
+        connection.send(Message(message.subject, recipients=[message.recipient], html=message.html))
+    except (smtplib.SMTPException, OSError) as e:
+        return _retry_later(message, e, now)
+    db.session.delete(message)
+    return 'sent'
+
+
+def deliver_queued(batch_size=None):
+    """领取一批邮件并通过同一个SMTP连接发送，返回(发送成功数, 等待重试数, 放弃数)"""
+    now = datetime.utcnow()
+    remaining = _claim(batch_size or current_app.config['BLUELOG_MAIL_BATCH_SIZE'], now)
+    results = Counter()
+    try:
+        with mail.connect() as connection:
+            while remaining:
+                results[_send(connection, remaining[0], now)] += 1
+                remaining.pop(0)
+    except (smtplib.SMTPException, OSError) as e:
+        # 连接SMTP服务器失败，本批剩余的邮件全部稍后重试
+        for message in remaining:
+            results[_retry_later(message, e, now)] += 1
+    db.session.commit()
+    return results['sent'], results['retry'], results['failed']
+
+
+def run_mail_worker(batch_size=None, interval=5.0, once=False, report=None):
+    """循环合并提醒并发送邮件队列，队列为空时等待interval秒；once为真时只处理一批。report接收(发送, 重试, 放弃, 等待, 失败)计数"""
+    while True:
+        flush_notifications()
+        results = deliver_queued(batch_size)
+        if report is not None and (once or any(results)):
+            report(results + queue_depth())
+        if once:
+            return
+        if not any(results):
+            time.sleep(interval)
+
+
+def notify(recipient, kind, post):
+    """记录一条提醒，由mail-worker按收件人合并成摘要邮件。只加入会话，和评论在同一个事务中提交"""
+    if not recipient:   # 没有配置BLUELOG_EMAIL，或者被回复的评论没有填写邮箱
+        return
+    db.session.add(Notification(recipient=recipient, kind=kind, post_id=post.id, post_title=post.title,
+                                url=url_for('blog.show_post', post_id=post.id, _external=True) + '#comments'))
+
+
+def _describe(counts):
+    return ', '.join('%d %s' % (counts[kind], KIND_NAMES[kind][counts[kind] != 1])
+                     for kind in sorted(counts) if counts[kind])
+
+
+def render_digest(notifications, max_posts):
+    """把同一收件人的提醒按文章分组，返回(主题, HTML)；提醒最多的max_posts篇文章逐篇列出，其余的只汇总数量"""
+    if len(notifications) == 1:
+        notification = notifications[0]
+        subject, intro = SINGLE_MAILS[notification.kind]
+        return subject, '<p>%s</p><p><a href="%s">%s</a></p>%s' % (
+            intro % escape(notification.post_title), notification.url, notification.url, FOOTER)
+    posts = OrderedDict()   # 链接 -> (标题, 各种提醒的数量)
+    for notification in notifications:
+        posts.setdefault(notification.url, (notification.post_title, Counter()))[1][notification.kind] += 1
+    ranked = sorted(posts.items(), key=lambda item: -sum(item[1][1].values()))
+    items = ''.join('<li><a href="%s">%s</a>: %s</li>' % (url, escape(title), _describe(counts))
+                    for url, (title, counts) in ranked[:max_posts])
+    rest = ranked[max_posts:]
+    more = '<p>And %d more %s with %s.</p>' % (len(rest), 'post' if len(rest) == 1 else 'posts', _describe(
+        sum((counts for url, (title, counts) in rest), Counter()))) if rest else ''
+    total = _describe(Counter(notification.kind for notification in notifications))
+    return total[0].upper() + total[1:], '<p>%s in %d posts:</p><ul>%s</ul>%s%s' % (
+        total[0].upper() + total[1:], len(posts), items, more, FOOTER)
+
+
+def flush_notifications(now=None):
+    """收件人最早的一条提醒等待超过BLUELOG_NOTIFICATION_WINDOW秒时，把他的所有提醒合并成一封摘要邮件写入邮件队列
+    每个收件人每个时间窗口最多收到一封提醒邮件。返回写入的摘要数"""
+    now = now or datetime.utcnow()
+    deadline = now - timedelta(seconds=current_app.config['BLUELOG_NOTIFICATION_WINDOW'])
+    due = [recipient for recipient, in db.session.query(Notification.recipient).group_by(Notification.recipient)
+           .having(db.func.min(Notification.timestamp) <= deadline)]
+    digests = 0
+    for recipient in due:
+        notifications = Notification.query.filter_by(recipient=recipient).order_by(Notification.id).all()
+        if not notifications:   # 查询到期收件人之后，已经被其他worker合并
+            continue
+        # 多个mail-worker同时合并时，只有删除了全部这些提醒的worker写入摘要；合并期间新加入的提醒留到下一封
+        deleted = Notification.query.filter(Notification.recipient == recipient,
+                                            Notification.id <= notifications[-1].id).delete(synchronize_session=False)
+        if deleted != len(notifications):
+            db.session.rollback()
+            continue
+        subject, html = render_digest(notifications, current_app.config['BLUELOG_NOTIFICATION_DIGEST_POSTS'])
+        db.session.add(QueuedMail(subject=subject, recipient=recipient, html=html))
+        db.session.commit()
+        digests += 1
+    return digests
 
 
+# 新评论和新回复不再直接发送邮件，而是记录提醒，由mail-worker合并成摘要
 def send_new_comment_email(post):
-    # 由于邮件内容简单,直接在发信函数中写出正文内容
-    post_url = url_for('blog.show_post', post_id=post.id, _external=True) + '#comments'
-    send_mail(subject='New comment', to=current_app.config['BLUELOG_EMAIL'],
-              html='<p>New comment in post <i>%s</i>, click the link below to check:</p>'
-                   '<p><a href="%s">%s</a></P>'
-                   '<p><small style="color: #868e96">Do not reply this email.</small></p>'
-                   % (post.title, post_url, post_url))
+    notify(current_app.config['BLUELOG_EMAIL'], 'comment', post)
 
 
 def send_new_reply_email(comment):
-    post_url = url_for('blog.show_post', post_id=comment.post_id, _external=True) + '#comments'
-    send_mail(subject='New reply', to=comment.email,
-              html='<p>New reply for the comment you left in post <i>%s</i>, click the link below to check: </p>'
-                   '<p><a href="%s">%s</a></p>'
-                   '<p><small style="color: #868e96">Do not reply this email.</small></p>'
-                   % (comment.post.title, post_url, post_url))
+    notify(comment.email, 'reply', comment.post)
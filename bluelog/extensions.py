@@ -8,14 +8,21 @@ from flask_ckeditor import CKEditor
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import CSRFProtect
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_migrate import Migrate
 
+from bluelog.caching import ContextCache, PageCache
+from bluelog.metrics import Metrics
+from bluelog.profiling import QueryBudget, SlowQuerySampler
+from bluelog.routing import RoutingSQLAlchemy, DatabaseRouter
+from bluelog.security import LoginGuard
+from bluelog.spool import CommentSpool
+from bluelog.sqlite import SQLiteProfile
+
 # 拓展类实例化
 bootstrap = Bootstrap()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()   # 支持把蓝本的读请求路由到只读副本
 login_manager = LoginManager()
 csrf = CSRFProtect()
 ckeditor = CKEditor()
@@ -23,13 +30,25 @@ mail = Mail()
 moment = Moment()
 toolbar = DebugToolbarExtension()
 migrate = Migrate()
+context_cache = ContextCache()
+page_cache = PageCache()
+query_budget = QueryBudget()
+query_sampler = SlowQuerySampler()
+metrics = Metrics()
+sqlite_profile = SQLiteProfile()
+database_router = DatabaseRouter(db)
+login_guard = LoginGuard()
+comment_spool = CommentSpool()
 
 
 @login_manager.user_loader
 def load_user(user_id):     # 用户加载函数，接收用户ID为参数，返回对应的用户对象
-    from bluelog.models import Admin
-    user = Admin.query.get(int(user_id))    # 如果用户已登录则返回Admin类实例
-    return user  # 返回对应用户对象
+    # 每个已登录的请求都要加载用户，这里使用context_cache中的管理员快照(管理员提交修改后失效)，不必每次查询数据库
+    from bluelog.models import AdminIdentity
+    admin = context_cache.get('admin')
+    if admin is None or str(admin.id) != user_id:
+        return None
+    return AdminIdentity(admin)     # 只读的管理员身份，需要修改管理员时另外查询Admin
 
 
 login_manager.login_view = 'auth.login'
@@ -1,17 +1,55 @@
 # -*- coding: utf-8 -*-
 """
 为方便编写前台和后台功能，我们在建立数据库模型之后就编写生成虚拟数据的函数
+    文章和评论按CHUNK_SIZE行分块生成，每块用Core的executemany一次插入，外键id在内存中计算，不再逐行查询
+    每块使用由随机种子、数据类型和块序号决定的Faker和random实例，因此指定种子时结果与worker进程数无关，可以重现
+    Faker文本和文章正文渲染可以交给多个进程并行生成(map_func)，插入始终在主进程中进行
+    批量插入不会触发模型事件，分类文章数和文章评论数在内存中累计后批量更新，全文索引在forge命令最后重建
 """
 import random
-
+import time
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from multiprocessing import Pool
+
+import click
 from faker import Faker
-from sqlalchemy.exc import IntegrityError
 
 from bluelog import db
-from bluelog.models import Admin, Category, Post, Comment, Link
+from bluelog.content import render_post
+from bluelog.models import Admin, Category, Post, Comment, Link, path_segment
 
 fake = Faker()   # 实例化Faker()类
 
+CHUNK_SIZE = 1000
+SCALES = {  # --scale预设的(分类数, 文章数, 评论数)
+    'small': (10, 50, 500),
+    'medium': (20, 5000, 50000),
+    'large': (50, 100000, 1000000),
+}
+SEED_EPOCH = datetime(2020, 1, 1)   # 指定种子时时间戳以此为终点，保证不同日期生成的数据相同
+
+
+def resolve_counts(scale, category=None, post=None, comment=None):
+    """返回(分类数, 文章数, 评论数)，未指定的数量使用scale预设"""
+    return tuple(SCALES[scale][i] if count is None else count for i, count in enumerate((category, post, comment)))
+
+
+def progress_reporter(interval=1):
+    """返回report(done, total)函数，最多每interval秒输出一次进度和每秒插入行数"""
+    state = dict(start=time.perf_counter(), last=0)
+
+    def report(done, total):
+        now = time.perf_counter()
+        if now - state['last'] < interval and done < total:
+            return
+        state['last'] = now
+        click.echo('  %d/%d rows, %.0f rows/s' % (done, total, done / max(now - state['start'], 1e-6)))
+    return report
+
 
 def fake_admin():   # 虚拟管理员信息
     admin = Admin(
@@ -26,89 +64,145 @@ def fake_admin():   # 虚拟管理员信息
     db.session.commit()
 
 
-def fake_categories(count=10):  # 虚拟分类，默认10个分类
-    category = Category(name='Default')  # 添加一个名为Default的默认分类，为创建文章时默认的分类
-    db.session.add(category)
+@contextmanager
+def generator_map(workers=1):
+    """返回用于生成数据块的map函数，workers大于1时使用进程池并行生成(保持块的顺序)"""
+    if workers <= 1:
+        yield map
+        return
+    with Pool(workers) as pool:
+        yield lambda func, chunks: pool.imap(func, chunks)
+
+
+def _next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def _chunks(kind, total, seed, **params):
+    for number, start in enumerate(range(0, total, CHUNK_SIZE)):
+        yield dict(params, kind=kind, number=number, start=start, size=min(CHUNK_SIZE, total - start), seed=seed)
 
-    for i in range(count):  # 循环生成随机分类
-        category = Category(name=fake.word())
-        db.session.add(category)
-        try:    # 由于Category分类名不能重复，因此需要采用try-except捕获异常，db.session.rollback()回滚操作
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
 
+def _timestamp(rng, seed):
+    until = SEED_EPOCH if seed is not None else datetime.utcnow()
+    return until - timedelta(seconds=rng.randint(0, 365 * 24 * 60 * 60))
 
-def fake_posts(count=50):   # 虚拟文章
-    for i in range(count):
-        post = Post(
-            title=fake.sentence(),
-            body=fake.text(2000),
-            category=Category.query.get(random.randint(1, Category.query.count())),  # 随机分配到某个分类
-            timestamp=fake.date_time_this_year()
-        )
 
-        db.session.add(post)
+def _post_rows(chunk_fake, rng, chunk):
+    rows = []
+    for i in range(chunk['start'], chunk['start'] + chunk['size']):
+        body = chunk_fake.text(2000)
+        rows.append(dict(render_post(body), id=chunk['first_id'] + i, title=chunk_fake.sentence(), body=body,
+                         category_id=rng.randint(*chunk['category_ids']),  # 随机分配到某个分类
+                         timestamp=_timestamp(rng, chunk['seed'])))
+    return rows
+
+
+def _comment_rows(chunk_fake, rng, chunk):
+    rows = []
+    for i in range(chunk['start'], chunk['start'] + chunk['size']):
+        row = dict(id=chunk['first_id'] + i, author=chunk_fake.name(), email=chunk_fake.email(), site=chunk_fake.url(),
+                   body=chunk_fake.sentence(), timestamp=_timestamp(rng, chunk['seed']), reviewed=True,
+                   from_admin=False, post_id=rng.randint(*chunk['post_ids']), replied_id=None,   # 随机放入文章
+                   path=path_segment(chunk['first_id'] + i))
+        if chunk['variant'] == 'unreviewed':
+            row['reviewed'] = False
+        elif chunk['variant'] == 'admin':  # 管理员评论
+            row.update(author='Mima Kirigoe', email='mima@example.com', site='example.com', from_admin=True)
+        elif chunk['variant'] == 'reply':   # 回复，所属文章在主进程中改为被回复评论的文章
+            row['replied_id'] = rng.randint(*chunk['replied_ids'])
+            row['path'] = path_segment(row['replied_id']) + row['path']   # 被回复的都是顶层评论
+        rows.append(row)
+    return rows
+
+
+_GENERATORS = {'post': _post_rows, 'comment': _comment_rows}
+
+
+def generate_chunk(chunk):
+    """生成一块数据行，在worker进程中执行，因此只依赖chunk参数"""
+    chunk_fake, rng = Faker(), random.Random()
+    if chunk['seed'] is not None:
+        key = '%s-%s-%s-%s' % (chunk['seed'], chunk['kind'], chunk.get('variant'), chunk['number'])
+        chunk_fake.seed_instance(key)
+        rng.seed(key)
+    return _GENERATORS[chunk['kind']](chunk_fake, rng, chunk)
+
+
+def _insert(table, chunks, map_func, on_rows, report=None, done=0, total=0):
+    """插入生成的数据块，on_rows在插入前处理每块数据行，report接收(已插入行数, 总行数)"""
+    for rows in map_func(generate_chunk, chunks):
+        on_rows(rows)
+        db.session.execute(table.insert(), rows)
+        done += len(rows)
+        if report is not None:
+            report(done, total)
     db.session.commit()
 
 
-def fake_comments(count=500):   # 虚拟评论
-    for i in range(count):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,  # 虚拟评论，默认已审核
-            post=Post.query.get(random.randint(1, Post.query.count()))  # 随机放入文章
-        )
-        db.session.add(comment)
-
-    salt = int(count * 0.1)     # 生成未审核的评论
-    for i in range(salt):
-        # unreviewed comments
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=False,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-
-        # 管理员评论
-        comment = Comment(
-            author='Mima Kirigoe',
-            email='mima@example.com',
-            site='example.com',
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            from_admin=True,
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
+def _increment(column, counts):
+    if not counts:
+        return
+    table = column.table
+    db.session.execute(table.update().where(table.c.id == db.bindparam('_id'))
+                       .values({column.key: column + db.bindparam('_count')}),
+                       [dict(_id=key, _count=count) for key, count in counts.items()])
     db.session.commit()
 
-    # 生成回复
-    for i in range(salt):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            replied=Comment.query.get(random.randint(1, Comment.query.count())),
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
+
+def fake_categories(count=10, seed=None):  # 虚拟分类，默认10个分类
+    category_fake = Faker()
+    if seed is not None:
+        category_fake.seed_instance(seed)
+    first_id = _next_id(Category)
+    existing = set(name for name, in db.session.query(Category.name))
+    names = [] if 'Default' in existing else ['Default']    # 添加一个名为Default的默认分类，为创建文章时默认的分类
+    total = len(names) + count
+    while len(names) < total:
+        # 分类名不能重复，重复时加上序号，保证生成的分类数与count一致
+        name = category_fake.word()
+        if name in existing or name in names:
+            name = '%s %d' % (name, first_id + len(names))
+        names.append(name)
+    db.session.execute(Category.__table__.insert(),
+                       [dict(id=first_id + i, name=name, post_count=0) for i, name in enumerate(names)])
     db.session.commit()
 
 
+def fake_posts(count=50, seed=None, map_func=map, report=None):   # 虚拟文章
+    category_ids = db.session.query(db.func.min(Category.id), db.func.max(Category.id)).one()
+    post_counts = Counter()
+    _insert(Post.__table__, _chunks('post', count, seed, first_id=_next_id(Post), category_ids=category_ids),
+            map_func, lambda rows: post_counts.update(row['category_id'] for row in rows), report, total=count)
+    _increment(Category.__table__.c.post_count, post_counts)
+
+
+def _link_comments(first_id, comment_posts, comment_counts, rows):
+    for row in rows:
+        if row['replied_id'] is not None:
+            row['post_id'] = comment_posts[row['replied_id'] - first_id]
+        comment_posts.append(row['post_id'])
+        if row['reviewed']:
+            comment_counts[row['post_id']] += 1
+
+
+def fake_comments(count=500, seed=None, map_func=map, report=None):   # 虚拟评论
+    post_ids = db.session.query(db.func.min(Post.id), db.func.max(Post.id)).one()
+    first_id = _next_id(Comment)
+    salt = int(count * 0.1)     # 未审核评论、管理员评论和回复的数量
+    comment_posts = array('l')  # 本次生成的评论(按id顺序)所属的文章id，回复与被回复的评论属于同一篇文章
+    comment_counts = Counter()
+    on_rows = partial(_link_comments, first_id, comment_posts, comment_counts)
+
+    done, total = 0, count + salt * 3
+    for variant, variant_count in ('reviewed', count), ('unreviewed', salt), ('admin', salt), ('reply', salt):
+        chunks = _chunks('comment', variant_count, seed, first_id=first_id + done, post_ids=post_ids,
+                         variant=variant, replied_ids=(first_id, first_id + count + salt * 2 - 1))
+        _insert(Comment.__table__, chunks, map_func, on_rows, report, done, total)
+        done += variant_count
+    _increment(Post.__table__.c.comment_count, comment_counts)
+
+
 def fake_links():   # 设置链接
     twitter = Link(name='Twitter', url='#')
     facebook = Link(name='Facebook', url='#')
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+日志处理
+    请求线程中的日志调用只把记录放进内存队列(QueueHandler)，写文件和发邮件由QueueListener在后台线程中完成，
+    错误集中出现时不会拖慢请求
+    DigestMailHandler对相同的错误(按异常类型和调用栈计算指纹)在时间窗口内只立即发送第一封邮件，
+    其余的合并为一封摘要邮件在窗口结束时发送
+    CompressedRotatingFileHandler在后台线程中用gzip压缩轮转出来的日志文件
+"""
+import atexit
+import gzip
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import smtplib
+import threading
+import time
+import traceback
+from email.message import EmailMessage
+from email.utils import formatdate
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask import request, has_request_context
+
+
+def fingerprint(record):
+    """日志记录的指纹：有异常时由异常类型和调用栈位置决定，否则由记录位置和消息模板决定"""
+    if record.exc_info and record.exc_info[0] is not None:
+        frames = traceback.extract_tb(record.exc_info[2])
+        parts = [record.exc_info[0].__name__] + ['%s:%s' % (frame.filename, frame.lineno) for frame in frames]
+    else:
+        parts = [record.pathname, str(record.lineno), str(record.msg)]
+    return hashlib.sha1('\n'.join(parts).encode('utf-8', 'replace')).hexdigest()[:16]
+
+
+class RequestQueueHandler(QueueHandler):
+    """在请求线程中记下请求信息和指纹后放入队列；队列满时丢弃记录而不是阻塞请求"""
+
+    def __init__(self, log_queue):
+        super(RequestQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if has_request_context():
+            record.url = request.url
+            record.remote_addr = request.remote_addr
+        else:
+            record.url = record.remote_addr = '-'
+        record.fingerprint = fingerprint(record)
+        return super(RequestQueueHandler, self).prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DigestMailHandler(logging.Handler):
+    """相同指纹的错误在window秒内只立即发送一次，重复出现的次数在窗口结束时汇总为一封摘要邮件"""
+
+    def __init__(self, mailhost, port, fromaddr, toaddrs, subject, credentials=None, use_ssl=False,
+                 window=300, timeout=10):
+        super(DigestMailHandler, self).__init__()
+        self.mailhost, self.port = mailhost, port
+        self.fromaddr, self.toaddrs, self.subject = fromaddr, toaddrs, subject
+        self.credentials, self.use_ssl = credentials, use_ssl
+        self.window, self.timeout = window, timeout
+        self.windows = {}   # 指纹 -> {'expires': 窗口结束时间, 'count': 重复次数, 'record': 最近一条记录}
+        self.timer = None
+
+    def emit(self, record):
+        key = getattr(record, 'fingerprint', None) or fingerprint(record)
+        now = time.time()
+        entry = self.windows.get(key)
+        try:
+            if entry is not None and now < entry['expires']:
+                entry['count'] += 1
+                entry['record'] = record
+                self._schedule(entry['expires'] - now)
+                return
+            if entry is not None and entry['count']:
+                self._send_digest(entry)
+            self.windows[key] = dict(expires=now + self.window, count=0, record=record)
+            self.send(self.subject, self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def flush(self, force=False):
+        """发送已经结束的时间窗口的摘要邮件，force为真时发送全部"""
+        self.acquire()
+        try:
+            self.timer = None
+            now = time.time()
+            expired = [key for key, entry in self.windows.items() if force or now >= entry['expires']]
+            for entry in [self.windows.pop(key) for key in expired]:
+                if entry['count']:
+                    self._send_digest(entry)
+            pending = [entry['expires'] for entry in self.windows.values() if entry['count']]
+            if pending:
+                self._schedule(min(pending) - now)
+        finally:
+            self.release()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.flush(force=True)
+        super(DigestMailHandler, self).close()
+
+    def send(self, subject, body):
+        smtp_class = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        smtp = smtp_class(self.mailhost, self.port, timeout=self.timeout)
+        try:
+            if self.credentials:
+                smtp.login(*self.credentials)
+            message = EmailMessage()
+            message['From'] = self.fromaddr
+            message['To'] = ', '.join(self.toaddrs)
+            message['Subject'] = subject
+            message['Date'] = formatdate()
+            message.set_content(body)
+            smtp.send_message(message)
+        finally:
+            smtp.quit()
+
+    def _send_digest(self, entry):
+        try:
+            self.send('%s (%d more)' % (self.subject, entry['count']),
+                      'The following error occurred %d more times within %d seconds. Last occurrence:\n\n%s'
+                      % (entry['count'], self.window, self.format(entry['record'])))
+        except Exception:
+            self.handleError(entry['record'])
+
+    def _schedule(self, delay):
+        if self.timer is None:
+            self.timer = threading.Timer(max(delay, 0), self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """轮转时把旧日志文件改名后交给后台线程压缩为.gz，下一次轮转前等待上一次压缩完成"""
+
+    def __init__(self, *args, **kwargs):
+        super(CompressedRotatingFileHandler, self).__init__(*args, **kwargs)
+        self.compressor = None
+
+    def rotation_filename(self, default_name):
+        return default_name + '.gz'
+
+    def doRollover(self):
+        self.wait()
+        super(CompressedRotatingFileHandler, self).doRollover()
+
+    def rotate(self, source, dest):
+        if not os.path.exists(source):
+            return
+        pending = dest[:-len('.gz')]
+        os.replace(source, pending)
+        self.compressor = threading.Thread(target=self._compress, args=(pending, dest), daemon=True)
+        self.compressor.start()
+
+    def wait(self):
+        if self.compressor is not None:
+            self.compressor.join()
+            self.compressor = None
+
+    def close(self):
+        self.wait()
+        super(CompressedRotatingFileHandler, self).close()
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, 'rb') as f_in, gzip.open(dest + '.part', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.replace(dest + '.part', dest)
+        os.remove(source)
+
+
+def start_queue_logging(logger, handlers, maxsize=10000):
+    """为logger添加队列处理器，并启动在后台线程中调用handlers的QueueListener，返回listener"""
+    log_queue = queue.Queue(maxsize)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # 退出时处理完队列中剩余的记录
+    logger.addHandler(RequestQueueHandler(log_queue))
+    return listener
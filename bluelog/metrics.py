@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus指标
+    MetricsMiddleware包在app.wsgi_app外层，统计每个端点的请求数和请求耗时；SQLAlchemy引擎事件累计请求中的查询数和数据库耗时，
+    模板渲染信号累计模板渲染耗时，请求结束时一起记入指标
+    所有指标都保存为可以直接相加的计数(直方图的桶保存累计计数)，gunicorn多个worker进程各自把计数写入
+    BLUELOG_METRICS_DIR目录下以worker标识(进程号加随机串，进程号被重用时也不会覆盖)命名的文件，
+    /metrics读取全部文件相加后按Prometheus文本格式输出
+    抓取时已经退出的worker的计数合并到metrics-retired.json后删除其文件，计数器保持单调递增，文件数不随worker重启增长
+    (合并需要fcntl文件锁，没有fcntl的平台上文件保留)；fork出的子进程在fork时清空从父进程继承的计数
+    队列长度这类所有进程共享的状态由gauge()注册的函数在抓取时计算，不写入计数文件
+    /metrics需要登录或在Authorization头中提供BLUELOG_METRICS_TOKEN
+"""
+import glob
+import hmac
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import request, abort, current_app, has_request_context, before_render_template, template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+
+_ENVIRON_KEY = 'bluelog.metrics'
+_WORKER_FILE = re.compile(r'^metrics-(?P<pid>\d+)(-[0-9a-f]+)?\.json$')
+RETIRED_FILE = 'metrics-retired.json'
+
+# 指标名 -> (类型, 说明)
+FAMILIES = {
+    'bluelog_http_requests_total': ('counter', 'Total HTTP requests.'),
+    'bluelog_http_request_duration_seconds': ('histogram', 'HTTP request latency.'),
+    'bluelog_db_queries_total': ('counter', 'Total SQL statements executed while handling requests.'),
+    'bluelog_db_query_duration_seconds_total': ('counter', 'Total time spent in SQL statements.'),
+    'bluelog_template_render_duration_seconds': ('histogram', 'Template render time per request.'),
+    'bluelog_db_route_total': ('counter', 'Requests routed to the primary database or the read replica.'),
+    'bluelog_login_attempts_total': ('counter', 'Login attempts by result.'),
+    'bluelog_comment_spool_depth': ('gauge', 'Comments waiting in the spool files.'),
+    'bluelog_comment_spool_written_total': ('counter', 'Spooled comments written, skipped or set aside.'),
+    'bluelog_comment_spool_flush_duration_seconds': ('histogram', 'Time to write one batch of spooled comments.'),
+}
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                             for name, value in labels)
+
+
+def _worker_id():
+    return '%d-%s' % (os.getpid(), uuid.uuid4().hex[:12])
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:     # 其他用户的进程
+        return True
+    return True
+
+
+def _read_samples(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+class Metrics(object):
+
+    def __init__(self, app=None):
+        self.values = {}    # (样本名, ((标签名, 标签值), ...)) -> 计数
+        self.gauges = {}    # 指标名 -> 返回当前值的函数，抓取时调用，不写入计数文件
+        self.lock = threading.Lock()
+        self.directory = None
+        self.flush_interval = 1
+        self.worker_id = _worker_id()
+        self.flushed_at = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+        if app is not None:
+            self.init_app(app)
+
+    def _after_fork(self):
+        # fork出的worker不继承父进程的计数，使用自己的文件；父进程的线程可能正持有锁，换一把新锁
+        self.lock = threading.Lock()
+        self.values = {}
+        self.worker_id = _worker_id()
+        self.flushed_at = 0
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_METRICS', True)
+        app.config.setdefault('BLUELOG_METRICS_TOKEN', None)
+        app.config.setdefault('BLUELOG_METRICS_DIR', None)
+        app.config.setdefault('BLUELOG_METRICS_FLUSH_INTERVAL', 1)
+        app.extensions['metrics'] = self
+        self.values = {}
+        self.gauges = {}
+        if not app.config['BLUELOG_METRICS']:
+            return
+        self.directory = app.config['BLUELOG_METRICS_DIR']
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        self.flush_interval = app.config['BLUELOG_METRICS_FLUSH_INTERVAL']
+        app.wsgi_app = MetricsMiddleware(app.wsgi_app, self)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+        app.teardown_request(self._record_endpoint)
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def gauge(self, name, func):
+        """注册抓取时计算的指标，比如所有进程共享的队列长度"""
+        self.gauges[name] = func
+
+    def observe(self, name, labels, value):
+        """直方图：累计计数加到所有上界不小于value的桶上，其余的桶也要输出(计数为0)"""
+        labels = tuple(labels)
+        with self.lock:
+            for bound in BUCKETS:
+                key = (name + '_bucket', labels + (('le', _format_value(bound)),))
+                self.values[key] = self.values.get(key, 0) + (value <= bound)
+            for suffix, amount in (('_sum', value), ('_count', 1)):
+                key = (name + suffix, labels)
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def record_request(self, state, method, status, duration):
+        endpoint = (('endpoint', state['endpoint'] or 'none'),)
+        self.inc('bluelog_http_requests_total', endpoint + (('method', method), ('status', status)))
+        self.observe('bluelog_http_request_duration_seconds', endpoint, duration)
+        self.inc('bluelog_db_queries_total', endpoint, state['queries'])
+        self.inc('bluelog_db_query_duration_seconds_total', endpoint, state['db_time'])
+        if state['renders']:
+            self.observe('bluelog_template_render_duration_seconds', endpoint, state['render_time'])
+        self.flush()
+
+    def flush(self, force=False):
+        """把本进程的计数写入指标目录，最多每flush_interval秒写一次"""
+        if not self.directory:
+            return
+        now = time.time()
+        if not force and now - self.flushed_at < self.flush_interval:
+            return
+        self.flushed_at = now
+        with self.lock:
+            samples = [[name, labels, value] for (name, labels), value in self.values.items()]
+        self._write_samples('metrics-%s.json' % self.worker_id, samples)
+
+    def _write_samples(self, filename, samples):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(samples, f)
+        os.replace(temp_path, os.path.join(self.directory, filename))
+
+    def collect(self):
+        """返回所有进程相加后的计数和抓取时计算的指标"""
+        totals = self._collect_counts()
+        for name, func in self.gauges.items():
+            totals[(name, ())] = func()
+        return totals
+
+    def _collect_counts(self):
+        if not self.directory:
+            with self.lock:
+                return dict(self.values)
+        self.flush(force=True)
+        if fcntl is None:
+            return self._sum_files()
+        # 合并和读取期间持有目录的文件锁，同时抓取的进程不会重复合并，也不会读到合并了一半的文件
+        with open(os.path.join(self.directory, 'metrics.lock'), 'w') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            self._retire_dead_workers()
+            return self._sum_files()
+
+    def _sum_files(self, paths=None):
+        totals = {}
+        for path in paths or glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            for name, labels, value in _read_samples(path):
+                key = (name, tuple(tuple(label) for label in labels))
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def _retire_dead_workers(self):
+        # 调用时持有文件锁
+        dead = []
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            match = _WORKER_FILE.match(os.path.basename(path))
+            if match and not _alive(int(match.group('pid'))):
+                dead.append(path)
+        if not dead:
+            return
+        totals = self._sum_files([os.path.join(self.directory, RETIRED_FILE)] + dead)
+        self._write_samples(RETIRED_FILE, [[name, labels, value] for (name, labels), value in totals.items()])
+        for path in dead:
+            os.remove(path)
+
+    def render(self):
+        """Prometheus文本格式"""
+        samples = sorted(self.collect().items(), key=lambda item: (item[0][0], _sort_labels(item[0][1])))
+        lines = []
+        for family, (metric_type, description) in sorted(FAMILIES.items()):
+            family_samples = [(name, labels, value) for (name, labels), value in samples
+                              if name == family or (metric_type == 'histogram' and name.rsplit('_', 1)[0] == family)]
+            lines.append('# HELP %s %s' % (family, description))
+            lines.append('# TYPE %s %s' % (family, metric_type))
+            for name, labels, value in family_samples:
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _metrics_view(self):
+        token = current_app.config['BLUELOG_METRICS_TOKEN']
+        authorization = request.headers.get('Authorization', '')
+        if not current_user.is_authenticated and \
+                not (token and hmac.compare_digest(authorization.encode(), ('Bearer ' + token).encode())):
+            abort(403)
+        return current_app.response_class(self.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @staticmethod
+    def _record_endpoint(exc):
+        state = request.environ.get(_ENVIRON_KEY)
+        if state is not None:
+            state['endpoint'] = request.endpoint
+
+    @staticmethod
+    def _render_started(app, template, context, **extra):
+        state = request.environ.get(_ENVIRON_KEY) if has_request_context() else None
+        if state is not None:
+            state['render_starts'].append(time.perf_counter())
+
+    @staticmethod
+    def _render_finished(app, template, context, **extra):
+        state = request.environ.get(_ENVIRON_KEY) if has_request_context() else None
+        if state is not None and state['render_starts']:
+            state['render_time'] += time.perf_counter() - state['render_starts'].pop()
+            state['renders'] += 1
+
+
+def _sort_labels(labels):
+    # 直方图的桶按上界数值排序
+    return [(name, float(value.replace('+Inf', 'inf')) if name == 'le' else value) for name, value in labels]
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and _ENVIRON_KEY in request.environ:
+        conn.info['bluelog_metrics_start'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('bluelog_metrics_start', None)
+    if start is not None and has_request_context():
+        state = request.environ.get(_ENVIRON_KEY)
+        if state is not None:
+            state['queries'] += 1
+            state['db_time'] += time.perf_counter() - start
+
+
+class MetricsMiddleware(object):
+    """WSGI中间件，在请求结束时记录请求耗时和请求中累计的数据库、模板耗时"""
+
+    def __init__(self, wsgi_app, metrics):
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        state = environ[_ENVIRON_KEY] = dict(endpoint=None, queries=0, db_time=0.0, renders=0, render_time=0.0,
+                                             render_starts=[])
+        status = []
+
+        def _start_response(status_line, headers, exc_info=None):
+            status.append(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        start = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, _start_response)
+        finally:
+            self.metrics.record_request(state, environ.get('REQUEST_METHOD', 'GET'), status[-1] if status else '500',
+                                        time.perf_counter() - start)
@@ -5,12 +5,16 @@
 对于评论和回复，需要在Comment中添加外键指向自身，以此得到层级关系，每个评论对象包含多个子评论
 在reply和comment中由于在同一模型中，SQLAlchemy无法分辨关系两侧，所以需要通过remote_side参数定义关系哪一个是远程侧，哪一个为本地侧
 以此定义为多对一关系，即多回复对应一个评论
+评论另外保存物化路径path：从顶层评论到自身的每一级id按定长十六进制拼接(比如 00000001/0000002a/)，
+按path排序就是评论树的深度优先顺序，一条评论的整个子树是以它的path为前缀的一段连续范围
 """
 from datetime import datetime
 
 from flask_login import UserMixin
+from sqlalchemy import event
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from bluelog.content import render_post
 from bluelog.extensions import db
 
 
@@ -29,48 +33,116 @@ class Admin(db.Model, UserMixin):   # 创建管理员模型，存储管理员资
     def validate_password(self, password):  # 验证密码
         return check_password_hash(self.password_hash, password)
 
+    def cache_tags(self):   # 博客标题等信息出现在所有页面上，修改后页面缓存全部失效
+        return {'*'}
+
+
+class AdminIdentity(UserMixin):  # 已登录管理员的只读身份，由缓存的管理员快照构造，作为current_user使用
+    def __init__(self, admin):
+        self._admin = admin
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'password_hash':     # 不通过current_user暴露密码散列
+            raise AttributeError(name)
+        return getattr(self._admin, name)
+
 
 class Category(db.Model):   # 文章分类数据库模型
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), unique=True)    # 分类名不允许重复，参数unique=True
+    # 分类下的文章数，由Post的模型事件维护，避免为了计数加载整个posts集合
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     posts = db.relationship('Post', back_populates='category')  # 这里分类category与post是一对多关系,posts为集合关系属性
 
     def delete(self):   # 删除指定分类
-        default_category = Category.query.get(1)    # 获取默认分类记录，query.get()传入主键做参数，返回对应主键记录
-        posts = self.posts[:]   # [:]截取列表全部内容
-        for post in posts:
-            post.category = default_category    # 为该分类下文章记录重新指定到默认分类
+        # 一条UPDATE把该分类下的文章全部移到默认分类(id为1)，不把文章逐个加载到内存中；批量UPDATE不触发模型事件，直接调整计数
+        moved = Post.query.filter_by(category_id=self.id).update({'category_id': 1}, synchronize_session=False)
+        Category.query.filter_by(id=1).update({'post_count': Category.post_count + moved}, synchronize_session=False)
         db.session.delete(self)  # 删除分类记录
         db.session.commit()
 
+    def cache_tags(self):   # 分类列表显示在每个页面的边栏中
+        return {'*'}
+
 
 class Post(db.Model):   # 文章模型类
+    __table_args__ = (
+        db.Index('ix_post_category_id_timestamp', 'category_id', 'timestamp'),   # 分类页按分类筛选后按时间分页
+        # 管理评论页对评论计数求和，只读这个覆盖索引，不必读取每篇文章含正文的整行
+        db.Index('ix_post_comment_count', 'comment_count'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60))
     body = db.Column(db.Text)
+    # 以下字段在设置body时由render_post()一次性生成，模板直接读取，不必每次渲染时处理正文
+    body_html = db.Column(db.Text)  # 按白名单过滤后的HTML
+    body_text = db.Column(db.Text)  # 纯文本
+    excerpt = db.Column(db.String(300))     # 摘要
+    word_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    reading_time = db.Column(db.Integer, default=0, server_default='0', nullable=False)    # 阅读时间(分钟)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # 设置时间戳，index=True建立索引
     can_comment = db.Column(db.Boolean, default=True)   # 用于评论开关功能，存储是否评论的布尔值
+    # 已审核的评论数，由Comment的模型事件维护
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))   # 将category.id设置为外键，与分类建立关系
+    # 将category.id设置为外键，与分类建立关系；active_history保证修改时能取到旧值，用于维护计数
+    category_id = db.column_property(db.Column(db.Integer, db.ForeignKey('category.id')), active_history=True)
     category = db.relationship('Category', back_populates='posts')      # 标量关系属性category
 
     # comments集合关系属性, cascade设置级联操作，即文章删除，评论随之删除
     comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan')
 
+    def cache_tags(self):   # 受影响的页面：文章页、首页以及修改前后所属的分类页
+        category_ids = db.inspect(self).attrs.category_id.history.sum()
+        tags = {'post:%s' % self.id, 'index'}
+        tags.update('category:%s' % category_id for category_id in category_ids if category_id)
+        return tags
+
+
+@event.listens_for(Post.body, 'set')
+def _render_body(target, value, oldvalue, initiator):
+    for key, field in render_post(value).items():
+        setattr(target, key, field)
+
+
+PATH_SEGMENT = '%08x/'    # 路径中每一级的格式，定长保证按字符串排序与按id排序一致
+
+
+def path_segment(comment_id):
+    return PATH_SEGMENT % comment_id
+
+
+def subtree_upper_bound(path):
+    """以path为前缀的所有路径都小于返回值('~'大于路径中使用的十六进制字符和'/')"""
+    return path + '~'
+
 
 class Comment(db.Model):    # 评论模型类
+    # 文章页的已审核评论、未读评论数和管理后台的筛选都是先按条件筛选再按时间分页
+    __table_args__ = (
+        db.Index('ix_comment_post_id_reviewed_timestamp', 'post_id', 'reviewed', 'timestamp'),
+        db.Index('ix_comment_reviewed_timestamp', 'reviewed', 'timestamp'),
+        db.Index('ix_comment_from_admin_timestamp', 'from_admin', 'timestamp'),
+        db.Index('ix_comment_replied_id_reviewed', 'replied_id', 'reviewed'),  # 评论树逐层查找回复，删除时级联查找回复
+        db.Index('ix_comment_post_id_path', 'post_id', 'path'),     # 文章页按路径范围取出整棵评论树，按前缀删除子树
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     author = db.Column(db.String(30))
     email = db.Column(db.String(254))
     site = db.Column(db.String(255))
     body = db.Column(db.Text)
     from_admin = db.Column(db.Boolean, default=False)   # 判断是否为管理员评论，管理员评论无需审核
-    reviewed = db.Column(db.Boolean, default=False)     # 存储评论是否通过审核
+    reviewed = db.column_property(db.Column(db.Boolean, default=False), active_history=True)     # 存储评论是否通过审核
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'))  # 将comment.id设置为外键与Comment本身建立关系,得到层级关系
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'))   # 将post.id设置为外键与Post建立关系
+    # 物化路径，插入后由模型事件根据id和上级评论的路径生成；使用Text，回复的层级不受长度限制
+    path = db.Column(db.Text)
+    # 将post.id设置为外键与Post建立关系
+    post_id = db.column_property(db.Column(db.Integer, db.ForeignKey('post.id')), active_history=True)
 
     post = db.relationship('Post', back_populates='comments')   # back_populates定义反向引用
     replies = db.relationship('Comment', back_populates='replied', cascade='all, delete-orphan')    # 回复设置级联操作
@@ -79,8 +151,173 @@ class Comment(db.Model):    # 评论模型类
     # replies = db.relationship('Comment', backref=db.backref('replied', remote_side=[id])
     # cascade='all,delete-orphan')
 
+    def cache_tags(self):   # 未审核的评论不会出现在访客看到的页面上；已审核的评论影响文章页及列表中的评论数
+        attrs = db.inspect(self).attrs
+        if not any(attrs.reviewed.history.sum()):
+            return set()
+        tags = {'index'} | {'post:%s' % post_id for post_id in attrs.post_id.history.sum() if post_id}
+        if self.post is not None:
+            tags.add('category:%s' % self.post.category_id)
+        return tags
+
 
 class Link(db.Model):   # 其他网站链接类模型
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30))
     url = db.Column(db.String(255))
+
+    def cache_tags(self):   # 链接列表显示在每个页面的边栏中
+        return {'*'}
+
+
+class QueuedMail(db.Model):   # 待发送的邮件，由flask mail-worker进程分批发送，发送成功后删除
+    __table_args__ = (db.Index('ix_queued_mail_status_next_attempt', 'status', 'next_attempt'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255))
+    recipient = db.Column(db.String(254))
+    html = db.Column(db.Text)
+    status = db.Column(db.String(10), default='pending', nullable=False)   # pending:等待发送, failed:多次重试后放弃
+    attempts = db.Column(db.Integer, default=0, nullable=False)    # 已失败的次数
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)     # 下次可以发送的时间
+    claim = db.Column(db.String(32))    # 领取该邮件的worker标记，防止多个worker重复发送
+    last_error = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Notification(db.Model):  # 等待合并成摘要邮件的提醒，由flask mail-worker按收件人合并后写入邮件队列
+    __table_args__ = (db.Index('ix_notification_recipient_timestamp', 'recipient', 'timestamp'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(254), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)     # comment:新评论(提醒管理员审核), reply:新回复
+    post_id = db.Column(db.Integer)
+    post_title = db.Column(db.String(60))   # 发送时文章可能已经删除，保存提醒时的标题和链接
+    url = db.Column(db.String(255))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+# 计数字段和评论路径维护
+# 在flush过程中通过模型事件直接对数据库执行 count = count + delta，多个进程并发写入时不会互相覆盖
+# 内存中已加载的分类/文章对象的计数会在flush结束后过期，下次访问时重新读取
+def _old_and_new(target, key):
+    """返回属性在本次flush中的旧值和新值"""
+    history = db.inspect(target).attrs[key].history
+    unchanged = history.unchanged[0] if history.unchanged else None
+    old = history.deleted[0] if history.deleted else unchanged
+    new = history.added[0] if history.added else unchanged
+    return old, new
+
+
+def _adjust_count(connection, target, model, counter, parent_id, delta):
+    if parent_id is None or not delta:
+        return
+    table = model.__table__
+    connection.execute(table.update().where(table.c.id == parent_id)
+                       .values({counter: table.c[counter] + delta}))
+    _expire_after_flush(target, model, parent_id, counter)
+
+
+def _expire_after_flush(target, model, instance_id, key):
+    # 在flush过程中直接写入数据库的字段，flush结束后让内存中的对象过期
+    session = db.object_session(target)
+    if session is not None:
+        session.info.setdefault('bluelog_stale_attributes', set()).add((model, instance_id, key))
+
+
+def _comment_counted_post(target, index):
+    # 只有已审核的评论计入文章评论数，index为0取旧值，为1取新值
+    reviewed = _old_and_new(target, 'reviewed')[index]
+    return _old_and_new(target, 'post_id')[index] if reviewed else None
+
+
+@event.listens_for(Post, 'after_insert')
+def _count_inserted_post(mapper, connection, target):
+    _adjust_count(connection, target, Category, 'post_count', target.category_id, 1)
+
+
+@event.listens_for(Post, 'after_update')
+def _count_updated_post(mapper, connection, target):
+    old, new = _old_and_new(target, 'category_id')
+    if old != new:
+        _adjust_count(connection, target, Category, 'post_count', old, -1)
+        _adjust_count(connection, target, Category, 'post_count', new, 1)
+
+
+@event.listens_for(Post, 'after_delete')
+def _count_deleted_post(mapper, connection, target):
+    _adjust_count(connection, target, Category, 'post_count', _old_and_new(target, 'category_id')[0], -1)
+
+
+@event.listens_for(Comment, 'after_insert')
+def _count_inserted_comment(mapper, connection, target):
+    _adjust_count(connection, target, Post, 'comment_count', _comment_counted_post(target, 1), 1)
+
+
+@event.listens_for(Comment, 'after_update')
+def _count_updated_comment(mapper, connection, target):
+    old, new = _comment_counted_post(target, 0), _comment_counted_post(target, 1)
+    if old != new:
+        _adjust_count(connection, target, Post, 'comment_count', old, -1)
+        _adjust_count(connection, target, Post, 'comment_count', new, 1)
+
+
+@event.listens_for(Comment, 'after_delete')
+def _count_deleted_comment(mapper, connection, target):
+    _adjust_count(connection, target, Post, 'comment_count', _comment_counted_post(target, 0), -1)
+
+
+@event.listens_for(Comment, 'after_insert')
+def _set_comment_path(mapper, connection, target):
+    # 插入之后才知道id；上级评论的路径在同一条UPDATE中用子查询读取，不必加载上级评论
+    comment = Comment.__table__
+    parent = db.select([comment.c.path]).where(comment.c.id == target.replied_id).as_scalar()
+    connection.execute(comment.update().where(comment.c.id == target.id)
+                       .values(path=db.func.coalesce(parent, '') + path_segment(target.id)))
+    _expire_after_flush(target, Comment, target.id, 'path')
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _expire_stale_attributes(session, flush_context):
+    for model, instance_id, key in session.info.pop('bluelog_stale_attributes', ()):
+        instance = session.identity_map.get(db.inspect(model).identity_key_from_primary_key((instance_id,)))
+        if instance is not None:
+            session.expire(instance, [key])
+
+
+def recount():
+    """按实际数据重新计算所有计数字段，用于修复或初始化"""
+    category, post, comment = Category.__table__, Post.__table__, Comment.__table__
+    post_count = db.select([db.func.count(post.c.id)]).where(post.c.category_id == category.c.id).as_scalar()
+    comment_count = db.select([db.func.count(comment.c.id)]) \
+        .where(db.and_(comment.c.post_id == post.c.id, comment.c.reviewed == db.true())).as_scalar()
+    db.session.execute(category.update().values(post_count=post_count))
+    db.session.execute(post.update().values(comment_count=comment_count))
+    db.session.commit()
+
+
+def rerender_posts(batch_size=100):
+    """按id分批重新生成所有文章的正文派生字段，返回处理的文章数"""
+    last_id, total = 0, 0
+    while True:
+        rows = db.session.query(Post.id, Post.body).filter(Post.id > last_id) \
+            .order_by(Post.id).limit(batch_size).all()
+        if not rows:
+            return total
+        # bulk_update_mappings直接生成UPDATE语句，不加载完整的文章对象
+        db.session.bulk_update_mappings(Post, [dict(render_post(body), id=post_id) for post_id, body in rows])
+        db.session.commit()
+        last_id, total = rows[-1].id, total + len(rows)
+
+
+def iter_post_bodies(batch_size=500):
+    """按id分批读取所有文章的正文，每次只在内存中保留一批"""
+    last_id = 0
+    while True:
+        rows = db.session.query(Post.id, Post.body).filter(Post.id > last_id) \
+            .order_by(Post.id).limit(batch_size).all()
+        if not rows:
+            return
+        for row in rows:
+            yield row.body
+        last_id = rows[-1].id
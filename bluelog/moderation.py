@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+批量审核与删除
+    逐条处理时每条评论都要加载ORM对象、触发模型事件维护计数和搜索索引，清理几千条垃圾评论就是几千次往返
+    这里每个操作都是固定几条基于集合的UPDATE/DELETE语句，选择条件以子查询的形式放在语句中，不把id读回Python：
+    先按同一个选择条件调整计数字段和搜索索引，最后再修改评论或文章本身，全部在一个事务中完成
+    删除评论时按物化路径前缀找出所有下级回复一起删除，与Comment.replies的级联删除一致；
+    没有路径的评论(绕过模型事件插入的数据)按replied_id逐层查找回复
+    修改通过query.update()/query.delete()执行，提交后页面缓存和模板上下文缓存全部失效
+"""
+from bluelog.extensions import db
+from bluelog.models import Post, Comment, Category, subtree_upper_bound
+from bluelog.search import search_index, fts_enabled
+
+
+def comment_selection(ids=None, unread_before=None):
+    """选中评论的id子查询：ids中的评论，或者unread_before之前提交的未读评论"""
+    comment = Comment.__table__
+    if ids is not None:
+        condition = comment.c.id.in_(ids)
+    else:
+        condition = db.and_(comment.c.reviewed == db.false(), comment.c.timestamp < unread_before)
+    return db.select([comment.c.id]).where(condition)
+
+
+def _adjust_comment_counts(condition, sign):
+    # 满足条件的评论按文章汇总，一条UPDATE调整所有相关文章的评论数
+    post, comment = Post.__table__, Comment.__table__
+    count = db.select([db.func.count()]).where(db.and_(condition, comment.c.post_id == post.c.id)).as_scalar()
+    db.session.execute(post.update().where(post.c.id.in_(db.select([comment.c.post_id]).where(condition)))
+                       .values(comment_count=post.c.comment_count + sign * count))
+
+
+def _unindex(rowids):
+    connection = db.session.connection()
+    if fts_enabled(connection):
+        connection.execute(search_index.delete().where(search_index.c.rowid.in_(rowids)))
+    return connection
+
+
+def approve_comments(selection):
+    """审核选中的未读评论，返回审核的评论数"""
+    comment = Comment.__table__
+    # 计数和索引都要在修改reviewed之前按未读状态选出同一批评论
+    unread = comment.c.id.in_(
+        db.select([comment.c.id]).where(db.and_(comment.c.id.in_(selection), comment.c.reviewed == db.false())))
+    _adjust_comment_counts(unread, 1)
+    connection = _unindex(db.select([comment.c.id * 2 + 1]).where(unread))
+    if fts_enabled(connection):
+        connection.execute(search_index.insert().from_select(
+            ['rowid', 'title', 'body', 'post_id'],
+            db.select([comment.c.id * 2 + 1, db.literal(''), db.func.coalesce(comment.c.body, ''), comment.c.post_id])
+            .where(unread)))
+    approved = Comment.query.filter(unread).update({'reviewed': True}, synchronize_session=False)
+    db.session.commit()
+    return approved
+
+
+def _unpathed_subtrees(selection):
+    # 选中的评论中没有路径的，按replied_id逐层找出它们和所有下级回复的id
+    comment = Comment.__table__
+    level = [id for id, in db.session.execute(
+        db.select([comment.c.id]).where(db.and_(comment.c.id.in_(selection), comment.c.path.is_(None))))]
+    found = []
+    while level:
+        found.extend(level)
+        level = [id for id, in db.session.execute(db.select([comment.c.id]).where(comment.c.replied_id.in_(level)))]
+    return found
+
+
+def with_replies(selection):
+    """选中的评论及其所有下级回复的id子查询：每条评论的子树是(post_id, path)索引上以它的路径为前缀的一段范围"""
+    comment = Comment.__table__
+    selected = comment.alias('selected')
+    subtrees = db.select([comment.c.id]).where(db.and_(
+        selected.c.id.in_(selection), comment.c.post_id == selected.c.post_id,
+        comment.c.path >= selected.c.path, comment.c.path < subtree_upper_bound(selected.c.path))) \
+        .correlate(None)    # 外层语句也是comment表，不能自动关联，否则成为逐行执行的关联子查询
+    unpathed = _unpathed_subtrees(selection)
+    if not unpathed:
+        return subtrees
+    return db.union(subtrees, db.select([comment.c.id]).where(comment.c.id.in_(unpathed)))
+
+
+def delete_comments(selection):
+    """删除选中的评论及其所有回复，返回删除的评论数"""
+    comment = Comment.__table__
+    doomed = comment.c.id.in_(with_replies(selection))
+    _adjust_comment_counts(db.and_(doomed, comment.c.reviewed == db.true()), -1)
+    _unindex(db.select([comment.c.id * 2 + 1]).where(doomed))
+    deleted = Comment.query.filter(doomed).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def delete_posts(ids):
+    """删除ids中的文章及其全部评论，返回删除的文章数"""
+    post, comment, category = Post.__table__, Comment.__table__, Category.__table__
+    selected = post.c.id.in_(ids)
+    count = db.select([db.func.count()]).where(db.and_(selected, post.c.category_id == category.c.id)).as_scalar()
+    db.session.execute(category.update().where(category.c.id.in_(db.select([post.c.category_id]).where(selected)))
+                       .values(post_count=category.c.post_count - count))
+    _unindex(db.union(db.select([post.c.id * 2]).where(selected),
+                      db.select([comment.c.id * 2 + 1]).where(comment.c.post_id.in_(ids))))
+    Comment.query.filter(Comment.post_id.in_(ids)).delete(synchronize_session=False)
+    deleted = Post.query.filter(selected).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
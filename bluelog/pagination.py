@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+键集(游标)分页
+    paginate()使用 OFFSET 跳过前面的记录，并额外执行一次 COUNT(*) 统计总数，页数越靠后越慢
+    KeysetPagination按排序字段(比如(timestamp, id))定位：WHERE (timestamp, id) < (上一页最后一条) LIMIT n，
+    可以直接利用索引，翻到多深都是同样的代价，也不需要统计总数
+    前几页仍然使用页码URL(?page=2)，超过BLUELOG_KEYSET_OFFSET_PAGES的页面通过不透明的after/before游标翻页
+"""
+import base64
+import json
+from datetime import datetime
+
+from flask import request, current_app, url_for, abort
+from sqlalchemy import and_, or_, DateTime
+
+CURSOR_PARAMS = ('page', 'after', 'before')
+
+
+def encode_cursor(values):
+    data = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+        if len(values) != len(columns):
+            raise ValueError(cursor)
+        return [datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value
+                for column, value in zip(columns, values)]
+    except (ValueError, TypeError):
+        abort(404)
+
+
+class KeysetPagination(object):
+    """与Flask-SQLAlchemy的Pagination对象接口兼容(page, has_prev, has_next, iter_pages()等)，但没有total和pages"""
+
+    keyset = True
+
+    def __init__(self, query, columns, page=1, per_page=20, after=None, before=None,
+                 descending=True, offset_pages=5):
+        self.columns = columns
+        self.page = page
+        self.per_page = per_page
+        self.descending = descending
+        self.offset_pages = offset_pages
+        self.total = None
+
+        if after is not None:
+            items = self._seek(query, decode_cursor(after, columns), forward=True).all()
+            self.has_prev, self.has_next = True, len(items) > per_page
+            self.items = items[:per_page]
+        elif before is not None:
+            # 向前翻页时反向排序取数据，再倒转回正常顺序
+            items = self._seek(query, decode_cursor(before, columns), forward=False).all()
+            self.has_prev, self.has_next = len(items) > per_page, True
+            self.items = items[:per_page][::-1]
+        else:
+            # 页码模式，多取一条记录判断是否还有下一页，省去COUNT(*)
+            items = query.order_by(*self._ordering(forward=True)) \
+                .offset((page - 1) * per_page).limit(per_page + 1).all()
+            self.has_prev, self.has_next = page > 1, len(items) > per_page
+            self.items = items[:per_page]
+        if not self.items and page != 1:
+            abort(404)
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    def prev_url(self, fragment=''):
+        args = {'page': self.prev_num}
+        if self.prev_num > self.offset_pages:
+            args['before'] = encode_cursor(self._key(self.items[0]))
+        return self._url(args, fragment)
+
+    def next_url(self, fragment=''):
+        args = {'page': self.next_num}
+        if self.next_num > self.offset_pages:
+            args['after'] = encode_cursor(self._key(self.items[-1]))
+        return self._url(args, fragment)
+
+    def page_url(self, page, fragment=''):
+        return self._url({'page': page}, fragment)
+
+    def iter_pages(self, *args, **kwargs):
+        """只列出可以直接用页码访问的前几页和当前页，更深的页面通过上一页/下一页的游标到达"""
+        last = min(self.offset_pages, self.next_num or self.page)
+        for num in range(1, last + 1):
+            yield num
+        if self.page > last:
+            if self.page > last + 1:
+                yield None
+            yield self.page
+
+    def _ordering(self, forward):
+        descending = self.descending == forward
+        return [column.desc() if descending else column.asc() for column in self.columns]
+
+    def _seek(self, query, values, forward):
+        # 展开为 a <= x AND ((a < x) OR (a = x AND b < y))，各个数据库都支持
+        # 单独的OR条件在SQLite中无法作为索引的范围条件，额外的 a <= x 让查询从游标位置开始按索引读取
+        less = self.descending == forward
+        clauses = []
+        for i, column in enumerate(self.columns):
+            equal = [prefix == value for prefix, value in zip(self.columns[:i], values[:i])]
+            clauses.append(and_(*(equal + [column < values[i] if less else column > values[i]])))
+        bound = self.columns[0] <= values[0] if less else self.columns[0] >= values[0]
+        return query.filter(bound, or_(*clauses)).order_by(*self._ordering(forward)).limit(self.per_page + 1)
+
+    def _key(self, item):
+        return [getattr(item, column.key) for column in self.columns]
+
+    @staticmethod
+    def _url(args, fragment):
+        url_args = dict(request.view_args)
+        url_args.update((key, value) for key, value in request.args.items() if key not in CURSOR_PARAMS)
+        url_args.update(args)
+        if fragment and not fragment.startswith('#'):
+            fragment = '#' + fragment
+        return url_for(request.endpoint, **url_args) + fragment
+
+
+def keyset_paginate(query, *columns, **kwargs):
+    """从查询字符串读取page/after/before参数，返回KeysetPagination对象"""
+    kwargs.setdefault('offset_pages', current_app.config['BLUELOG_KEYSET_OFFSET_PAGES'])
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(404)
+    return KeysetPagination(query, columns, page=page,
+                            after=request.args.get('after'), before=request.args.get('before'), **kwargs)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+请求的查询预算
+    页面变慢往往不是因为某一条查询很慢，而是模板中逐条访问关系属性触发了大量相同的快速查询(N+1查询)
+    QueryBudget统计每个请求发出的SQL语句：总数超过视图的预算，或同一形状的语句(参数用占位符表示，
+    IN列表折叠为一个占位符)重复次数超过BLUELOG_QUERY_REPEAT_LIMIT时视为违规
+    违规在生产环境中记录警告日志，在测试配置中抛出QueryBudgetExceeded，让测试用例直接失败
+    预算优先使用BLUELOG_QUERY_BUDGETS中按端点名配置的值，其次是视图上的 @query_budget.limit(n)，
+    最后是BLUELOG_QUERY_BUDGET_DEFAULT
+慢查询采样
+    SlowQuerySampler按BLUELOG_SLOW_QUERY_SAMPLE_RATE的比例为语句计时，未被抽中的语句只多一次随机数判断；
+    超过BLUELOG_SLOW_QUERY_THRESHOLD秒的语句连同参数、端点和EXPLAIN QUERY PLAN的输出保存在定长的环形缓冲区中，
+    管理后台按语句形状汇总，列出总耗时最多的语句
+"""
+import random
+import re
+import time
+from collections import Counter, deque, namedtuple
+from datetime import datetime
+
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+_IN_LIST_RE = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)' % (_PLACEHOLDER, _PLACEHOLDER))
+
+
+class QueryBudgetExceeded(Exception):
+    """请求的查询数超出预算或出现重复查询"""
+
+
+def statement_shape(statement):
+    """语句的形状：折叠IN列表和空白，参数个数不同的同一查询视为相同"""
+    return ' '.join(_IN_LIST_RE.sub('(?)', statement).split())
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        statements = g.get('query_budget_statements')
+        if statements is not None:
+            statements.append(statement)
+
+
+class QueryBudget(object):
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_QUERY_BUDGETS', {})
+        app.config.setdefault('BLUELOG_QUERY_BUDGET_DEFAULT', None)
+        app.config.setdefault('BLUELOG_QUERY_REPEAT_LIMIT', 5)
+        app.config.setdefault('BLUELOG_QUERY_BUDGET_RAISE', False)
+        app.before_request(self._start)
+        app.after_request(self._check)
+        app.teardown_request(self._stop)
+        app.extensions['query_budget'] = self
+
+    @staticmethod
+    def limit(max_queries):
+        """视图装饰器，设置视图每个请求最多发出的查询数"""
+        def decorator(view):
+            view.query_budget = max_queries
+            return view
+        return decorator
+
+    @staticmethod
+    def budget(endpoint):
+        """端点的查询预算，没有设置时返回None"""
+        budgets = current_app.config['BLUELOG_QUERY_BUDGETS']
+        if endpoint in budgets:
+            return budgets[endpoint]
+        view = current_app.view_functions.get(endpoint)
+        return getattr(view, 'query_budget', current_app.config['BLUELOG_QUERY_BUDGET_DEFAULT'])
+
+    @staticmethod
+    def violations(endpoint, statements):
+        """返回违规说明列表"""
+        messages = []
+        budget = QueryBudget.budget(endpoint)
+        if budget is not None and len(statements) > budget:
+            messages.append('%s issued %d queries, budget is %d' % (endpoint, len(statements), budget))
+        repeat_limit = current_app.config['BLUELOG_QUERY_REPEAT_LIMIT']
+        for shape, count in Counter(statement_shape(statement) for statement in statements).most_common():
+            if count <= repeat_limit:
+                break
+            messages.append('%s repeated a query %d times (possible N+1): %s' % (endpoint, count, shape))
+        return messages
+
+    @staticmethod
+    def _start():
+        g.query_budget_statements = []
+
+    @staticmethod
+    def _check(response):
+        statements = g.pop('query_budget_statements', None)
+        if statements is None:
+            return response
+        messages = QueryBudget.violations(request.endpoint, statements)
+        if messages and current_app.config['BLUELOG_QUERY_BUDGET_RAISE']:
+            raise QueryBudgetExceeded('\n'.join(messages))
+        for message in messages:
+            current_app.logger.warning('Query budget exceeded: %s' % message)
+        return response
+
+    @staticmethod
+    def _stop(exc):
+        g.pop('query_budget_statements', None)
+
+
+SlowQuery = namedtuple('SlowQuery', 'statement parameters duration endpoint plan timestamp')
+SlowQueryStats = namedtuple('SlowQueryStats', 'shape count total max endpoints last')
+
+
+def explain(dbapi_connection, statement, parameters):
+    """返回SQLite的EXPLAIN QUERY PLAN输出，每个步骤一行并按层级缩进；其他数据库或非查询语句返回None"""
+    if not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    depths = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depths[node_id] = depths.get(parent, -1) + 1
+        lines.append('  ' * depths[node_id] + detail)
+    return '\n'.join(lines)
+
+
+class SlowQuerySampler(object):
+
+    def __init__(self, app=None):
+        self.sample_rate = 0
+        self.threshold = None
+        self.queries = deque()
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_SLOW_QUERY_THRESHOLD', 1)
+        app.config.setdefault('BLUELOG_SLOW_QUERY_SAMPLE_RATE', 0.1)
+        app.config.setdefault('BLUELOG_SLOW_QUERY_BUFFER', 200)
+        self.sample_rate = app.config['BLUELOG_SLOW_QUERY_SAMPLE_RATE']
+        self.threshold = app.config['BLUELOG_SLOW_QUERY_THRESHOLD']
+        self.queries = deque(maxlen=app.config['BLUELOG_SLOW_QUERY_BUFFER'])
+        app.extensions['query_sampler'] = self
+
+    def top(self, limit=20):
+        """按语句形状汇总缓冲区中的慢查询，按总耗时倒序返回SlowQueryStats列表"""
+        groups = {}
+        for query in list(self.queries):
+            groups.setdefault(statement_shape(query.statement), []).append(query)
+        stats = []
+        for shape, queries in groups.items():
+            durations = [query.duration for query in queries]
+            endpoints = sorted(set(query.endpoint for query in queries))
+            stats.append(SlowQueryStats(shape, len(queries), sum(durations), max(durations), endpoints, queries[-1]))
+        return sorted(stats, key=lambda item: item.total, reverse=True)[:limit]
+
+    def clear(self):
+        self.queries.clear()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # 未被抽中的语句也要覆盖上一条语句的开始时间(执行出错时不会调用_after_execute)
+        sampled = self.sample_rate and random.random() < self.sample_rate
+        conn.info['bluelog_query_start'] = time.perf_counter() if sampled else None
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('bluelog_query_start', None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        if duration < self.threshold:
+            return
+        plan = None
+        if not executemany and conn.dialect.name == 'sqlite':
+            try:
+                plan = explain(conn.connection, statement, parameters)
+            except conn.dialect.dbapi.Error as e:
+                plan = 'EXPLAIN failed: %s' % e
+        endpoint = request.endpoint if has_request_context() else None
+        self.queries.append(SlowQuery(statement, parameters, duration, endpoint or '-', plan, datetime.utcnow()))
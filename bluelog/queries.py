@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+列表页使用的只读查询
+    文章列表只需要标题、摘要、时间和分类名，加载完整的Post对象会同时读取很大的body字段，
+    并为每一行创建ORM对象、登记到identity map中
+    这里只查询需要的字段，在同一条语句中连接分类表取得分类名，返回不可变的轻量行对象(可按属性名访问)，
+    模板中的post.title、post.category_name等写法不变，也可以直接交给keyset_paginate()分页
+    文章页的评论树按物化路径(Comment.path)的范围一次取出，已经是显示顺序，避免逐层访问replies关系属性；
+    绕过模型事件插入、没有路径的评论按replied_id逐层查找
+"""
+from collections import defaultdict
+
+from bluelog.extensions import db
+from bluelog.models import Post, Category, Comment, subtree_upper_bound
+
+
+def post_listing():
+    """首页和分类页的文章列表"""
+    return db.session.query(
+        Post.id, Post.title, Post.excerpt, Post.timestamp, Post.comment_count,
+        Post.category_id, Category.name.label('category_name'),
+    ).outerjoin(Category, Post.category_id == Category.id)
+
+
+def manage_post_listing():
+    """管理文章页面的文章列表"""
+    return db.session.query(
+        Post.id, Post.title, Post.timestamp, Post.comment_count, Post.word_count, Post.can_comment,
+        Post.category_id, Category.name.label('category_name'),
+    ).outerjoin(Category, Post.category_id == Category.id)
+
+
+def comment_threads(roots):
+    """
+    一页顶层评论连同其下所有已审核的回复，按树形(深度优先、同层按发表顺序)排列
+    一页顶层评论的子树在路径上是一段连续范围，按(post_id, path)索引一次范围扫描取出，不需要排序
+    返回(评论列表, {评论id: 层级})；回复的上级评论都在同一个会话中，访问comment.replied不会再发出查询
+    """
+    if not roots:
+        return [], {}
+    paths = [root.path for root in roots]
+    if None in paths:
+        return _walk_threads(roots)
+    rows = Comment.query.filter(Comment.post_id == roots[0].post_id, Comment.path >= min(paths),
+                                Comment.path < subtree_upper_bound(max(paths)), Comment.reviewed == db.true()) \
+        .order_by(Comment.path).all()
+
+    # 范围内可能有不在本页的顶层评论(时间顺序与id顺序不一致时)，上级评论未审核的回复也不显示：
+    # 按路径顺序，只保留上级评论已经保留的回复；各个子树再按本页顶层评论的顺序排列
+    threads = dict((root.id, []) for root in roots)
+    depths, thread_of = {}, {}
+    for comment in rows:
+        if comment.id in threads:
+            depths[comment.id], thread_of[comment.id] = 0, comment.id
+        elif comment.replied_id in depths:
+            depths[comment.id] = depths[comment.replied_id] + 1
+            thread_of[comment.id] = thread_of[comment.replied_id]
+        else:
+            continue
+        threads[thread_of[comment.id]].append(comment)
+    return [comment for root in roots for comment in threads[root.id]], depths
+
+
+def _walk_threads(roots):
+    # 没有物化路径时按replied_id逐层查询已审核的回复，每层一条查询，再按深度优先排列
+    replies = defaultdict(list)
+    level = [root.id for root in roots]
+    while level:
+        rows = Comment.query.filter(Comment.replied_id.in_(level), Comment.reviewed == db.true()) \
+            .order_by(Comment.timestamp, Comment.id).all()
+        for comment in rows:
+            replies[comment.replied_id].append(comment)
+        level = [comment.id for comment in rows]
+
+    ordered, depths = [], {}
+    stack = [(root, 0) for root in reversed(roots)]
+    while stack:
+        comment, depth = stack.pop()
+        ordered.append(comment)
+        depths[comment.id] = depth
+        stack.extend((reply, depth + 1) for reply in reversed(replies[comment.id]))
+    return ordered, depths
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+读写分离
+    SQLALCHEMY_BINDS中配置了BLUELOG_REPLICA_BIND(默认'replica')时，BLUELOG_REPLICA_BLUEPRINTS中蓝本的GET/HEAD请求
+    从只读副本读取，比如定期快照(flask replica-snapshot)的SQLite文件或另一个数据库URL；
+    其他请求(包括admin蓝本和所有写请求)以及所有写操作都使用主库
+    读己之写：会话一旦flush过，之后的读取都回到主库；请求提交过修改后，在用户会话中记录时间，
+    BLUELOG_REPLICA_STICKY_SECONDS秒内该用户的请求都从主库读取，不会因为副本延迟看不到自己刚提交的内容
+    提交修改后，页面缓存和模板上下文缓存立即失效，但副本还没有同步，紧接着从副本读取的请求会把旧数据重新写入缓存，
+    并且在副本同步之后继续返回：因此BLUELOG_REPLICA_STICKY_SECONDS秒内从副本读到的数据不写入缓存
+    (页面缓存按页面的标签最近一次失效的时间判断，文件系统后端多个进程共享；模板上下文缓存按本进程最近一次提交的时间判断)
+    每个请求的路由结果计入bluelog_db_route_total指标
+"""
+import sqlite3
+import time
+
+from flask import request, session, current_app, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm, event
+from sqlalchemy.engine.url import make_url
+
+from bluelog.caching import on_models_committed
+
+_READ_BIND = 'bluelog_read_bind'
+_WROTE = 'bluelog_wrote'
+_STICKY_KEY = '_primary_until'
+
+
+class RoutingSession(SignallingSession):
+    """读取路由到info中指定的副本，flush和flush之后的读取使用主库"""
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = self.info.get(_READ_BIND)
+        if bind is not None and not self._flushing and not self.info.get(_WROTE):
+            return get_state(self.app).db.get_engine(self.app, bind=bind)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _record_write(db_session, flush_context):
+    db_session.info[_WROTE] = True
+
+
+class DatabaseRouter(object):
+
+    def __init__(self, db=None, app=None):
+        self.db = db
+        self.committed_at = 0   # 本进程最近一次提交修改的时间
+        on_models_committed(self._on_models_committed)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_REPLICA_BIND', 'replica')
+        app.config.setdefault('BLUELOG_REPLICA_BLUEPRINTS', ('blog',))
+        app.config.setdefault('BLUELOG_REPLICA_STICKY_SECONDS', 10)
+        app.extensions['database_router'] = self
+        app.before_request(self._route)
+        app.after_request(self._remember_write)
+        app.teardown_request(self._reset)
+
+    @staticmethod
+    def replica_bind(app):
+        bind = app.config['BLUELOG_REPLICA_BIND']
+        return bind if bind in (app.config.get('SQLALCHEMY_BINDS') or {}) else None
+
+    def reading_replica(self):
+        """当前请求是否从副本读取"""
+        if not has_request_context() or self.replica_bind(current_app) is None:
+            return False
+        info = self.db.session().info
+        return info.get(_READ_BIND) is not None and not info.get(_WROTE)
+
+    def replica_lag(self):
+        """提交后副本可能还没有同步的秒数"""
+        return current_app.config['BLUELOG_REPLICA_STICKY_SECONDS']
+
+    def recently_committed(self):
+        """本进程在副本可能还没有同步的时间内提交过修改"""
+        return time.time() - self.committed_at < self.replica_lag()
+
+    def _on_models_committed(self, changes):
+        self.committed_at = time.time()
+
+    def decide(self):
+        """返回当前请求的(路由, 原因)"""
+        config = current_app.config
+        if request.method not in ('GET', 'HEAD'):
+            return 'primary', 'write'
+        if request.blueprint not in config['BLUELOG_REPLICA_BLUEPRINTS']:
+            return 'primary', 'blueprint'
+        if session.get(_STICKY_KEY, 0) > time.time():
+            return 'primary', 'sticky'
+        return 'replica', 'read'
+
+    def _route(self):
+        bind = self.replica_bind(current_app)
+        db_session = self.db.session()
+        db_session.info.pop(_WROTE, None)
+        db_session.info.pop(_READ_BIND, None)
+        if bind is None:
+            return
+        route, reason = self.decide()
+        if route == 'replica':
+            db_session.info[_READ_BIND] = bind
+        metrics = current_app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.inc('bluelog_db_route_total', (('route', route), ('reason', reason)))
+
+    def _remember_write(self, response):
+        if self.db.session().info.get(_WROTE) and self.replica_bind(current_app) is not None:
+            session[_STICKY_KEY] = time.time() + current_app.config['BLUELOG_REPLICA_STICKY_SECONDS']
+        return response
+
+    def _reset(self, exc):
+        db_session = self.db.session()
+        db_session.info.pop(_READ_BIND, None)
+        db_session.info.pop(_WROTE, None)
+
+
+def snapshot_replica(app):
+    """用SQLite的在线备份把主库复制到副本文件，已经打开的副本连接在下一个事务中就能读到新数据"""
+    primary = make_url(app.config['SQLALCHEMY_DATABASE_URI']).database
+    replica = make_url(app.config['SQLALCHEMY_BINDS'][app.config['BLUELOG_REPLICA_BIND']]).database
+    source, target = sqlite3.connect(primary), sqlite3.connect(replica)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return primary, replica
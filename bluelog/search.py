@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+全文搜索
+    使用SQLite的FTS5虚拟表search_index索引文章标题、文章纯文本正文和已审核的评论，避免 LIKE '%x%' 扫描全部正文
+    文章和评论共用一张索引表，用rowid区分：文章为 id * 2，评论为 id * 2 + 1
+    索引通过模型事件在同一个事务中同步更新，flask reindex命令可以分批重建索引
+    其他数据库或未编译FTS5的SQLite不创建索引表，搜索页面提示不可用
+"""
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, event
+
+from bluelog.extensions import db
+from bluelog.models import Post, Comment
+from bluelog.pagination import keyset_paginate
+
+_MARK_START, _MARK_END = '\x02', '\x03'     # 高亮标记，转义后再替换为<mark>标签，避免正文中的内容被当作HTML
+
+_create_index = DDL("CREATE VIRTUAL TABLE IF NOT EXISTS search_index "
+                    "USING fts5(title, body, post_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')")
+_drop_index = DDL('DROP TABLE IF EXISTS search_index')
+
+search_index = db.table('search_index', db.column('rowid'), db.column('title'), db.column('body'),
+                        db.column('post_id'))
+
+
+def fts_enabled(connection):
+    """当前数据库是否支持FTS5，结果保存在dialect对象上"""
+    dialect = connection.dialect
+    if dialect.name != 'sqlite':
+        return False
+    if not hasattr(dialect, 'bluelog_fts5'):
+        options = [row[0] for row in connection.execute('PRAGMA compile_options')]
+        dialect.bluelog_fts5 = 'ENABLE_FTS5' in options
+    return dialect.bluelog_fts5
+
+
+def _fts_ddl(ddl, target, bind, **kwargs):
+    return fts_enabled(bind)
+
+
+event.listen(db.metadata, 'after_create', _create_index.execute_if(callable_=_fts_ddl))
+event.listen(db.metadata, 'before_drop', _drop_index.execute_if(callable_=_fts_ddl))
+
+
+def _post_row(post_id, title, body_text):
+    return dict(rowid=post_id * 2, title=title or '', body=body_text or '', post_id=post_id)
+
+
+def _comment_row(comment_id, body, post_id):
+    return dict(rowid=comment_id * 2 + 1, title='', body=body or '', post_id=post_id)
+
+
+def _replace(connection, rowid, row=None):
+    connection.execute(search_index.delete().where(search_index.c.rowid == rowid))
+    if row is not None:
+        connection.execute(search_index.insert().values(**row))
+
+
+def _changed(target, *keys):
+    attrs = db.inspect(target).attrs
+    return any(attrs[key].history.has_changes() for key in keys)
+
+
+@event.listens_for(Post, 'after_insert')
+@event.listens_for(Post, 'after_update')
+def _index_post(mapper, connection, target):
+    if fts_enabled(connection) and _changed(target, 'title', 'body_text'):
+        _replace(connection, target.id * 2, _post_row(target.id, target.title, target.body_text))
+
+
+@event.listens_for(Comment, 'after_insert')
+@event.listens_for(Comment, 'after_update')
+def _index_comment(mapper, connection, target):
+    # 只有已审核的评论进入索引，取消审核或修改内容时同步更新
+    if fts_enabled(connection) and _changed(target, 'body', 'reviewed', 'post_id'):
+        row = _comment_row(target.id, target.body, target.post_id) if target.reviewed else None
+        _replace(connection, target.id * 2 + 1, row)
+
+
+@event.listens_for(Post, 'after_delete')
+def _unindex_post(mapper, connection, target):
+    if fts_enabled(connection):
+        _replace(connection, target.id * 2)
+
+
+@event.listens_for(Comment, 'after_delete')
+def _unindex_comment(mapper, connection, target):
+    if fts_enabled(connection):
+        _replace(connection, target.id * 2 + 1)
+
+
+def reindex(batch_size=500):
+    """清空并按id分批重建索引，返回(文章数, 评论数)"""
+    connection = db.session.connection()
+    connection.execute(search_index.delete())
+    counts = []
+    for query, make_row in (
+            (db.session.query(Post.id, Post.title, Post.body_text), _post_row),
+            (db.session.query(Comment.id, Comment.body, Comment.post_id).filter(Comment.reviewed == db.true()),
+             _comment_row)):
+        model_id, last_id, total = query.column_descriptions[0]['expr'], 0, 0
+        while True:
+            rows = query.filter(model_id > last_id).order_by(model_id).limit(batch_size).all()
+            if not rows:
+                break
+            connection.execute(search_index.insert(), [make_row(*row) for row in rows])
+            last_id, total = rows[-1][0], total + len(rows)
+        counts.append(total)
+    connection.execute("INSERT INTO search_index(search_index) VALUES('optimize')")
+    db.session.commit()
+    return tuple(counts)
+
+
+def match_expression(keywords):
+    """把用户输入转换为FTS5查询：每个词加双引号按短语匹配，多个词之间为AND关系，避免语法错误"""
+    terms = ['"%s"' % term.replace('"', '""') for term in re.split(r'\s+', keywords.strip()) if term]
+    return ' '.join(terms)
+
+
+def search_available():
+    return fts_enabled(db.session.connection())
+
+
+def paginate_search(keywords, per_page):
+    """
+    按相关度返回搜索结果的分页对象，bm25得分越小越相关，标题的权重是正文的10倍，按(rank, rowid)键集分页
+    结果行包含post_id、post_title、title(高亮后的标题，评论为空)、snippet(高亮片段)和is_comment
+    """
+    fts = db.literal_column('search_index')
+    results = db.select([
+        search_index.c.rowid.label('rowid'),
+        search_index.c.post_id.label('post_id'),
+        db.func.bm25(fts, 10.0, 1.0).label('rank'),
+        db.func.highlight(fts, 0, _MARK_START, _MARK_END).label('title'),
+        db.func.snippet(fts, 1, _MARK_START, _MARK_END, '…', 24).label('snippet'),
+    ]).where(fts.match(match_expression(keywords))).alias('results')
+    query = db.session.query(
+        results.c.rowid, results.c.rank, results.c.post_id, results.c.title, results.c.snippet,
+        (results.c.rowid % 2).label('is_comment'), Post.title.label('post_title'),
+    ).select_from(results).join(Post, Post.id == results.c.post_id)
+    return keyset_paginate(query, results.c.rank, results.c.rowid, per_page=per_page, descending=False)
+
+
+def highlight(text):
+    """转义文本并把高亮标记替换为<mark>标签"""
+    return Markup(str(escape(text or '')).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>'))
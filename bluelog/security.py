@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+登录保护
+    验证密码散列(PBKDF2)故意很慢，登录请求集中涌入时会占满worker，访客的请求只能排队
+    LoginGuard把密码验证放到有界的线程池中执行(hashlib计算散列时释放GIL)：同时计算的散列不超过
+    BLUELOG_LOGIN_WORKERS个，排队的不超过BLUELOG_LOGIN_QUEUE个，队列已满的请求立即返回503，不再计算散列
+    请求线程仍然等待验证结果，同步worker在等待期间不能处理其他请求，所以最多等待BLUELOG_LOGIN_TIMEOUT秒，
+    超时同样返回503(线程池中的任务执行完后才释放名额)；登录请求最多占用worker这么久
+    同一IP在BLUELOG_LOGIN_WINDOW秒内失败BLUELOG_LOGIN_ATTEMPTS次后，窗口期内的登录请求直接返回429
+    失败记录保存在进程内，最多记录BLUELOG_LOGIN_TRACKED_IPS个IP；多个worker进程各自计数
+    每次尝试的结果计入bluelog_login_attempts_total指标
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask import current_app
+from werkzeug.security import check_password_hash
+
+
+def check_credentials(expected_username, password_hash, username, password):
+    """在线程池中执行，不访问应用上下文"""
+    return username == expected_username and check_password_hash(password_hash, password)
+
+
+class LoginGuard(object):
+
+    def __init__(self, app=None):
+        self.workers = 2
+        self.max_attempts = 5
+        self.window = 300
+        self.max_tracked = 10000
+        self.timeout = 2
+        self._lock = threading.Lock()
+        self._failures = OrderedDict()  # IP -> 失败时间队列，按最近失败时间排序，超过上限时淘汰最久的
+        self._slots = threading.BoundedSemaphore(1)
+        self._executor = None
+        self._executor_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_LOGIN_WORKERS', 2)
+        app.config.setdefault('BLUELOG_LOGIN_QUEUE', 8)
+        app.config.setdefault('BLUELOG_LOGIN_ATTEMPTS', 5)
+        app.config.setdefault('BLUELOG_LOGIN_WINDOW', 300)
+        app.config.setdefault('BLUELOG_LOGIN_TRACKED_IPS', 10000)
+        app.config.setdefault('BLUELOG_LOGIN_TIMEOUT', 2)
+        app.extensions['login_guard'] = self
+        self.workers = app.config['BLUELOG_LOGIN_WORKERS']
+        self.max_attempts = app.config['BLUELOG_LOGIN_ATTEMPTS']
+        self.window = app.config['BLUELOG_LOGIN_WINDOW']
+        self.max_tracked = app.config['BLUELOG_LOGIN_TRACKED_IPS']
+        self.timeout = app.config['BLUELOG_LOGIN_TIMEOUT']
+        self._slots = threading.BoundedSemaphore(self.workers + app.config['BLUELOG_LOGIN_QUEUE'])
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._failures.clear()
+
+    def _recent_failures(self, ip, now):
+        # 调用时持有锁
+        failures = self._failures.get(ip)
+        if failures is None:
+            return None
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[ip]
+            return None
+        return failures
+
+    def throttled(self, ip):
+        with self._lock:
+            failures = self._recent_failures(ip, time.time())
+            return failures is not None and len(failures) >= self.max_attempts
+
+    def _record(self, ip, success):
+        with self._lock:
+            if success:
+                self._failures.pop(ip, None)
+                return
+            now = time.time()
+            failures = self._recent_failures(ip, now)
+            if failures is None:
+                failures = self._failures[ip] = deque(maxlen=self.max_attempts)
+            failures.append(now)
+            self._failures.move_to_end(ip)
+            while len(self._failures) > self.max_tracked:
+                self._failures.popitem(last=False)
+
+    def _submit(self, func, *args):
+        # 线程池在每个进程中第一次使用时创建，fork出的worker进程不会继承父进程的线程
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bluelog-login')
+            self._executor_pid = os.getpid()
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def _verify(self, ip, credentials):
+        # 调用时已经占用一个名额
+        try:
+            future = self._submit(check_credentials, *credentials)
+        except Exception:   # 没有提交的任务不会执行释放名额的回调，比如线程池已经在解释器退出时关闭
+            self._slots.release()
+            raise
+        try:
+            success = future.result(timeout=self.timeout)
+        except TimeoutError:
+            return 'busy'
+        self._record(ip, success)
+        return 'success' if success else 'failure'
+
+    def attempt(self, ip, *credentials):
+        """验证登录，返回'success'、'failure'、'throttled'(失败次数过多)或'busy'(验证队列已满或等待超时)"""
+        if self.throttled(ip):
+            result = 'throttled'
+        elif not self._slots.acquire(blocking=False):
+            result = 'busy'
+        else:
+            result = self._verify(ip, credentials)
+        metrics = current_app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.inc('bluelog_login_attempts_total', (('result', result),))
+        return result
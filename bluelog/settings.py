@@ -24,7 +24,19 @@ class BaseConfig(object):
     DEBUG_TB_INTERCEPT_REDIRECTS = False    # Flask-debugger参数,是否拦截重定向
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False  # SQLAlchemy警告信息
-    SQLALCHEMY_RECORD_QUERIES = True    # 显式的禁用或启用查询记录
+    # 每个SQLite连接打开时执行的PRAGMA，空字典表示使用SQLite的默认设置(同时不再替换连接池)
+    # 读写分离：SQLALCHEMY_BINDS中有这个名字的数据库时，下列蓝本的GET请求从该副本读取
+    BLUELOG_REPLICA_BIND = 'replica'
+    BLUELOG_REPLICA_BLUEPRINTS = ('blog',)
+    BLUELOG_REPLICA_STICKY_SECONDS = 10     # 提交修改后该用户的请求从主库读取、副本读到的数据不写入缓存的秒数，应大于副本的最大延迟
+    BLUELOG_SQLITE_PRAGMAS = {
+        'busy_timeout': 5000,   # 锁被占用时最多等待的毫秒数，放在最前面，切换日志模式时也会等待
+        'journal_mode': 'WAL',  # 读写互不阻塞，多个worker进程可以同时读取
+        'synchronous': 'NORMAL',    # WAL模式下只在检查点时fsync，断电最多丢失最近的事务，不会损坏数据库
+        'mmap_size': 256 * 1024 * 1024,     # 通过内存映射读取数据库文件
+        'cache_size': -16000,   # 每个连接的页缓存，负数表示KiB
+        'temp_store': 'MEMORY',     # 排序和临时表使用内存
+    }
 
     CKEDITOR_ENABLE_CSRF = True     # 开启CSRF保护
     CKEDITOR_FILE_UPLOADER = 'admin.upload_image'   # 使用admin.upload_image函数上传图片
@@ -37,15 +49,62 @@ class BaseConfig(object):
     MAIL_DEFAULT_SENDER = ('Bluelog Admin', MAIL_USERNAME)      # 默认发信人
 
     BLUELOG_EMAIL = os.getenv('BLUELOG_EMAIL')
+    BLUELOG_MAIL_BATCH_SIZE = 50    # mail-worker每批发送的邮件数，同一批邮件共用一个SMTP连接
+    BLUELOG_MAIL_MAX_ATTEMPTS = 5   # 发送失败的最大重试次数
+    BLUELOG_MAIL_RETRY_DELAY = 60   # 首次重试等待秒数，之后每次加倍
+    BLUELOG_MAIL_LEASE = 600    # worker领取邮件后的租期(秒)，超时未处理的邮件会被重新领取
+
+    BLUELOG_NOTIFICATION_WINDOW = 600   # 新评论和新回复提醒的合并窗口(秒)，每个收件人每个窗口最多收到一封摘要
+    BLUELOG_NOTIFICATION_DIGEST_POSTS = 20  # 摘要中逐篇列出的文章数，其余的文章只汇总数量
+
+    BLUELOG_LOG_QUEUE_SIZE = 10000  # 日志队列长度，后台线程处理不过来时丢弃新的日志记录而不阻塞请求
+    BLUELOG_ERROR_MAIL_WINDOW = 300     # 相同错误的邮件合并时间窗口(秒)
+
     BLUELOG_POST_PER_PAGE = 10      # 每个页面文章个数
     BLUELOG_MANAGE_POST_PER_PAGE = 15   # 管理文章页面文章显示个数
     BLUELOG_COMMENT_PER_PAGE = 15   # 每页评论数
+    BLUELOG_KEYSET_OFFSET_PAGES = 5     # 前几页使用页码URL，更深的页面使用游标翻页
+    BLUELOG_SEARCH_RESULT_PER_PAGE = 20     # 每页搜索结果数
 
     BLUELOG_THEMES = {'perfect_blue': 'Perfect Blue', 'black_swan': 'Black Swan'}   # 主题字典(主题名称与CSS文件名对应：显示名称)
-    BLUELOG_SLOW_QUERY_THRESHOLD = 1    #
+    BLUELOG_SLOW_QUERY_THRESHOLD = 1    # 慢查询阈值(秒)
+    BLUELOG_SLOW_QUERY_SAMPLE_RATE = 0.1    # 计时的语句比例，0表示关闭慢查询采样
+    BLUELOG_SLOW_QUERY_BUFFER = 200     # 保留最近的慢查询条数
+    BLUELOG_METRICS = True  # 是否统计请求、数据库和模板耗时并提供/metrics
+    BLUELOG_METRICS_TOKEN = os.getenv('BLUELOG_METRICS_TOKEN')  # 抓取/metrics时使用的Bearer令牌，未登录时必须提供
+    BLUELOG_METRICS_DIR = None  # 多进程部署时各worker写入计数文件的目录，None表示只统计当前进程
+    BLUELOG_METRICS_FLUSH_INTERVAL = 1  # worker写入计数文件的最小间隔(秒)
+    BLUELOG_QUERY_BUDGETS = {}  # 按端点名覆盖视图的查询预算，如 {'blog.index': 10}
+    BLUELOG_QUERY_BUDGET_DEFAULT = 20   # 没有设置预算的视图每个请求最多发出的查询数
+    BLUELOG_QUERY_REPEAT_LIMIT = 5  # 同一形状的查询在一个请求中重复超过这个次数视为N+1查询
+    BLUELOG_QUERY_BUDGET_RAISE = False  # 违规时抛出异常(测试配置)还是记录警告日志
+    BLUELOG_CONTEXT_CACHE = True    # 是否缓存模板上下文(管理员、分类、链接、未读评论数)
+    BLUELOG_CONTEXT_CACHE_TIMEOUT = 60  # 缓存过期秒数，多进程部署时其他进程的修改最多延迟这么久可见
+    # 匿名访客整页缓存后端：None(关闭)、'memory'(进程内LRU)、'filesystem'(多个worker进程共享的磁盘目录)
+    BLUELOG_PAGE_CACHE = 'memory'
+    BLUELOG_PAGE_CACHE_TIMEOUT = 300    # 页面缓存过期秒数
+    BLUELOG_PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024     # 进程内缓存的最大字节数
+    BLUELOG_PAGE_CACHE_DIR = os.path.join(basedir, 'cache')     # 磁盘缓存目录
+
+    BLUELOG_LOGIN_WORKERS = 2   # 同时验证密码散列的线程数
+    BLUELOG_LOGIN_QUEUE = 8     # 等待验证的登录请求数上限，超过时直接返回503
+    BLUELOG_LOGIN_TIMEOUT = 2   # 请求等待验证结果的秒数，超时返回503
+    BLUELOG_LOGIN_ATTEMPTS = 5  # 同一IP在时间窗口内允许失败的次数
+    BLUELOG_LOGIN_WINDOW = 300  # 失败次数的统计窗口(秒)
+
+    # 匿名评论写入队列的目录，None表示评论在请求中直接提交；设置后由后台线程批量写入数据库
+    BLUELOG_COMMENT_SPOOL = None
+    BLUELOG_COMMENT_SPOOL_BATCH = 100   # 每个事务写入的评论数，队列中攒够这么多条时立即写入
+    BLUELOG_COMMENT_SPOOL_INTERVAL = 200    # 后台线程写入的间隔(毫秒)，0表示不启动后台线程，只由flask flush-comments写入
 
     BLUELOG_UPLOAD_PATH = os.path.join(basedir, 'uploads')  # 上传路径
-    BLUELOG_ALLOWED_IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif']    # 允许上传的图片格式
+    BLUELOG_ALLOWED_IMAGE_EXTENSIONS = ['png', 'jpg', 'gif', 'webp']    # 允许上传的图片格式(按文件内容判断)
+    BLUELOG_UPLOAD_MAX_BYTES = 8 * 1024 * 1024  # 上传文件的最大字节数
+    BLUELOG_UPLOAD_CACHE_SECONDS = 365 * 24 * 60 * 60  # 内容寻址的上传文件的缓存时间
+    BLUELOG_IMAGE_MAX_PIXELS = 40 * 1000 * 1000     # 图片的最大像素数，防止解压炸弹
+    BLUELOG_IMAGE_DISPLAY_WIDTH = 1280  # 插入文章的图片版本的最大宽度
+    BLUELOG_IMAGE_QUALITY = 85  # 生成JPEG和WebP版本的质量
+    BLUELOG_IMAGE_WORKERS = 2   # 生成图片版本的进程数，0表示在上传请求中直接生成(需要安装Pillow)
 
 
 class DevelopmentConfig(BaseConfig):    # 开发配置类
@@ -55,11 +114,18 @@ class DevelopmentConfig(BaseConfig):    # 开发配置类
 class TestingConfig(BaseConfig):    # 测试配置类
     TESTING = True
     WTF_CSRF_ENABLED = False
+    BLUELOG_QUERY_BUDGET_RAISE = True   # 查询数回归直接导致测试失败
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'  # in-memory database
+    BLUELOG_IMAGE_WORKERS = 0
 
 
 class ProductionConfig(BaseConfig):     # 生产配置类
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', prefix + os.path.join(basedir, 'data.db'))
+    # 只读副本，比如用flask replica-snapshot定期复制的SQLite文件
+    SQLALCHEMY_BINDS = {'replica': os.getenv('REPLICA_DATABASE_URL')} if os.getenv('REPLICA_DATABASE_URL') else {}
+    BLUELOG_PAGE_CACHE = 'filesystem'
+    BLUELOG_METRICS_DIR = os.getenv('BLUELOG_METRICS_DIR', os.path.join(basedir, 'metrics'))
+    BLUELOG_COMMENT_SPOOL = os.getenv('BLUELOG_COMMENT_SPOOL')
 
 # 配置config映射字典
 config = {
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+评论写入队列
+    热门文章集中收到评论时，每条评论都单独提交一个事务，请求排队等待SQLite的写锁
+    配置了BLUELOG_COMMENT_SPOOL(队列目录)时，匿名评论验证通过后追加到本地的队列文件，写入磁盘(fsync)后请求立即返回；
+    后台线程每BLUELOG_COMMENT_SPOOL_INTERVAL毫秒，或者队列中攒够BLUELOG_COMMENT_SPOOL_BATCH条时，
+    把队列中的评论每BLUELOG_COMMENT_SPOOL_BATCH条一个事务写入数据库
+    每个进程追加到自己的队列文件，写入期间一直持有文件的排他锁(flock)；后台线程提交前先换用新文件，
+    目录中没有被锁住的文件都可以提交，所以进程退出或崩溃后留下的文件会由其他进程或flask flush-comments提交
+    文件在写入数据库之后才删除，两者之间崩溃时重复的评论由写入函数跳过
+    数据库暂时不可用(连接断开、database is locked、磁盘已满等)时文件保留，后台线程逐次加倍等待时间后重试，不会放弃；
+    其他错误把这一批对半拆开重试，单独写入也失败的记录(比如无法解析的时间)记录到日志，追加到同名的.failed文件，
+    不再阻塞后面的评论，排查后用flask flush-comments --retry-failed重新写入；无法解析的行记录到日志后跳过
+    没有fcntl的平台(Windows)上不能判断文件是否正在写入，只适合单进程部署
+    指标：队列中等待的评论数(抓取时统计)、写入的评论数、每批写入的耗时
+"""
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy.exc import DBAPIError, IntegrityError, DataError
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+
+
+def _lock(f, blocking=True):
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def _open_locked(path):
+    # 加锁之前文件可能已经被flask flush-comments --retry-failed改名，这时重新打开
+    while True:
+        f = open(path, 'ab')
+        _lock(f)
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+def _transient(error):
+    """数据库连接、锁、磁盘空间等暂时性的错误，重试可能成功；约束冲突等由记录本身引起的错误不算"""
+    return isinstance(error, DBAPIError) and not isinstance(error, (IntegrityError, DataError))
+
+
+def read_records(f):
+    """读取队列文件中的记录，跳过崩溃时没有写完的最后一行和无法解析的行"""
+    records = []
+    for line in f:
+        if not line.endswith(b'\n'):
+            continue
+        try:
+            records.append(json.loads(line.decode('utf-8')))
+        except ValueError:  # UnicodeDecodeError和JSONDecodeError都是ValueError的子类
+            current_app.logger.error('Skipped an undecodable spooled comment in %s: %r', f.name, line)
+    return records
+
+
+class CommentSpool(object):
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.batch_size = 100
+        self.interval = 0.2
+        self._writer = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._file = None
+        self._pending = 0
+        self._pid = None
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_COMMENT_SPOOL', None)
+        app.config.setdefault('BLUELOG_COMMENT_SPOOL_BATCH', 100)
+        app.config.setdefault('BLUELOG_COMMENT_SPOOL_INTERVAL', 200)
+        app.extensions['comment_spool'] = self
+        self._rotate()
+        self.directory = app.config['BLUELOG_COMMENT_SPOOL']
+        self.batch_size = app.config['BLUELOG_COMMENT_SPOOL_BATCH']
+        self.interval = app.config['BLUELOG_COMMENT_SPOOL_INTERVAL'] / 1000.0
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        metrics = app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.gauge('bluelog_comment_spool_depth', self.depth)
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def writer(self, func):
+        """注册写入函数：接收一批记录，在一个事务中写入数据库，返回实际写入的条数"""
+        self._writer = func
+        return func
+
+    def _segment(self):
+        # 调用时持有锁。新文件加锁之前可能被其他进程当作遗留的空文件提交并删除，这时换一个新文件
+        if self._pid != os.getpid():    # fork出的子进程不使用父进程的文件和后台线程
+            self._file, self._pending, self._thread, self._pid = None, 0, None, os.getpid()
+        while self._file is None:
+            f = open(os.path.join(self.directory, '%s.jsonl' % uuid.uuid4().hex), 'ab')
+            _lock(f)
+            if os.fstat(f.fileno()).st_nlink:
+                self._file = f
+            else:
+                f.close()
+        return self._file
+
+    def _rotate(self):
+        # 关闭本进程的文件(释放文件锁)，之后的评论写入新文件
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+            self._pending = 0
+
+    def append(self, record):
+        """把一条记录追加到本进程的队列文件，写入磁盘后返回"""
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self._lock:
+            f = self._segment()
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._wakeup.set()
+            self._start_writer()
+
+    def _start_writer(self):
+        # 调用时持有锁。BLUELOG_COMMENT_SPOOL_INTERVAL为0时不启动后台线程，由flask flush-comments提交
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(current_app._get_current_object(),),
+                                        name='bluelog-comment-spool', daemon=True)
+        self._thread.start()
+
+    def _run(self, app):
+        failures = 0
+        while True:
+            if failures:    # 数据库暂时不可用时不因为攒够一批而提前重试，等待时间逐次加倍，最长一分钟
+                time.sleep(min(self.interval * 2 ** failures, 60))
+            else:
+                self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                with app.app_context():
+                    self.flush()
+                failures = 0
+            except Exception:   # 数据库暂时不可用等，文件保留，下次重试
+                failures += 1
+                app.logger.exception('Failed to write spooled comments.')
+
+    def flush(self):
+        """把目录中所有没有被锁住的队列文件(包括本进程刚换下的文件)写入数据库，返回读取的记录数"""
+        self._rotate()
+        count = 0
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.jsonl'))):
+            count += self._flush_file(path)
+        return count
+
+    def _flush_file(self, path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:   # 已经被其他进程提交
+            return 0
+        with f:
+            if not _lock(f, blocking=False) or not os.fstat(f.fileno()).st_nlink:
+                return 0    # 正在写入的文件，或者刚被其他进程提交
+            records = read_records(f)
+            failed = []
+            for start in range(0, len(records), self.batch_size):
+                failed.extend(self._write_isolating(records[start:start + self.batch_size]))
+            if failed:
+                self._set_aside(path, failed)
+            os.remove(path)
+        return len(records)
+
+    def _write_isolating(self, records):
+        # 暂时性的错误直接抛出，文件保留到下次重试；其他错误把这一批对半拆开重试，返回单独写入也失败的记录
+        try:
+            self._write(records)
+        except Exception as error:
+            if _transient(error):
+                raise
+            if len(records) == 1:
+                current_app.logger.exception('Failed to write spooled comment %r.', records[0])
+                return records
+            middle = len(records) // 2
+            return self._write_isolating(records[:middle]) + self._write_isolating(records[middle:])
+        return []
+
+    def _set_aside(self, path, records):
+        # 调用时持有队列文件的锁，同一个.failed文件只有这一个进程追加
+        with _open_locked(path[:-len('.jsonl')] + '.failed') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        metrics = current_app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.inc('bluelog_comment_spool_written_total', (('result', 'failed'),), len(records))
+
+    def retry_failed(self):
+        """把.failed文件改名为新的队列文件，下次flush()时重新写入，返回文件数"""
+        paths = glob.glob(os.path.join(self.directory, '*.failed'))
+        for path in paths:
+            with open(path, 'rb') as f:
+                _lock(f)    # 等待正在追加的进程写完
+                os.replace(path, os.path.join(self.directory, '%s.jsonl' % uuid.uuid4().hex))
+        return len(paths)
+
+    def _write(self, records):
+        start = time.perf_counter()
+        written = self._writer(records)
+        metrics = current_app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.observe('bluelog_comment_spool_flush_duration_seconds', (), time.perf_counter() - start)
+            metrics.inc('bluelog_comment_spool_written_total', (('result', 'written'),), written)
+            metrics.inc('bluelog_comment_spool_written_total', (('result', 'skipped'),), len(records) - written)
+            metrics.flush()
+
+    def depth(self):
+        """队列文件中等待写入的记录数(所有进程)"""
+        count = 0
+        for path in glob.glob(os.path.join(self.directory, '*.jsonl')):
+            try:
+                with open(path, 'rb') as f:
+                    count += sum(1 for line in f if line.endswith(b'\n'))
+            except FileNotFoundError:
+                continue
+        return count
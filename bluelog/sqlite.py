@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite引擎配置
+    默认的SQLite连接使用回滚日志(rollback journal)，写事务期间其他连接不能读取，多个gunicorn worker同时写入时
+    很容易出现database is locked，每次提交还要多次fsync
+    SQLiteProfile在每个新连接上执行BLUELOG_SQLITE_PRAGMAS中的PRAGMA：WAL日志模式让读写互不阻塞，
+    synchronous=NORMAL在WAL模式下只在检查点时fsync，busy_timeout让写入在锁被占用时等待而不是立即失败，
+    mmap_size、cache_size和temp_store减少读取时的系统调用和临时文件
+    Flask-SQLAlchemy对SQLite文件数据库默认使用NullPool，每次请求都要重新打开文件并执行这些PRAGMA，
+    这里改为QueuePool(SQLALCHEMY_ENGINE_OPTIONS中显式设置的选项优先)，连接可以在线程之间依次复用
+    连接池中的连接不能跨进程使用：gunicorn使用--preload时worker会继承主进程已经打开的连接，
+    取出连接时检查进程号，发现是父进程打开的连接就丢弃并重新连接
+"""
+import os
+import sqlite3
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import Pool, QueuePool
+
+# SQLite文件数据库的连接池选项，线程数较多的worker可以在SQLALCHEMY_ENGINE_OPTIONS中调大
+POOL_OPTIONS = {
+    'poolclass': QueuePool,
+    'pool_size': 5,
+    'max_overflow': 10,
+    'connect_args': {'check_same_thread': False},   # 连接池中的连接会被不同线程依次使用
+}
+
+
+def is_sqlite_file(uri):
+    url = make_url(uri)
+    return url.drivername.startswith('sqlite') and url.database not in (None, '', ':memory:')
+
+
+class SQLiteProfile(object):
+
+    def __init__(self, app=None):
+        self.pragmas = {}
+        event.listen(Engine, 'connect', self._apply_pragmas)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLUELOG_SQLITE_PRAGMAS', {})
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        app.extensions['sqlite_profile'] = self
+        self.pragmas = app.config['BLUELOG_SQLITE_PRAGMAS']
+        if self.pragmas and is_sqlite_file(app.config['SQLALCHEMY_DATABASE_URI']):
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(POOL_OPTIONS, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+
+    def _apply_pragmas(self, dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self.pragmas.items():
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        finally:
+            cursor.close()
+
+
+@event.listens_for(Pool, 'connect')
+def _record_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    # 父进程打开的连接：不关闭(父进程可能仍在使用)，只让连接池丢弃它并重新连接
+    if connection_record.info.get('pid', os.getpid()) != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError('Connection record belongs to pid %s, attempting to check out in pid %s' %
+                                     (connection_record.info['pid'], os.getpid()))
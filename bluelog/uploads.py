@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+图片上传
+    上传的文件分块写入磁盘，超过BLUELOG_UPLOAD_MAX_BYTES立即中止；文件类型由文件头的魔数判断，
+    不信任客户端提供的文件名和扩展名
+    文件按内容寻址保存：文件名是内容的SHA-256，放在按哈希前两级分片的子目录中(ab/cd/<哈希>.<扩展名>)，
+    相同的图片只保存一份，不同的图片不会互相覆盖；文件内容永远不变，get_image返回immutable缓存头
+    安装了Pillow时，后台进程池(BLUELOG_IMAGE_WORKERS个进程，0表示在请求中直接处理)按VARIANT_WIDTHS生成缩小的版本，
+    每个版本同时生成WebP，并按EXIF方向旋转、去掉EXIF等元数据；没有安装Pillow时只保存原图
+    返回给CKEditor的是宽度不超过BLUELOG_IMAGE_DISPLAY_WIDTH的版本(文件名为<哈希>-<宽度>w.<扩展名>)，
+    render_post()根据这种文件名为图片加上srcset；版本生成之前请求版本文件时返回原图，浏览器接受WebP时优先返回WebP版本
+    flask uploads-gc分批扫描文章正文，找出不再被任何文章引用的文件(原图和所有版本)
+"""
+import functools
+import hashlib
+import logging
+import os
+import posixpath
+import time
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse, unquote
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:     # Pillow是可选依赖
+    Image = ImageOps = None
+
+CHUNK_SIZE = 64 * 1024
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+VARIANT_WIDTHS = (320, 640, 1280)
+RESIZABLE = {'jpg': 'JPEG', 'png': 'PNG'}   # 动图和WebP原图不生成版本
+_VARIANT_RE = re.compile(r'^(?P<name>[0-9a-f]{64})-(?P<width>\d+)w\.(?P<extension>jpg|png)$')
+_STORED_RE = re.compile(r'^(?P<name>[0-9a-f]{64})(-\d+w)?\.(png|jpg|gif|webp)$')     # 原图、版本和WebP
+_REFERENCE_RE = re.compile(r'/uploads/([^\s"\'<>?#)]+)')  # 文章正文中get_image的URL
+
+_executor = None
+_executor_pid = None
+logger = logging.getLogger('bluelog')   # 即app.logger，进程池的回调不在应用上下文中执行
+
+
+class UploadError(Exception):
+    """上传的文件不符合要求，消息直接返回给编辑器"""
+
+
+def sniff_image(head):
+    """根据文件头返回图片类型(扩展名)，不是支持的图片时返回None"""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for signature, extension in SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return None
+
+
+def _copy(stream, f, max_bytes):
+    size, head, digest = 0, b'', hashlib.sha256()
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadError('File is too large, the limit is %.1f MB.' % (max_bytes / 1024.0 / 1024))
+        if len(head) < 16:
+            head += chunk[:16]
+        digest.update(chunk)
+        f.write(chunk)
+    return head, digest.hexdigest()
+
+
+def stored_path(digest, extension):
+    """内容哈希对应的相对路径，按哈希的前两级分片，避免单个目录中的文件过多"""
+    return '%s/%s/%s.%s' % (digest[:2], digest[2:4], digest, extension)
+
+
+def save_upload(stream, directory, max_bytes, allowed_extensions):
+    """把上传的文件流分块写入directory，验证类型后按内容哈希保存，返回相对路径；已经有相同的文件时不重复保存"""
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            head, digest = _copy(stream, f, max_bytes)
+        extension = sniff_image(head)
+        if extension not in allowed_extensions:
+            raise UploadError('Image only!')
+        filename = stored_path(digest, extension)
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            os.utime(path)  # 重新上传的文件按新文件对待，不会在uploads-gc的宽限期内被删除
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return filename
+
+
+def plan_variants(path, display_width, max_pixels):
+    """返回要生成的版本宽度列表(最后一个是显示用的版本)，不能或不需要生成版本时返回空列表"""
+    extension = path.rsplit('.', 1)[1]
+    if Image is None or extension not in RESIZABLE:
+        return []
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            if image.getexif().get(0x0112) in (5, 6, 7, 8):     # 旋转90度的照片，宽高互换
+                width, height = height, width
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise UploadError('Invalid image.')
+    if width * height > max_pixels:
+        raise UploadError('Image is too large, the limit is %d pixels.' % max_pixels)
+    display = min(width, display_width)
+    return sorted(set(size for size in VARIANT_WIDTHS if size < display) | {display})
+
+
+def _save(image, path, quality):
+    # 先写入临时文件再重命名，请求版本文件时不会读到写了一半的文件；临时文件名唯一，同一张图片的两个任务不会互相覆盖
+    extension = os.path.splitext(path)[1]
+    image_format = 'WEBP' if extension == '.webp' else RESIZABLE[extension[1:]]
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, image_format, quality=quality, optimize=True)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def make_variants(path, widths, quality):
+    """生成各个宽度的版本和对应的WebP，在后台进程中执行"""
+    stem, extension = os.path.splitext(path)
+    with Image.open(path) as original:
+        image = ImageOps.exif_transpose(original)
+        if extension == '.jpg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        for width in widths:
+            resized = image
+            if width < image.width:
+                resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            _save(resized, '%s-%dw%s' % (stem, width, extension), quality)
+            _save(resized, '%s-%dw.webp' % (stem, width), quality)
+    return widths
+
+
+def submit(func, *args, workers=0):
+    """在进程池中执行func；workers为0时直接执行。进程池在每个进程中第一次使用时创建"""
+    global _executor, _executor_pid
+    if workers <= 0:
+        func(*args)
+        return None
+    if _executor is None or _executor_pid != os.getpid():
+        _executor, _executor_pid = ProcessPoolExecutor(max_workers=workers), os.getpid()
+    future = _executor.submit(func, *args)
+    future.add_done_callback(functools.partial(_log_failure, func.__name__, args))
+    return future
+
+
+def _log_failure(name, args, future):
+    # 后台进程中的异常只保存在future中，请求不会等待结果，不记录的话版本没有生成也没有任何提示
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('Background task %s%r failed.', name, args, exc_info=future.exception())
+
+
+def variant_name(filename, width):
+    stem, extension = filename.rsplit('.', 1)
+    return '%s-%dw.%s' % (stem, width, extension)
+
+
+def process_upload(stream, content_length, config):
+    """保存上传的图片，还没有生成版本时提交生成版本的任务，返回插入文章使用的相对路径"""
+    max_bytes = config['BLUELOG_UPLOAD_MAX_BYTES']
+    if content_length and content_length > max_bytes + 4096:    # 留出表单其他部分的长度，不必读完请求就能拒绝
+        raise UploadError('File is too large, the limit is %.1f MB.' % (max_bytes / 1024.0 / 1024))
+    directory = config['BLUELOG_UPLOAD_PATH']
+    filename = save_upload(stream, directory, max_bytes, config['BLUELOG_ALLOWED_IMAGE_EXTENSIONS'])
+    path = os.path.join(directory, filename)
+    try:
+        widths = plan_variants(path, config['BLUELOG_IMAGE_DISPLAY_WIDTH'], config['BLUELOG_IMAGE_MAX_PIXELS'])
+    except UploadError:
+        os.remove(path)
+        raise
+    if not widths:
+        return filename
+    display = variant_name(filename, widths[-1])
+    if not os.path.exists(os.path.join(directory, display)):
+        submit(make_variants, path, widths, config['BLUELOG_IMAGE_QUALITY'], workers=config['BLUELOG_IMAGE_WORKERS'])
+    return display
+
+
+def resolve_image(directory, filename, accept_webp):
+    """返回(实际要发送的文件, 是否可以永久缓存)：优先WebP版本，版本还没有生成时返回原图且不能永久缓存"""
+    head, name = posixpath.split(filename)
+    match = _VARIANT_RE.match(name)
+    if match is None:
+        return filename, _STORED_RE.match(name) is not None
+    if accept_webp:
+        webp = posixpath.join(head, name.rsplit('.', 1)[0] + '.webp')
+        if os.path.exists(os.path.join(directory, webp)):
+            return webp, True
+    if not os.path.exists(os.path.join(directory, filename)):
+        return posixpath.join(head, '%s.%s' % (match.group('name'), match.group('extension'))), False
+    return filename, True
+
+
+def upload_key(filename):
+    """文件对应的引用键：内容寻址的文件是哈希(原图和各个版本共用)，其他文件是相对路径"""
+    match = _STORED_RE.match(posixpath.basename(filename))
+    return match.group('name') if match else filename
+
+
+def find_references(bodies):
+    """从文章正文中找出引用的上传文件，返回引用键的集合"""
+    references = set()
+    for body in bodies:
+        for path in _REFERENCE_RE.findall(body or ''):
+            references.add(upload_key(unquote(path)))
+    return references
+
+
+def find_orphans(directory, references, grace_seconds):
+    """返回上传目录中没有被引用、并且修改时间早于宽限期的文件的相对路径
+    宽限期用于保护刚上传、所在文章还没有保存的图片，以及正在写入的临时文件"""
+    deadline = time.time() - grace_seconds
+    orphans = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, directory).replace(os.sep, '/')
+            if upload_key(filename) not in references and os.path.getmtime(path) < deadline:
+                orphans.append(filename)
+    return sorted(orphans)
+
+
+def remove_uploads(directory, filenames):
+    """删除文件，并删除因此变空的分片目录"""
+    for filename in filenames:
+        os.remove(os.path.join(directory, filename))
+        parent = os.path.dirname(filename)
+        while parent:
+            try:
+                os.rmdir(os.path.join(directory, parent))
+            except OSError:     # 目录不为空
+                break
+            parent = os.path.dirname(parent)
+
+
+def responsive_image_attrs(src):
+    """为上传图片的显示版本生成srcset和sizes属性，其他图片返回空列表"""
+    try:
+        path = urlparse(src or '').path
+    except ValueError:  # 无法解析的URL，如"http://[x"
+        return []
+    match = _VARIANT_RE.match(posixpath.basename(path))
+    if match is None:
+        return []
+    display = int(match.group('width'))
+    prefix = src[:src.rindex(match.group(0))]
+    widths = [width for width in VARIANT_WIDTHS if width < display] + [display]
+    srcset = ', '.join('%s%s-%dw.%s %dw' % (prefix, match.group('name'), width, match.group('extension'), width)
+                       for width in widths)
+    return [('srcset', srcset), ('sizes', '(max-width: %dpx) 100vw, %dpx' % (display, display))]
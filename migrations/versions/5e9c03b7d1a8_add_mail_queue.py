@@ -0,0 +1,38 @@
+"""Add mail queue
+
+Revision ID: 5e9c03b7d1a8
+Revises: a4b81e6d5f02
+Create Date: 2026-10-18 18:22:09.871000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e9c03b7d1a8'
+down_revision = 'a4b81e6d5f02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('queued_mail',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('subject', sa.String(length=255), nullable=True),
+    sa.Column('recipient', sa.String(length=254), nullable=True),
+    sa.Column('html', sa.Text(), nullable=True),
+    sa.Column('status', sa.String(length=10), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('next_attempt', sa.DateTime(), nullable=False),
+    sa.Column('claim', sa.String(length=32), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_queued_mail_status_next_attempt', 'queued_mail', ['status', 'next_attempt'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_queued_mail_status_next_attempt', table_name='queued_mail')
+    op.drop_table('queued_mail')
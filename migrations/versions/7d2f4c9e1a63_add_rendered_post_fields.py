@@ -0,0 +1,52 @@
+"""Add rendered post fields
+
+Revision ID: 7d2f4c9e1a63
+Revises: 3c5e8a1f2b47
+Create Date: 2026-10-18 14:05:12.118000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from bluelog.content import render_post
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2f4c9e1a63'
+down_revision = '3c5e8a1f2b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post') as batch_op:
+        batch_op.add_column(sa.Column('body_html', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('body_text', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('excerpt', sa.String(length=300), nullable=True))
+        batch_op.add_column(sa.Column('word_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('reading_time', sa.Integer(), server_default='0', nullable=False))
+
+    # 按id分批为现有文章生成派生字段，之后修改过滤规则可以使用flask rerender命令重新生成
+    post = sa.table('post', sa.column('id', sa.Integer), sa.column('body', sa.Text),
+                    sa.column('body_html', sa.Text), sa.column('body_text', sa.Text),
+                    sa.column('excerpt', sa.String), sa.column('word_count', sa.Integer),
+                    sa.column('reading_time', sa.Integer))
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(sa.select([post.c.id, post.c.body]).where(post.c.id > last_id)
+                                  .order_by(post.c.id).limit(100)).fetchall()
+        if not rows:
+            break
+        for post_id, body in rows:
+            connection.execute(post.update().where(post.c.id == post_id).values(**render_post(body)))
+        last_id = rows[-1][0]
+
+
+def downgrade():
+    with op.batch_alter_table('post') as batch_op:
+        batch_op.drop_column('reading_time')
+        batch_op.drop_column('word_count')
+        batch_op.drop_column('excerpt')
+        batch_op.drop_column('body_text')
+        batch_op.drop_column('body_html')
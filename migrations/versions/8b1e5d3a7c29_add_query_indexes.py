@@ -0,0 +1,32 @@
+"""Add indexes for the hot comment and post queries
+
+Revision ID: 8b1e5d3a7c29
+Revises: 5e9c03b7d1a8
+Create Date: 2026-10-18 20:41:37.215000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1e5d3a7c29'
+down_revision = '5e9c03b7d1a8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_post_category_id_timestamp', 'post', ['category_id', 'timestamp'], unique=False)
+    op.create_index('ix_comment_post_id_reviewed_timestamp', 'comment', ['post_id', 'reviewed', 'timestamp'],
+                    unique=False)
+    op.create_index('ix_comment_reviewed_timestamp', 'comment', ['reviewed', 'timestamp'], unique=False)
+    op.create_index('ix_comment_from_admin_timestamp', 'comment', ['from_admin', 'timestamp'], unique=False)
+    op.create_index('ix_comment_replied_id_reviewed', 'comment', ['replied_id', 'reviewed'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_comment_replied_id_reviewed', table_name='comment')
+    op.drop_index('ix_comment_from_admin_timestamp', table_name='comment')
+    op.drop_index('ix_comment_reviewed_timestamp', table_name='comment')
+    op.drop_index('ix_comment_post_id_reviewed_timestamp', table_name='comment')
+    op.drop_index('ix_post_category_id_timestamp', table_name='post')
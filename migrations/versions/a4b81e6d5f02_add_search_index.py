@@ -0,0 +1,38 @@
+"""Add full-text search index
+
+Revision ID: a4b81e6d5f02
+Revises: 7d2f4c9e1a63
+Create Date: 2026-10-18 16:40:27.553000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4b81e6d5f02'
+down_revision = '7d2f4c9e1a63'
+branch_labels = None
+depends_on = None
+
+
+def _fts5_available(bind):
+    if bind.dialect.name != 'sqlite':
+        return False
+    return 'ENABLE_FTS5' in [row[0] for row in bind.execute('PRAGMA compile_options')]
+
+
+def upgrade():
+    # 只有支持FTS5的SQLite才创建索引表，其他数据库上搜索功能不可用
+    if not _fts5_available(op.get_bind()):
+        return
+    op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index "
+               "USING fts5(title, body, post_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')")
+    # 文章rowid为 id * 2，已审核的评论rowid为 id * 2 + 1
+    op.execute("INSERT INTO search_index(rowid, title, body, post_id) "
+               "SELECT id * 2, coalesce(title, ''), coalesce(body_text, ''), id FROM post")
+    op.execute("INSERT INTO search_index(rowid, title, body, post_id) "
+               "SELECT id * 2 + 1, '', coalesce(body, ''), post_id FROM comment WHERE reviewed = 1")
+
+
+def downgrade():
+    op.execute('DROP TABLE IF EXISTS search_index')
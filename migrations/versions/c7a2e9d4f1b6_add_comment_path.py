@@ -0,0 +1,50 @@
+"""Add materialized paths to comments
+
+Revision ID: c7a2e9d4f1b6
+Revises: 8b1e5d3a7c29
+Create Date: 2026-10-19 10:12:46.530000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7a2e9d4f1b6'
+down_revision = '8b1e5d3a7c29'
+branch_labels = None
+depends_on = None
+
+PATH_SEGMENT = '%08x/'  # 与bluelog.models.PATH_SEGMENT一致，迁移中不引用模型代码
+
+
+def upgrade():
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.add_column(sa.Column('path', sa.String(length=512), nullable=True))
+    op.create_index('ix_comment_post_id_path', 'comment', ['post_id', 'path'], unique=False)
+
+    # 按id分批回填：回复总是晚于被回复的评论插入，按id顺序处理时上级评论的路径已经生成，
+    # 在本批中就从内存取，否则从数据库读取；上级评论已不存在的回复按顶层评论处理
+    comment = sa.table('comment', sa.column('id', sa.Integer), sa.column('replied_id', sa.Integer),
+                       sa.column('path', sa.String))
+    update = comment.update().where(comment.c.id == sa.bindparam('_id')).values(path=sa.bindparam('_path'))
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(sa.select([comment.c.id, comment.c.replied_id]).where(comment.c.id > last_id)
+                                  .order_by(comment.c.id).limit(1000)).fetchall()
+        if not rows:
+            break
+        parent_ids = set(replied_id for comment_id, replied_id in rows if replied_id is not None)
+        paths = dict(connection.execute(sa.select([comment.c.id, comment.c.path])
+                                        .where(comment.c.id.in_(parent_ids))).fetchall()) if parent_ids else {}
+        for comment_id, replied_id in rows:
+            paths[comment_id] = (paths.get(replied_id) or '') + PATH_SEGMENT % comment_id
+        connection.execute(update, [dict(_id=comment_id, _path=paths[comment_id]) for comment_id, _ in rows])
+        last_id = rows[-1][0]
+
+
+def downgrade():
+    op.drop_index('ix_comment_post_id_path', table_name='comment')
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.drop_column('path')
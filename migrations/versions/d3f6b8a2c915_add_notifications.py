@@ -0,0 +1,35 @@
+"""Add notifications for digest mails
+
+Revision ID: d3f6b8a2c915
+Revises: c7a2e9d4f1b6
+Create Date: 2026-10-19 15:40:27.214000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f6b8a2c915'
+down_revision = 'c7a2e9d4f1b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('notification',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('recipient', sa.String(length=254), nullable=False),
+    sa.Column('kind', sa.String(length=10), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=True),
+    sa.Column('post_title', sa.String(length=60), nullable=True),
+    sa.Column('url', sa.String(length=255), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_notification_recipient_timestamp', 'notification', ['recipient', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_notification_recipient_timestamp', table_name='notification')
+    op.drop_table('notification')
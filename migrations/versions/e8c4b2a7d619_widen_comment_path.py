@@ -0,0 +1,27 @@
+"""Store comment paths as text so reply depth is not limited
+
+Revision ID: e8c4b2a7d619
+Revises: d3f6b8a2c915
+Create Date: 2026-10-20 09:26:51.318000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8c4b2a7d619'
+down_revision = 'd3f6b8a2c915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # String(512)只能容纳56级回复，更深的回复在限制长度的数据库中写入失败或被截断，按前缀取子树的范围查询随之出错
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.alter_column('path', existing_type=sa.String(length=512), type_=sa.Text(), existing_nullable=True)
+
+
+def downgrade():
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.alter_column('path', existing_type=sa.Text(), type_=sa.String(length=512), existing_nullable=True)
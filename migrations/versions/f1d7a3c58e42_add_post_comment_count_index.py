@@ -0,0 +1,23 @@
+"""Index post comment counts for the comment total
+
+Revision ID: f1d7a3c58e42
+Revises: e8c4b2a7d619
+Create Date: 2026-10-20 10:05:14.902000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1d7a3c58e42'
+down_revision = 'e8c4b2a7d619'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_post_comment_count', 'post', ['comment_count'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_comment_count', table_name='post')
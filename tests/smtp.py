@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+测试用的本地SMTP服务器，只实现发信需要的命令，收到的邮件保存在messages列表中
+"""
+import socketserver
+import threading
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.sender, self.recipients = None, []
+        self.reply('220 localhost test SMTP')
+        while True:
+            line = self.rfile.readline().decode().rstrip('\r\n')
+            command = getattr(self, 'smtp_' + line[:4].upper(), self.smtp_NOOP)
+            if not line or command(line) is False:
+                return
+
+    def smtp_EHLO(self, line):
+        self.reply('250 localhost')
+
+    smtp_HELO = smtp_EHLO
+
+    def smtp_MAIL(self, line):
+        self.sender, self.recipients = line.split(':', 1)[1].strip(), []
+        self.reply('250 OK')
+
+    def smtp_RCPT(self, line):
+        recipient = line.split(':', 1)[1].strip().strip('<>')
+        if recipient in self.server.rejected:
+            return self.reply('550 No such user')
+        self.recipients.append(recipient)
+        self.reply('250 OK')
+
+    def smtp_DATA(self, line):
+        self.reply('354 End data with <CR><LF>.<CR><LF>')
+        lines = []
+        for data in iter(self.rfile.readline, b''):
+            if data == b'.\r\n':
+                break
+            lines.append(data.decode())
+        self.server.messages.append((self.sender, self.recipients, ''.join(lines)))
+        self.reply('250 OK')
+
+    def smtp_QUIT(self, line):
+        self.reply('221 Bye')
+        return False
+
+    def smtp_NOOP(self, line):    # RSET、NOOP等
+        self.reply('250 OK')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _SMTPHandler)
+        self.messages = []
+        self.rejected = set()
+        self.connections = 0
+        self.port = self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
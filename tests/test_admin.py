@@ -5,14 +5,36 @@
     :copyright: © 2018 Grey Li <withlihui@gmail.com>
     :license: MIT, see LICENSE for more details.
 """
-from flask import url_for
+import hashlib
+import io
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+import zlib
+from datetime import datetime
+
+from flask import url_for, current_app
 
 from bluelog.models import Post, Category, Link, Comment
-from bluelog.extensions import db
+from bluelog.extensions import db, query_sampler
+from bluelog.profiling import QueryBudget, QueryBudgetExceeded, statement_shape
+from bluelog.uploads import Image, submit
 
 from tests.base import BaseTestCase
 
 
+def png_bytes(width, height):
+    """生成一张纯色的PNG图片"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\x00' + b'\x1e\x90\xff' * width for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
 class AdminTestCase(BaseTestCase):
 
     def setUp(self):
@@ -41,6 +63,32 @@ class AdminTestCase(BaseTestCase):
         self.assertIn('Something', data)
         self.assertIn('Hello, world.', data)
 
+    def test_post_rendered_fields(self):
+        self.client.post(url_for('admin.new_post'), data=dict(
+            title='Rendered',
+            category=1,
+            body='<p onclick="steal()">Hello <b>world</b> 你好</p><script>alert(1)</script>'
+                 '<a href="javascript:alert(1)">link</a><img src="http://[x">'
+        ))
+        post = Post.query.filter_by(title='Rendered').first()
+        self.assertEqual(post.body_html, '<p>Hello <b>world</b> 你好</p><a>link</a><img>')   # 无法解析的URL也去掉
+        self.assertEqual(post.body_text, 'Hello world 你好\nlink')
+        self.assertEqual(post.excerpt, 'Hello world 你好 link')
+        self.assertEqual(post.word_count, 5)
+        self.assertEqual(post.reading_time, 1)
+
+        response = self.client.get(url_for('blog.show_post', post_id=post.id))
+        self.assertNotIn('alert(1)', response.get_data(as_text=True))
+
+        self.client.post(url_for('admin.edit_post', post_id=post.id), data=dict(
+            title='Rendered',
+            category=1,
+            body=' '.join(['word'] * 700)
+        ))
+        self.assertEqual(post.word_count, 700)
+        self.assertEqual(post.reading_time, 3)
+        self.assertTrue(post.excerpt.endswith('...'))
+
     def test_edit_post(self):
         response = self.client.get(url_for('admin.edit_post', post_id=1))
         data = response.get_data(as_text=True)
@@ -123,6 +171,81 @@ class AdminTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('I am a guest comment.', data)
 
+    def test_post_and_comment_counters(self):
+        self.assertEqual(Category.query.get(1).post_count, 1)
+        self.assertEqual(Post.query.get(1).comment_count, 0)
+
+        self.client.post(url_for('admin.approve_comment', comment_id=1))
+        self.assertEqual(Post.query.get(1).comment_count, 1)
+
+        self.client.post(url_for('admin.new_category'), data=dict(name='Tech'))
+        self.client.post(url_for('admin.edit_post', post_id=1), data=dict(
+            title='Hello', category=2, body='Blah...'))
+        self.assertEqual(Category.query.get(1).post_count, 0)
+        self.assertEqual(Category.query.get(2).post_count, 1)
+
+        self.client.post(url_for('admin.delete_category', category_id=2))
+        self.assertEqual(Category.query.get(1).post_count, 1)
+
+        self.client.post(url_for('admin.delete_comment', comment_id=1))
+        self.assertEqual(Post.query.get(1).comment_count, 0)
+
+        reply = Comment(body='A reply', post_id=1, reviewed=True, replied=Comment(body='B', post_id=1, reviewed=True))
+        db.session.add(reply)
+        db.session.commit()
+        self.assertEqual(Post.query.get(1).comment_count, 2)
+        self.client.post(url_for('admin.delete_comment', comment_id=reply.replied_id))
+        self.assertEqual(Post.query.get(1).comment_count, 0)
+
+        self.client.post(url_for('admin.delete_post', post_id=1))
+        self.assertEqual(Category.query.get(1).post_count, 0)
+
+    def test_bulk_comments(self):
+        post = Post.query.get(1)
+        spam = [Comment(body='Spam %d' % i, post=post, timestamp=datetime(2020, 1, 1)) for i in range(3)]
+        reply = Comment(body='Reply to spam', post=post, replied=spam[0], reviewed=True)
+        reply_reply = Comment(body='Nested reply', post=post, replied=reply)
+        fresh = Comment(body='Fresh comment', post=post)
+        db.session.add_all(spam + [reply, reply_reply, fresh])
+        db.session.commit()
+        self.assertEqual(post.comment_count, 1)
+
+        response = self.client.post(url_for('admin.bulk_comments'),
+                                    data=dict(action='approve', ids=[fresh.id, spam[1].id]), follow_redirects=True)
+        self.assertIn('2条评论已审核', response.get_data(as_text=True))
+        self.assertEqual(Post.query.get(1).comment_count, 3)
+        data = self.client.get(url_for('blog.search', q='fresh')).get_data(as_text=True)
+        self.assertIn('Fresh</mark> comment', data)
+
+        # 删除时下级回复一起删除，已审核的评论从计数和搜索索引中去掉
+        response = self.client.post(url_for('admin.bulk_comments'), data=dict(action='delete', older_than=30),
+                                    follow_redirects=True)
+        self.assertIn('4条评论已删除', response.get_data(as_text=True))
+        self.assertEqual(sorted(comment.body for comment in Comment.query),
+                         ['A comment', 'Fresh comment', 'Spam 1'])
+        self.assertEqual(Post.query.get(1).comment_count, 3 - 1)
+        self.assertNotIn('Reply to spam', self.client.get(url_for('blog.search', q='reply')).get_data(as_text=True))
+
+        response = self.client.post(url_for('admin.bulk_comments'), data=dict(action='delete'), follow_redirects=True)
+        self.assertIn('No comments selected.', response.get_data(as_text=True))
+
+    def test_bulk_delete_posts(self):
+        category = Category(name='Tech')
+        posts = [Post(title='Flask %d' % i, body='Flask post', category=category) for i in range(3)]
+        db.session.add_all(posts + [Comment(body='A flask comment', post=posts[0], reviewed=True)])
+        db.session.commit()
+        ids = [posts[0].id, posts[1].id, 1]
+        kept, deleted = posts[2].id, posts[0].id
+
+        response = self.client.post(url_for('admin.bulk_delete_posts'), data=dict(ids=ids), follow_redirects=True)
+        self.assertIn('3 posts deleted.', response.get_data(as_text=True))
+        self.assertEqual([post.title for post in Post.query], ['Flask 2'])
+        self.assertEqual(Comment.query.count(), 0)
+        self.assertEqual([c.post_count for c in Category.query.order_by(Category.id)], [0, 1])
+        data = self.client.get(url_for('blog.search', q='flask')).get_data(as_text=True)
+        self.assertIn('/post/%d"' % kept, data)
+        self.assertNotIn('/post/%d"' % deleted, data)
+
     def test_new_category(self):
         response = self.client.get(url_for('admin.new_category'))
         data = response.get_data(as_text=True)
@@ -194,6 +317,8 @@ class AdminTestCase(BaseTestCase):
         self.assertIn('Category deleted.', data)
         self.assertIn('Default', data)
         self.assertNotIn('Tech', data)
+        self.assertEqual(post.category_id, 1)
+        self.assertEqual(Category.query.get(1).post_count, 2)
 
     def test_new_link(self):
         response = self.client.get(url_for('admin.new_link'))
@@ -239,9 +364,31 @@ class AdminTestCase(BaseTestCase):
         self.assertIn('Manage Posts', data)
 
     def test_manage_comment_page(self):
+        category = Category.query.get(1)
+        for i in range(10):
+            post = Post(title='Post %d' % i, body='Blah', category=category)
+            db.session.add(Comment(body='Comment %d' % i, post=post, reviewed=i % 2 == 0))
+        db.session.commit()
+        db.session.remove()
+        # 测试配置中查询数超出预算或出现N+1查询会抛出QueryBudgetExceeded
         response = self.client.get(url_for('admin.manage_comment'))
         data = response.get_data(as_text=True)
         self.assertIn('Manage Comments', data)
+        # 总数由文章评论计数(已审核)和未读评论数得出
+        total = Comment.query.count()
+        self.assertIn('<small class="text-muted">%d</small>' % total, data)
+
+    def test_query_budget(self):
+        current_app.config['BLUELOG_QUERY_BUDGETS'] = {'admin.manage_link': 1}
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get(url_for('admin.manage_link'))
+
+        statements = ['SELECT category.name FROM category WHERE category.id = ?'] * 6
+        messages = QueryBudget.violations('blog.index', statements)
+        self.assertEqual(len(messages), 1)
+        self.assertIn('repeated a query 6 times (possible N+1)', messages[0])
+        self.assertEqual(statement_shape('SELECT * FROM post WHERE id IN (?, ?,\n ?)'),
+                         statement_shape('SELECT * FROM post WHERE id IN (?)'))
 
     def test_manage_category_page(self):
         response = self.client.get(url_for('admin.manage_category'))
@@ -253,6 +400,23 @@ class AdminTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('Manage Links', data)
 
+    def test_slow_queries(self):
+        query_sampler.sample_rate, query_sampler.threshold = 1, 0
+        self.client.get(url_for('blog.show_post', post_id=1))
+        stats = query_sampler.top()
+        self.assertTrue(stats)
+        self.assertIn('blog.show_post', [endpoint for item in stats for endpoint in item.endpoints])
+        self.assertTrue(any(item.last.plan and 'SEARCH' in item.last.plan for item in stats))
+
+        response = self.client.get(url_for('admin.slow_queries'))
+        data = response.get_data(as_text=True)
+        self.assertIn('Slow Queries', data)
+        self.assertIn('FROM post', data)
+
+        query_sampler.sample_rate = 0
+        response = self.client.post(url_for('admin.slow_queries'), follow_redirects=True)
+        self.assertIn('No slow queries.', response.get_data(as_text=True))
+
     def test_blog_setting(self):
         response = self.client.post(url_for('admin.settings'), data=dict(
             name='Grey Li',
@@ -273,3 +437,90 @@ class AdminTestCase(BaseTestCase):
         response = self.client.get(url_for('blog.about'), follow_redirects=True)
         data = response.get_data(as_text=True)
         self.assertIn('Example about page', data)
+
+    def upload(self, content, filename='image.png'):
+        response = self.client.post(url_for('admin.upload_image'), data=dict(upload=(io.BytesIO(content), filename)))
+        return response.get_json()
+
+    def upload_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        current_app.config['BLUELOG_UPLOAD_PATH'] = directory
+        return directory
+
+    def test_upload_image(self):
+        directory = self.upload_directory()
+        content = png_bytes(8, 8)
+        digest = hashlib.sha256(content).hexdigest()
+        result = self.upload(content, 'evil.html')
+        self.assertEqual(result['uploaded'], 1)
+        self.assertRegex(result['filename'], r'^%s/%s/%s(-8w)?\.png$' % (digest[:2], digest[2:4], digest))
+        self.assertTrue(os.path.exists(os.path.join(directory, digest[:2], digest[2:4], digest + '.png')))
+        response = self.client.get(result['url'])
+        self.assertEqual(response.data[:8], b'\x89PNG\r\n\x1a\n')
+        self.assertIn('Accept', response.headers['Vary'])
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response.close()
+
+        # 相同的图片只保存一份
+        files = sorted(os.path.join(root, name) for root, dirs, names in os.walk(directory) for name in names)
+        self.assertEqual(self.upload(content, 'copy.png')['url'], result['url'])
+        self.assertEqual(sorted(os.path.join(root, name) for root, dirs, names in os.walk(directory)
+                                for name in names), files)
+
+        result = self.upload(b'<script>alert(1)</script>', 'image.png')
+        self.assertEqual(result['uploaded'], 0)
+
+        current_app.config['BLUELOG_UPLOAD_MAX_BYTES'] = 100
+        result = self.upload(png_bytes(64, 64))
+        self.assertEqual(result['uploaded'], 0)
+        self.assertIn('too large', result['error']['message'])
+        self.assertEqual(len(os.listdir(directory)), 1)     # 只有第一张图片的分片目录
+
+    def test_responsive_image(self):
+        post = Post.query.get(1)
+        name = 'aa/aa/' + 'a' * 64
+        post.body = '<img src="/admin/uploads/%s-640w.jpg" srcset="https://evil.example/x.jpg 1w">' % name
+        self.assertIn('srcset="/admin/uploads/%s-320w.jpg 320w, /admin/uploads/%s-640w.jpg 640w" '
+                      'sizes="(max-width: 640px) 100vw, 640px"' % (name, name), post.body_html)
+        self.assertNotIn('evil', post.body_html)
+
+    def test_upload_requires_login(self):
+        self.logout()
+        response = self.client.post(url_for('admin.upload_image'),
+                                    data=dict(upload=(io.BytesIO(png_bytes(8, 8)), 'image.png')))
+        self.assertNotEqual(response.status_code, 200)
+
+    def test_background_failure_logged(self):
+        missing = os.path.join(tempfile.mkdtemp(), 'missing.png')
+        self.addCleanup(os.rmdir, os.path.dirname(missing))
+        with self.assertLogs('bluelog', 'ERROR') as logs:
+            future = submit(os.remove, missing, workers=1)
+            self.assertRaises(FileNotFoundError, future.result)
+            for _ in range(100):    # 回调在结果设置之后执行
+                if logs.records:
+                    break
+                time.sleep(0.01)
+        self.assertIn('Background task remove', logs.output[0])
+        self.assertIn('FileNotFoundError', logs.output[0])
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_image_variants(self):
+        current_app.config['BLUELOG_IMAGE_DISPLAY_WIDTH'] = 640
+        directory = self.upload_directory()
+        result = self.upload(png_bytes(1000, 500))
+        name = result['filename'].split('-')[0]
+        self.assertEqual(result['filename'], name + '-640w.png')
+        suffixes = ('.png', '-320w.png', '-320w.webp', '-640w.png', '-640w.webp')
+        self.assertEqual(sorted(os.listdir(os.path.join(directory, os.path.dirname(name)))),
+                         sorted(os.path.basename(name) + suffix for suffix in suffixes))
+        with Image.open(os.path.join(directory, name + '-320w.png')) as image:
+            self.assertEqual(image.size, (320, 160))
+        response = self.client.get(result['url'], headers={'Accept': 'image/webp,*/*'})
+        self.assertEqual(response.mimetype, 'image/webp')
+        response.close()
+
+        post = Post.query.get(1)
+        post.body = '<img src="%s">' % result['url']
+        db.session.commit()
+        self.assertIn('%s-320w.png 320w' % name, post.body_html)
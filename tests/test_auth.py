@@ -5,8 +5,15 @@
     :copyright: © 2018 Grey Li <withlihui@gmail.com>
     :license: MIT, see LICENSE for more details.
 """
-from flask import url_for
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
+from flask import url_for, current_app
+from flask_login import current_user
+from sqlalchemy import event
+
+from bluelog.extensions import db, metrics, login_guard
 from tests.base import BaseTestCase
 
 
@@ -32,3 +39,48 @@ class AuthTestCase(BaseTestCase):
         response = self.client.get(url_for('admin.settings'), follow_redirects=True)
         data = response.get_data(as_text=True)
         self.assertIn('Please log in to access this page.', data)
+
+    def test_login_throttled(self):
+        for i in range(5):
+            self.assertEqual(self.login(username='grey', password='wrong-password').status_code, 200)
+        response = self.login()     # 失败次数过多后正确的密码也不再验证
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('登录失败次数过多', response.get_data(as_text=True))
+        self.assertIn('bluelog_login_attempts_total{result="throttled"} 1', metrics.render())
+
+    def test_login_slot_released_when_submit_fails(self):
+        with mock.patch.object(ThreadPoolExecutor, 'submit', side_effect=RuntimeError('shutdown')):
+            for i in range(current_app.config['BLUELOG_LOGIN_WORKERS'] + current_app.config['BLUELOG_LOGIN_QUEUE']):
+                self.assertRaises(RuntimeError, login_guard.attempt, '127.0.0.1', 'grey', 'hash', '123')
+        response = self.login()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('登录请求过多', response.get_data(as_text=True))
+
+    def test_login_timeout(self):
+        current_app.config['BLUELOG_LOGIN_TIMEOUT'] = 0.05
+        login_guard.init_app(current_app)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with mock.patch('bluelog.security.check_credentials', side_effect=lambda *args: release.wait(5)):
+            response = self.login()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('bluelog_login_attempts_total{result="busy"} 1', metrics.render())
+
+    def test_user_loader_cache(self):
+        self.login()
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', record)
+        self.client.get(url_for('admin.settings'))
+        self.assertFalse([statement for statement in statements if 'FROM admin' in statement])
+
+        # 修改设置后缓存的管理员快照失效，后续请求看到新的名字
+        self.client.post(url_for('admin.settings'), data=dict(
+            name='Grey', blog_title='My Blog', blog_sub_title='Just some raw ideas.', about='Example about page'))
+        self.assertIn('value="Grey"', self.client.get(url_for('admin.settings')).get_data(as_text=True))
+        with self.assertRaises(AttributeError):
+            current_user.password_hash
@@ -5,8 +5,19 @@
     :copyright: © 2018 Grey Li <withlihui@gmail.com>
     :license: MIT, see LICENSE for more details.
 """
+import os
+import shutil
+import tempfile
+import time
+
 from flask import current_app
+from sqlalchemy.pool import QueuePool
+
+from bluelog import create_app
 
+from bluelog.caching import CachedPage, MemoryBackend, FileSystemBackend
+from bluelog.extensions import db, context_cache, sqlite_profile
+from bluelog.models import Admin, Link
 from tests.base import BaseTestCase
 
 
@@ -23,3 +34,103 @@ class BasicTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertEqual(response.status_code, 404)
         self.assertIn('404 Error', data)
+
+    def test_template_context_cache(self):
+        context_cache.clear()
+        self.client.get('/')
+        self.assertEqual(context_cache.stats()['misses'], 3)
+        self.client.get('/about')
+        self.assertEqual(context_cache.stats()['hits'], 3)
+        self.assertEqual(context_cache.stats()['misses'], 3)
+
+    def test_template_context_cache_invalidation(self):
+        self.client.get('/')
+        db.session.add(Link(name='HelloFlask', url='http://helloflask.com'))
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertIn('HelloFlask', response.get_data(as_text=True))
+
+        admin = Admin.query.first()
+        admin.blog_title = 'Cached Title'
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertIn('Cached Title', response.get_data(as_text=True))
+
+    def test_template_context_cache_rollback(self):
+        self.client.get('/')
+        db.session.add(Link(name='HelloFlask', url='http://helloflask.com'))
+        db.session.flush()
+        db.session.rollback()
+        self.client.get('/')
+        self.assertEqual(context_cache.stats()['misses'], 3)
+
+    def test_memory_page_cache_backend(self):
+        backend = MemoryBackend(max_bytes=10)
+        backend.set('a', CachedPage(b'12345', 'text/html', False), ['post:1'], None)
+        backend.set('b', CachedPage(b'12345', 'text/html', False), ['post:2'], None)
+        self.assertIsNotNone(backend.get('a'))
+        backend.set('c', CachedPage(b'12345', 'text/html', False), ['post:3'], None)
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.size, 10)
+
+        backend.invalidate(['post:1'])
+        self.assertIsNone(backend.get('a'))
+        self.assertIsNotNone(backend.get('c'))
+
+    def test_filesystem_page_cache_backend(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        backend = FileSystemBackend(cache_dir)
+        other_process = FileSystemBackend(cache_dir)
+        backend.set('a', CachedPage(b'page a', 'text/html', False), ['post:1'], None)
+        backend.set('b', CachedPage(b'page b', 'text/html', False), ['post:2'], None)
+        self.assertEqual(other_process.get('a').body, b'page a')
+
+        other_process.invalidate(['post:1'])
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('b').body, b'page b')
+
+        other_process.clear()
+        self.assertIsNone(backend.get('b'))
+
+        backend.set('c', CachedPage(b'page c', 'text/html', False), [], 0.01)
+        time.sleep(0.02)
+        self.assertIsNone(backend.get('c'))
+
+    def test_filesystem_page_cache_prune(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        backend = FileSystemBackend(cache_dir, max_entries=4, prune_every=3)
+        for i in range(5):
+            backend.set(str(i), CachedPage(b'page', 'text/html', False), [], None)
+        # 第3次写入时还没有超出上限，之后的写入不扫描目录
+        self.assertEqual(len([entry for entry in os.scandir(cache_dir) if entry.is_file()]), 5)
+        backend.set('5', CachedPage(b'page', 'text/html', False), [], None)
+        self.assertEqual(len([entry for entry in os.scandir(cache_dir) if entry.is_file()]), 4)
+
+    def sqlite_file_app(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = create_app('testing')
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'test.db')
+        sqlite_profile.init_app(app)
+        return app
+
+    def test_sqlite_profile(self):
+        with self.sqlite_file_app().app_context():
+            self.assertIsInstance(db.engine.pool, QueuePool)
+            pragmas = [db.engine.execute('PRAGMA %s' % name).scalar()
+                       for name in ('journal_mode', 'synchronous', 'busy_timeout', 'temp_store')]
+            self.assertEqual(pragmas, ['wal', 1, 5000, 2])
+            db.engine.dispose()
+
+    def test_sqlite_connection_not_shared_across_processes(self):
+        with self.sqlite_file_app().app_context():
+            connection = db.engine.raw_connection()
+            parent = connection.connection
+            connection._connection_record.info['pid'] = os.getpid() + 1     # 模拟fork前父进程打开的连接
+            connection.close()
+            connection = db.engine.raw_connection()
+            self.assertIsNot(connection.connection, parent)
+            connection.close()
+            db.engine.dispose()
@@ -5,10 +5,21 @@
     :copyright: © 2018 Grey Li <withlihui@gmail.com>
     :license: MIT, see LICENSE for more details.
 """
-from flask import url_for
+import json
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
 
-from bluelog.models import Post, Category, Link, Comment
-from bluelog.extensions import db
+from flask import url_for, current_app
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from bluelog.models import Post, Category, Link, Comment, Notification
+from bluelog.extensions import db, comment_spool, metrics
+from bluelog.queries import post_listing, comment_threads
 
 from tests.base import BaseTestCase
 
@@ -125,3 +136,269 @@ class BlogTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('Thanks, your comment will be published after reviewed.', data)
         self.assertNotIn('I am a guest comment.', data)
+
+    def test_page_cache(self):
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Page-Cache'], 'BYPASS')
+
+        self.logout()
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Page-Cache'], 'HIT')
+        self.assertIn('Hello Post', response.get_data(as_text=True))
+
+        self.client.set_cookie('localhost', 'theme', 'black_swan')
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+        self.assertIn('css/black_swan.min.css', response.get_data(as_text=True))
+
+    def test_page_cache_invalidation(self):
+        self.logout()
+        self.client.get(url_for('blog.show_post', post_id=1))
+        self.client.get(url_for('blog.show_category', category_id=1))
+        self.client.get(url_for('blog.about'))
+
+        post = Post.query.get(1)
+        db.session.add(Comment(body='A new comment', post=post, reviewed=True))
+        db.session.commit()
+        response = self.client.get(url_for('blog.show_post', post_id=1))
+        self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+        self.assertIn('A new comment', response.get_data(as_text=True))
+        response = self.client.get(url_for('blog.show_category', category_id=1))
+        self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+        response = self.client.get(url_for('blog.about'))
+        self.assertEqual(response.headers['X-Page-Cache'], 'HIT')
+
+        db.session.add(Comment(body='An unreviewed comment', post=post))
+        db.session.commit()
+        response = self.client.get(url_for('blog.show_post', post_id=1))
+        self.assertEqual(response.headers['X-Page-Cache'], 'HIT')
+
+        db.session.add(Link(name='HelloFlask', url='http://helloflask.com'))
+        db.session.commit()
+        response = self.client.get(url_for('blog.about'))
+        self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+        self.assertIn('HelloFlask', response.get_data(as_text=True))
+
+    def test_page_cache_csrf_token(self):
+        current_app.config['WTF_CSRF_ENABLED'] = True
+        self.logout()
+        self.client.get(url_for('blog.show_post', post_id=1))
+        response = self.client.get(url_for('blog.show_post', post_id=1))
+        data = response.get_data(as_text=True)
+        self.assertEqual(response.headers['X-Page-Cache'], 'HIT')
+        self.assertIn('name="csrf_token"', data)
+        self.assertNotIn('__bluelog_csrf_token__', data)
+
+    def test_comment_paths(self):
+        post = Post.query.get(1)
+        root = Comment.query.get(1)
+        hidden = Comment(body='Unreviewed reply', post=post, replied=root)
+        db.session.add(hidden)
+        db.session.commit()
+        reply = Comment(body='Reply to unreviewed', post=post, replied=hidden, reviewed=True)
+        db.session.add(reply)
+        db.session.commit()
+        self.assertEqual(reply.path, '%08x/%08x/%08x/' % (root.id, hidden.id, reply.id))
+
+        ordered, depths = comment_threads([root])
+        self.assertEqual(ordered, [root])   # 上级评论未审核的回复不显示
+        self.assertEqual(depths, {root.id: 0})
+
+    def test_comments_without_path(self):
+        # 绕过模型事件插入的评论没有物化路径，按replied_id查找回复
+        comment = Comment.__table__
+        db.session.execute(comment.insert(), [
+            dict(id=10, body='Core root', post_id=1, replied_id=None, reviewed=True, timestamp=datetime(2018, 1, 1)),
+            dict(id=11, body='Core reply', post_id=1, replied_id=10, reviewed=True, timestamp=datetime(2018, 1, 2))])
+        db.session.commit()
+        root = Comment.query.get(10)
+        ordered, depths = comment_threads([root])
+        self.assertEqual([c.id for c in ordered], [10, 11])
+        self.assertEqual(depths, {10: 0, 11: 1})
+        self.assertEqual(self.client.get(url_for('blog.show_post', post_id=1, view='thread')).status_code, 200)
+
+        self.client.post(url_for('admin.delete_comment', comment_id=10))
+        self.assertEqual(Comment.query.filter(Comment.id.in_([10, 11])).count(), 0)
+
+    def test_post_listing_rows(self):
+        row = post_listing().first()
+        self.assertEqual((row.title, row.category_name), ('Hello Post', 'Default'))
+        self.assertNotIn('body', row.keys())
+
+        data = self.client.get(url_for('blog.index')).get_data(as_text=True)
+        self.assertIn('href="/category/1">Default</a>', data)
+
+    def test_comment_queries(self):
+        post = Post.query.get(1)
+        parent = Comment.query.get(1)
+        for i in range(5):
+            parent = Comment(body='Reply %d' % i, post=post, replied=parent, reviewed=True)
+            db.session.add(parent)
+        db.session.commit()
+        db.session.remove()
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            if 'FROM comment' in statement and 'count(' not in statement:
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            flat = self.client.get(url_for('blog.show_post', post_id=1)).get_data(as_text=True)
+            self.assertEqual(len(statements), 1)
+            del statements[:]
+            threaded = self.client.get(url_for('blog.show_post', post_id=1, view='thread')).get_data(as_text=True)
+            self.assertEqual(len(statements), 2)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertIn('Reply 4', flat)
+        positions = [threaded.index('Reply %d' % i) for i in range(5)]
+        self.assertEqual(positions, sorted(positions))
+        self.assertIn('margin-left: 10rem', threaded)
+
+    def test_search(self):
+        current_app.config['BLUELOG_SEARCH_RESULT_PER_PAGE'] = 2
+        post = Post.query.get(1)
+        db.session.add_all([
+            Post(title='Flask tips', body='<p>Use the <b>application factory</b>.</p>', category=post.category),
+            Post(title='Other', body='<p>Nothing about flask here, <i>&lt;b&gt;</i></p>', category=post.category),
+            Comment(body='Flask is great', post=post, reviewed=True),
+            Comment(body='Flask spam', post=post),
+        ])
+        db.session.commit()
+
+        data = self.client.get(url_for('blog.search', q='flask')).get_data(as_text=True)
+        self.assertIn('<mark>Flask</mark> tips', data)   # 标题匹配排在最前
+        self.assertNotIn('<b>', data.split('page-header')[1])
+        data += self.client.get(url_for('blog.search', q='flask', page=2)).get_data(as_text=True)
+        self.assertIn('&lt;b&gt;', data)
+        self.assertIn('<mark>Flask</mark> is great', data)
+        self.assertNotIn('spam', data)
+
+        post.title = 'Renamed'
+        db.session.commit()
+        data = self.client.get(url_for('blog.search', q='renamed')).get_data(as_text=True)
+        self.assertIn('<mark>Renamed</mark>', data)
+
+        db.session.delete(post)
+        db.session.commit()
+        data = self.client.get(url_for('blog.search', q='great')).get_data(as_text=True)
+        self.assertIn('No results.', data)
+
+        response = self.client.get(url_for('blog.search', q='"unbalanced'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_keyset_pagination(self):
+        current_app.config['BLUELOG_KEYSET_OFFSET_PAGES'] = 1
+        current_app.config['BLUELOG_POST_PER_PAGE'] = 4
+        category = Category.query.get(1)
+        base = datetime(2018, 1, 1)
+        # 每两篇文章时间相同，翻页时需要靠id区分先后
+        for i in range(10):
+            db.session.add(Post(title='Post %02d' % i, body='...', category=category,
+                                timestamp=base + timedelta(days=i // 2)))
+        db.session.commit()
+        expected = [post.title for post in Post.query.order_by(Post.timestamp.desc(), Post.id.desc())]
+
+        seen = []
+        url = url_for('blog.index')
+        pages = []
+        while url:
+            data = self.client.get(url).get_data(as_text=True)
+            pages.append(data)
+            seen.extend(re.findall(r'(Hello Post|Post \d\d)</a>', data))
+            links = re.findall(r'href="([^"]*)">\s*Next', data)
+            url = links[0].replace('&amp;', '&') if links and links[0] != '#' else None
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(pages), 3)
+        self.assertIn('after=', pages[1])
+
+        prev = re.findall(r'href="([^"]*)">\s*<span aria-hidden="true">&larr;', pages[2])[0].replace('&amp;', '&')
+        self.assertIn('before=', prev)
+        data = self.client.get(prev).get_data(as_text=True)
+        self.assertEqual(re.findall(r'(Hello Post|Post \d\d)</a>', data), expected[4:8])
+
+        response = self.client.get(url_for('blog.index', page=2, after='not-a-cursor'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_comment_spool(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        current_app.config.update(BLUELOG_COMMENT_SPOOL=directory, BLUELOG_COMMENT_SPOOL_INTERVAL=0,
+                                  BLUELOG_EMAIL='admin@example.com')
+        comment_spool.init_app(current_app)
+        Comment.query.get(1).email = 'grey@example.com'
+        db.session.commit()
+        self.logout()
+        for suffix in ('', '?reply=1'):
+            response = self.client.post(url_for('blog.show_post', post_id=1) + suffix, data=dict(
+                author='Guest', email='a@b.com', site='http://greyli.com', body='Spooled comment%s.' % suffix),
+                follow_redirects=True)
+            self.assertIn('Thanks, your comment will be published after reviewed.', response.get_data(as_text=True))
+        # 请求只写入了队列文件
+        self.assertEqual(Comment.query.filter(Comment.body.like('Spooled%')).count(), 0)
+        self.assertIn('bluelog_comment_spool_depth 2', metrics.render())
+
+        result = self.runner.invoke(args=['flush-comments'])
+        self.assertIn('Flushed 2 comments.', result.output)
+        comment, reply = Comment.query.filter(Comment.body.like('Spooled%')).order_by(Comment.id).all()
+        self.assertFalse(comment.reviewed)
+        self.assertEqual(reply.replied_id, 1)
+        self.assertTrue(reply.path.startswith(Comment.query.get(1).path))
+        self.assertEqual(Notification.query.filter_by(kind='comment').count(), 2)
+        self.assertEqual(Notification.query.filter_by(kind='reply', recipient='grey@example.com').count(), 1)
+
+        # 写入数据库后、删除队列文件前崩溃时，重新读取的评论被跳过
+        comment_spool.append(dict(author='Guest', email='a@b.com', site='http://greyli.com', body='Spooled comment.',
+                                  post_id=1, replied_id=None, timestamp=comment.timestamp.isoformat(),
+                                  url_root='http://localhost/'))
+        self.assertEqual(comment_spool.flush(), 1)
+        self.assertEqual(Comment.query.filter(Comment.body.like('Spooled%')).count(), 2)
+        data = metrics.render()
+        self.assertIn('bluelog_comment_spool_written_total{result="skipped"} 1', data)
+        self.assertIn('bluelog_comment_spool_depth 0', data)
+
+    def test_comment_spool_bad_records(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        current_app.config.update(BLUELOG_COMMENT_SPOOL=directory, BLUELOG_COMMENT_SPOOL_INTERVAL=0)
+        comment_spool.init_app(current_app)
+        record = dict(author='Guest', email='a@b.com', site='http://greyli.com', body='Spooled comment.', post_id=1,
+                      replied_id=None, timestamp='2020-01-01T00:00:00', url_root='http://localhost/')
+        # 无法解析的行被跳过，同一个文件中的其他评论正常写入
+        with open(os.path.join(directory, 'a.jsonl'), 'wb') as f:
+            f.write(b'{"author": \xff\n' + (json.dumps(record) + '\n').encode('utf-8'))
+        self.assertEqual(comment_spool.flush(), 1)
+        self.assertEqual(Comment.query.filter_by(body='Spooled comment.').count(), 1)
+
+        # 数据库暂时不可用时文件保留，不算作失败
+        with open(os.path.join(directory, 'b.jsonl'), 'w') as f:
+            for body in ('First comment.', 'Bad comment.', 'Last comment.'):
+                timestamp = 'not-a-time' if body == 'Bad comment.' else record['timestamp']
+                f.write(json.dumps(dict(record, body=body, timestamp=timestamp)) + '\n')
+        locked = OperationalError('INSERT', {}, Exception('database is locked'))
+        with mock.patch.object(comment_spool, '_writer', side_effect=locked):
+            for attempt in range(20):
+                self.assertRaises(OperationalError, comment_spool.flush)
+        self.assertEqual(sorted(os.listdir(directory)), ['b.jsonl'])
+
+        # 单独写入也失败的记录放入.failed文件，同一批中的其他评论正常写入
+        self.assertEqual(comment_spool.flush(), 3)
+        self.assertEqual(Comment.query.filter(Comment.body.in_(['First comment.', 'Last comment.'])).count(), 2)
+        self.assertEqual(sorted(os.listdir(directory)), ['b.failed'])
+        with open(os.path.join(directory, 'b.failed')) as f:
+            self.assertEqual([json.loads(line)['body'] for line in f], ['Bad comment.'])
+        self.assertIn('bluelog_comment_spool_written_total{result="failed"} 1', metrics.render())
+
+        # 排查后重新写入
+        with open(os.path.join(directory, 'b.failed'), 'w') as f:
+            f.write(json.dumps(dict(record, body='Bad comment.')) + '\n')
+        result = self.runner.invoke(args=['flush-comments', '--retry-failed'])
+        self.assertIn('Retrying 1 failed files.', result.output)
+        self.assertIn('Flushed 1 comments.', result.output)
+        self.assertEqual(Comment.query.filter_by(body='Bad comment.').count(), 1)
+        self.assertEqual(os.listdir(directory), [])
@@ -5,6 +5,13 @@
     :copyright: © 2018 Grey Li <withlihui@gmail.com>
     :license: MIT, see LICENSE for more details.
 """
+import os
+import shutil
+import tempfile
+import time
+
+from flask import current_app
+
 from bluelog.models import Admin, Post, Category, Comment
 from bluelog.extensions import db
 from tests.base import BaseTestCase
@@ -43,6 +50,51 @@ class CLITestCase(BaseTestCase):
         self.assertEqual(Admin.query.first().username, 'new grey')
         self.assertEqual(Category.query.first().name, 'Default')
 
+    def test_recount_command(self):
+        db.create_all()
+        category = Category(name='Default')
+        post = Post(title='Hello', category=category)
+        db.session.add_all([category, post, Comment(body='A', post=post, reviewed=True), Comment(body='B', post=post)])
+        db.session.commit()
+        db.session.execute(Category.__table__.update().values(post_count=5))
+        db.session.execute(Post.__table__.update().values(comment_count=5))
+        db.session.commit()
+
+        result = self.runner.invoke(args=['recount'])
+        self.assertIn('Done.', result.output)
+        self.assertEqual(Category.query.first().post_count, 1)
+        self.assertEqual(Post.query.first().comment_count, 1)
+
+    def test_rerender_command(self):
+        db.create_all()
+        category = Category(name='Default')
+        db.session.add_all([Post(title='Post %d' % i, body='<p>Hello <b>world</b></p>', category=category)
+                            for i in range(3)])
+        db.session.commit()
+        db.session.execute(Post.__table__.update().values(body_html=None, excerpt=None, word_count=0))
+        db.session.commit()
+
+        result = self.runner.invoke(args=['rerender', '--batch-size', '2'])
+        self.assertIn('Rendered 3 posts.', result.output)
+        db.session.expire_all()
+        for post in Post.query.all():
+            self.assertEqual(post.body_html, '<p>Hello <b>world</b></p>')
+            self.assertEqual(post.excerpt, 'Hello world')
+            self.assertEqual(post.word_count, 2)
+
+    def test_reindex_command(self):
+        db.create_all()
+        post = Post(title='Hello', body='<p>Search me</p>', category=Category(name='Default'))
+        db.session.add_all([post, Comment(body='A', post=post, reviewed=True), Comment(body='B', post=post)])
+        db.session.commit()
+        db.session.execute('DELETE FROM search_index')
+        db.session.commit()
+
+        result = self.runner.invoke(args=['reindex', '--batch-size', '1'])
+        self.assertIn('Indexed 1 posts and 1 comments.', result.output)
+        self.assertEqual(db.session.execute("SELECT rowid FROM search_index WHERE search_index MATCH 'search'")
+                         .fetchall(), [(2,)])
+
     def test_forge_command(self):
         result = self.runner.invoke(args=['forge'])
 
@@ -77,3 +129,71 @@ class CLITestCase(BaseTestCase):
 
         self.assertIn('Generating links...', result.output)
         self.assertIn('Done.', result.output)
+
+    def forge_snapshot(self, *args):
+        result = self.runner.invoke(args=['forge', '--post', '20', '--comment', '100', '--seed', '42'] + list(args))
+        self.assertIn('Done.', result.output)
+        posts = [(p.title, p.category_id, p.timestamp, p.comment_count) for p in Post.query.order_by(Post.id)]
+        comments = [(c.author, c.post_id, c.replied_id, c.reviewed) for c in Comment.query.order_by(Comment.id)]
+        categories = [(c.name, c.post_count) for c in Category.query.order_by(Category.id)]
+        return posts, comments, categories
+
+    def test_forge_command_with_seed(self):
+        first = self.forge_snapshot()
+        self.assertEqual(first, self.forge_snapshot('--workers', '2'))
+        # 回复与被回复的评论属于同一篇文章
+        for comment in Comment.query.filter(Comment.replied_id.isnot(None)):
+            self.assertEqual(comment.post_id, comment.replied.post_id)
+        # 批量更新的计数与重新统计的结果一致
+        self.runner.invoke(args=['recount'])
+        self.assertEqual(first[2], [(c.name, c.post_count) for c in Category.query.order_by(Category.id)])
+        self.assertEqual([p[3] for p in first[0]], [p.comment_count for p in Post.query.order_by(Post.id)])
+
+    def test_index_advisor_command(self):
+        self.runner.invoke(args=['forge', '--post', '20', '--comment', '100', '--seed', '42'])
+        result = self.runner.invoke(args=['index-advisor', '--all'])
+        self.assertIn('GET /admin/comment/manage?filter=unread', result.output)
+        self.assertIn('ix_comment_post_id_reviewed_timestamp', result.output)
+        self.assertIn('0 of ', result.output)
+
+    def test_index_advisor_missing_index(self):
+        self.runner.invoke(args=['forge', '--post', '20', '--comment', '100', '--seed', '42'])
+        db.session.execute('DROP INDEX ix_comment_reviewed_timestamp')
+        db.session.commit()
+        result = self.runner.invoke(args=['index-advisor'])
+        self.assertIn('GET /admin/comment/manage?filter=unread', result.output)
+        self.assertIn('! full scan of comment through index ix_comment_timestamp', result.output)
+        self.assertNotIn('0 of ', result.output)
+
+    def test_uploads_gc_command(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        current_app.config['BLUELOG_UPLOAD_PATH'] = directory
+        kept, orphan, fresh = 'a' * 64, 'b' * 64, 'c' * 64
+        files = ['aa/aa/%s.jpg' % kept, 'aa/aa/%s-640w.webp' % kept, 'bb/bb/%s.png' % orphan,
+                 'bb/bb/%s-320w.png' % orphan, 'cc/cc/%s.gif' % fresh, 'legacy.png', 'old.png']
+        old = time.time() - 48 * 3600
+        for filename in files:
+            path = os.path.join(directory, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'wb').close()
+            if not filename.startswith('cc/'):  # 刚上传、还没有保存到文章中的图片
+                os.utime(path, (old, old))
+        db.create_all()
+        category = Category(name='Default')
+        db.session.add_all([
+            Post(title='One', body='<img src="/admin/uploads/aa/aa/%s-640w.jpg">' % kept, category=category),
+            Post(title='Two', body='<img src="/admin/uploads/legacy.png">', category=category),
+            Post(title='Three', body='No images.', category=category),
+        ])
+        db.session.commit()
+
+        result = self.runner.invoke(args=['uploads-gc', '--batch-size', '2'])
+        self.assertIn('Found 3 unreferenced files.', result.output)
+        self.assertIn('bb/bb/%s-320w.png' % orphan, result.output)
+        self.assertEqual(len(os.listdir(directory)), 5)
+
+        result = self.runner.invoke(args=['uploads-gc', '--delete'])
+        self.assertIn('Deleted 3 unreferenced files.', result.output)
+        self.assertEqual(sorted(os.listdir(directory)), ['aa', 'cc', 'legacy.png'])
+        self.assertEqual(len(os.listdir(os.path.join(directory, 'aa', 'aa'))), 2)
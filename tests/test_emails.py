@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from unittest import mock
+
+from flask import url_for, current_app
+
+from bluelog.emails import send_mail, deliver_queued, queue_depth, flush_notifications, notify, render_digest, \
+    send_new_comment_email
+from bluelog.extensions import db
+from bluelog.models import Post, Category, QueuedMail, Notification
+from tests.base import BaseTestCase
+from tests.smtp import SMTPServer
+
+
+class EmailTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(EmailTestCase, self).setUp()
+        current_app.config.update(MAIL_SERVER='127.0.0.1', MAIL_USE_SSL=False, BLUELOG_EMAIL='admin@example.com',
+                                  MAIL_DEFAULT_SENDER='noreply@example.com', BLUELOG_MAIL_MAX_ATTEMPTS=2)
+        self.mail_state = current_app.extensions['mail']
+        self.mail_state.suppress = False    # 测试环境默认不发信
+        self.mail_state.use_ssl = False
+        db.session.add(Post(title='Hello Post', body='Blah...', category=Category(name='Default')))
+        db.session.commit()
+
+    def use_server(self, server):
+        self.mail_state.server, self.mail_state.port = '127.0.0.1', server.port
+
+    def test_comment_queues_mail(self):
+        self.client.post(url_for('blog.show_post', post_id=1), data=dict(
+            author='Guest', email='a@b.com', site='http://greyli.com', body='A guest comment.',
+        ))
+        self.assertEqual(Notification.query.one().kind, 'comment')
+        self.assertEqual(flush_notifications(), 0)  # 合并窗口还没有结束
+        self.assertEqual(flush_notifications(datetime.utcnow() + timedelta(seconds=600)), 1)
+        message = QueuedMail.query.one()    # 只有一条提醒时仍然是单条提醒邮件
+        self.assertEqual((message.subject, message.recipient), ('New comment', 'admin@example.com'))
+        self.assertIn('Hello Post', message.html)
+        self.assertEqual(queue_depth(), (1, 0))
+        self.assertEqual(Notification.query.count(), 0)
+
+    def test_notification_digest(self):
+        current_app.config.update(BLUELOG_NOTIFICATION_WINDOW=0, BLUELOG_NOTIFICATION_DIGEST_POSTS=2)
+        posts = [Post.query.get(1)] + [Post(title='Post %d' % i, body='...', category_id=1) for i in (2, 3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        for post, count in zip(posts, (3, 2, 1)):
+            for i in range(count):
+                send_new_comment_email(post)
+        notify('admin@example.com', 'reply', posts[1])
+        notify('a@b.com', 'reply', posts[0])
+        db.session.commit()
+
+        with SMTPServer() as server:
+            self.use_server(server)
+            result = self.runner.invoke(args=['mail-worker', '--once'])
+        self.assertIn('Sent 2, retry 0, failed 0.', result.output)
+        self.assertEqual(Notification.query.count(), 0)
+        messages = dict((recipients[0], data) for sender, recipients, data in server.messages)
+        self.assertIn('Subject: 6 new comments, 1 new reply', messages['admin@example.com'])
+        self.assertIn('Subject: New reply', messages['a@b.com'])
+
+    def test_notifications_taken_by_another_worker(self):
+        send_new_comment_email(Post.query.get(1))
+        db.session.commit()
+        query = Notification.query.filter_by(recipient='admin@example.com').order_by(Notification.id)
+
+        def taken(*args):   # 模拟另一个worker在查询到期收件人之后合并了这些提醒
+            Notification.query.delete()
+            return []
+
+        with mock.patch.object(type(query), 'all', taken):
+            self.assertEqual(flush_notifications(datetime.utcnow() + timedelta(seconds=600)), 0)
+        self.assertEqual(QueuedMail.query.count(), 0)
+
+    def test_digest_rendering(self):
+        notifications = [Notification(kind='comment', post_title='Post %d' % i, url='http://localhost/post/%d' % i)
+                         for i in (1, 1, 1, 2, 2, 3)] + [Notification(kind='reply', post_title='Post 2',
+                                                                      url='http://localhost/post/2')]
+        subject, html = render_digest(notifications, 2)
+        self.assertEqual(subject, '6 new comments, 1 new reply')
+        self.assertIn('<li><a href="http://localhost/post/1">Post 1</a>: 3 new comments</li>', html)
+        self.assertIn('<li><a href="http://localhost/post/2">Post 2</a>: 2 new comments, 1 new reply</li>', html)
+        self.assertNotIn('Post 3', html)    # 超出数量的文章只汇总
+        self.assertIn('And 1 more post with 1 new comment.', html)
+
+    def test_deliver_batch_over_one_connection(self):
+        for i in range(3):
+            send_mail('Subject %d' % i, 'user%d@example.com' % i, '<p>Body %d</p>' % i)
+        with SMTPServer() as server:
+            self.use_server(server)
+            self.assertEqual(deliver_queued(), (3, 0, 0))
+        self.assertEqual(server.connections, 1)
+        self.assertEqual([recipients for _, recipients, _ in server.messages],
+                         [['user0@example.com'], ['user1@example.com'], ['user2@example.com']])
+        self.assertEqual(QueuedMail.query.count(), 0)
+
+    def test_retry_with_backoff(self):
+        send_mail('Hello', 'bad@example.com', '<p>Hi</p>')
+        send_mail('Hello', 'good@example.com', '<p>Hi</p>')
+        with SMTPServer() as server:
+            server.rejected.add('bad@example.com')
+            self.use_server(server)
+            self.assertEqual(deliver_queued(), (1, 1, 0))
+            message = QueuedMail.query.one()
+            self.assertEqual((message.status, message.attempts, message.claim), ('pending', 1, None))
+            self.assertGreater(message.next_attempt, datetime.utcnow())
+            self.assertEqual(deliver_queued(), (0, 0, 0))   # 还未到重试时间
+
+            message.next_attempt = datetime.utcnow()
+            db.session.commit()
+            self.assertEqual(deliver_queued(), (0, 0, 1))
+        self.assertEqual(QueuedMail.query.one().status, 'failed')
+        self.assertEqual(queue_depth(), (0, 1))
+
+    def test_server_unavailable(self):
+        send_mail('Hello', 'user@example.com', '<p>Hi</p>')
+        with SMTPServer() as server:
+            port = server.port
+        self.mail_state.server, self.mail_state.port = '127.0.0.1', port
+        self.assertEqual(deliver_queued(), (0, 1, 0))
+        self.assertIn('Error', QueuedMail.query.one().last_error)
+
+    def test_mail_worker_command(self):
+        send_mail('Hello', 'user@example.com', '<p>Hi</p>')
+        with SMTPServer() as server:
+            self.use_server(server)
+            result = self.runner.invoke(args=['mail-worker', '--once'])
+        self.assertIn('Sent 1, retry 0, failed 0. Queue: 0 pending, 0 failed.', result.output)
+        self.assertEqual(len(server.messages), 1)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import gzip
+import logging
+import os
+import queue
+import shutil
+import sys
+import tempfile
+
+from flask import current_app
+
+from bluelog.logs import DigestMailHandler, CompressedRotatingFileHandler, RequestQueueHandler, fingerprint
+from tests.base import BaseTestCase
+from tests.smtp import SMTPServer
+
+
+def make_record(message='Boom', exc_info=None):
+    return logging.LogRecord('bluelog', logging.ERROR, __file__, 10, message, None, exc_info)
+
+
+def raise_error(error):
+    try:
+        raise error
+    except Exception:
+        return sys.exc_info()
+
+
+class LoggingTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(LoggingTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(LoggingTestCase, self).tearDown()
+
+    def test_no_handlers_when_testing(self):
+        # 测试不向仓库的logs目录写日志
+        self.assertFalse([handler for handler in current_app.logger.handlers
+                          if isinstance(handler, RequestQueueHandler)])
+        self.assertNotIn('log_listener', current_app.extensions)
+
+    def test_fingerprint(self):
+        first, second = raise_error(ValueError('a')), raise_error(ValueError('b'))
+        self.assertEqual(fingerprint(make_record(exc_info=first)), fingerprint(make_record(exc_info=second)))
+        other = raise_error(KeyError('a'))
+        self.assertNotEqual(fingerprint(make_record(exc_info=first)), fingerprint(make_record(exc_info=other)))
+
+    def test_request_queue_handler(self):
+        log_queue = queue.Queue(1)
+        handler = RequestQueueHandler(log_queue)
+        handler.handle(make_record())
+        handler.handle(make_record())   # 队列已满，丢弃而不阻塞
+        record = log_queue.get_nowait()
+        self.assertEqual(record.url, 'http://localhost/')
+        self.assertEqual(record.fingerprint, fingerprint(record))
+        self.assertEqual(handler.dropped, 1)
+
+    def test_digest_mail_handler(self):
+        with SMTPServer() as server:
+            handler = DigestMailHandler('127.0.0.1', server.port, 'noreply@example.com', ['admin@example.com'],
+                                        'Bluelog Application Error', window=60)
+            for i in range(5):
+                handler.handle(make_record(exc_info=raise_error(ValueError(i))))
+            handler.handle(make_record(exc_info=raise_error(KeyError('other'))))
+            self.assertEqual(len(server.messages), 2)
+            handler.close()
+
+        self.assertEqual(len(server.messages), 3)
+        sender, recipients, data = server.messages[-1]
+        self.assertEqual(recipients, ['admin@example.com'])
+        self.assertIn('Subject: Bluelog Application Error (4 more)', data)
+        self.assertIn('ValueError: 4', data)
+
+    def test_compressed_rotation(self):
+        filename = os.path.join(self.tmpdir, 'bluelog.log')
+        handler = CompressedRotatingFileHandler(filename, maxBytes=100, backupCount=2)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        for i in range(3):
+            handler.handle(make_record('x' * 60 + str(i)))
+        handler.close()
+
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['bluelog.log', 'bluelog.log.1.gz', 'bluelog.log.2.gz'])
+        with gzip.open(filename + '.2.gz', 'rt') as f:
+            self.assertEqual(f.read(), 'x' * 60 + '0\n')
+        with gzip.open(filename + '.1.gz', 'rt') as f:
+            self.assertEqual(f.read(), 'x' * 60 + '1\n')
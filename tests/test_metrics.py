@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from flask import url_for, current_app
+
+from bluelog.extensions import db, metrics
+from bluelog.models import Post, Category
+from tests.base import BaseTestCase
+
+
+class MetricsTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        db.session.add(Post(title='Hello Post', body='Blah...', category=Category(name='Default')))
+        db.session.commit()
+        current_app.config['BLUELOG_METRICS_TOKEN'] = 'secret'
+
+    def scrape(self):
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True)
+
+    def test_metrics_protected(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 403)
+        self.login()
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_request_metrics(self):
+        self.client.get(url_for('blog.show_post', post_id=1))
+        self.client.get('/no-such-page')
+        data = self.scrape()
+        self.assertIn('bluelog_http_requests_total{endpoint="blog.show_post",method="GET",status="200"} 1', data)
+        self.assertIn('bluelog_http_requests_total{endpoint="none",method="GET",status="404"} 1', data)
+        self.assertIn('bluelog_http_request_duration_seconds_bucket{endpoint="blog.show_post",le="+Inf"} 1', data)
+        self.assertIn('bluelog_http_request_duration_seconds_count{endpoint="blog.show_post"} 1', data)
+        self.assertIn('bluelog_template_render_duration_seconds_count{endpoint="blog.show_post"} 1', data)
+        self.assertIn('# TYPE bluelog_http_request_duration_seconds histogram', data)
+        queries = [line for line in data.splitlines()
+                   if line.startswith('bluelog_db_queries_total{endpoint="blog.show_post"}')]
+        self.assertEqual(len(queries), 1)
+        self.assertGreater(int(queries[0].split()[-1]), 0)
+
+    def test_multiprocess_collect(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics.directory = directory
+        self.addCleanup(setattr, metrics, 'directory', None)
+        # 另一个(仍在运行的)worker进程写入的计数
+        self.write_worker_file(directory, 'metrics-%d-abc123.json' % os.getppid(), 2)
+
+        self.client.get(url_for('blog.index'))
+        data = self.scrape()
+        self.assertIn('bluelog_http_requests_total{endpoint="blog.index",method="GET",status="200"} 3', data)
+        self.assertTrue(os.path.exists(os.path.join(directory, 'metrics-%s.json' % metrics.worker_id)))
+        self.assertTrue(os.path.exists(os.path.join(directory, 'metrics-%d-abc123.json' % os.getppid())))
+
+    def write_worker_file(self, directory, filename, value):
+        with open(os.path.join(directory, filename), 'w') as f:
+            json.dump([['bluelog_http_requests_total',
+                        [['endpoint', 'blog.index'], ['method', 'GET'], ['status', '200']], value]], f)
+
+    def test_dead_workers_retired(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics.directory = directory
+        self.addCleanup(setattr, metrics, 'directory', None)
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        self.write_worker_file(directory, 'metrics-%d-abc123.json' % process.pid, 2)
+        self.write_worker_file(directory, 'metrics-%d-def456.json' % process.pid, 3)
+
+        data = self.scrape()
+        self.assertIn('bluelog_http_requests_total{endpoint="blog.index",method="GET",status="200"} 5', data)
+        # 已经退出的worker的文件合并到一个文件，计数不变
+        self.assertFalse(os.path.exists(os.path.join(directory, 'metrics-%d-abc123.json' % process.pid)))
+        self.assertTrue(os.path.exists(os.path.join(directory, 'metrics-retired.json')))
+        self.write_worker_file(directory, 'metrics-%d-0789ab.json' % process.pid, 1)
+        data = self.scrape()
+        self.assertIn('bluelog_http_requests_total{endpoint="blog.index",method="GET",status="200"} 6', data)
+
+    def test_reset_after_fork(self):
+        worker_id = metrics.worker_id
+        self.addCleanup(setattr, metrics, 'worker_id', worker_id)
+        self.client.get(url_for('blog.index'))
+        metrics._after_fork()
+        self.assertEqual(metrics.values, {})
+        self.assertNotEqual(metrics.worker_id, worker_id)
+        # 子进程的第一个请求也被计数
+        self.client.get(url_for('blog.index'))
+        self.assertIn('bluelog_http_requests_total{endpoint="blog.index",method="GET",status="200"} 1',
+                      metrics.render())
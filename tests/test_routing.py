@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from flask import url_for
+
+from bluelog import create_app
+from bluelog.extensions import db, page_cache, context_cache, sqlite_profile
+from bluelog.models import Admin, Category, Post
+from bluelog.routing import snapshot_replica
+from tests.base import BaseTestCase
+
+
+class RoutingTestCase(BaseTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = create_app('testing')
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(directory, 'primary.db'),
+            SQLALCHEMY_BINDS={'replica': 'sqlite:///' + os.path.join(directory, 'replica.db')},
+            BLUELOG_PAGE_CACHE=None,
+        )
+        sqlite_profile.init_app(app)
+        page_cache.init_app(app)
+        self.app = app
+        self.context = app.test_request_context()
+        self.context.push()
+        self.client = app.test_client()
+        self.runner = app.test_cli_runner()
+
+        db.create_all()
+        user = Admin(name='Grey Li', username='grey', about='I am test', blog_title='Testlog', blog_sub_title='a test')
+        user.set_password('123')
+        db.session.add(user)
+        db.session.add(Post(title='Replicated Post', body='Blah...', category=Category(name='Default')))
+        db.session.commit()
+        snapshot_replica(app)
+
+        db.session.add(Post(title='Fresh Post', body='Blah...', category_id=1))  # 只在主库中
+        db.session.commit()
+
+    def tearDown(self):
+        super(RoutingTestCase, self).tearDown()
+        for bind in (None, 'replica'):
+            db.get_engine(self.app, bind=bind).dispose()
+
+    def test_blog_reads_from_replica(self):
+        data = self.client.get(url_for('blog.index')).get_data(as_text=True)
+        self.assertIn('Replicated Post', data)
+        self.assertNotIn('Fresh Post', data)
+        self.assertEqual(self.client.get(url_for('blog.show_post', post_id=2)).status_code, 404)
+
+        self.login()
+        data = self.client.get(url_for('admin.manage_post')).get_data(as_text=True)
+        self.assertIn('Fresh Post', data)
+
+        data = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('bluelog_db_route_total{route="replica",reason="read"}', data)
+        self.assertIn('bluelog_db_route_total{route="primary",reason="blueprint"}', data)
+        self.assertIn('bluelog_db_route_total{route="primary",reason="write"} 1', data)
+
+    def test_read_your_writes(self):
+        self.login()
+        self.client.post(url_for('blog.show_post', post_id=1), data=dict(
+            author='Grey Li', email='grey@example.com', site='http://greyli.com', body='Sticky comment.'))
+        # 刚提交修改的用户从主库读取，其他访客仍然读取副本
+        self.assertIn('Sticky comment.', self.client.get(url_for('blog.show_post', post_id=1)).get_data(as_text=True))
+        guest = self.app.test_client()
+        self.assertNotIn('Sticky comment.', guest.get(url_for('blog.show_post', post_id=1)).get_data(as_text=True))
+        self.assertIn('bluelog_db_route_total{route="primary",reason="sticky"} 1',
+                      self.client.get('/metrics').get_data(as_text=True))
+
+    def test_replica_snapshot_command(self):
+        result = self.runner.invoke(args=['replica-snapshot'])
+        self.assertIn('replica.db', result.output)
+        self.assertIn('Fresh Post', self.client.get(url_for('blog.index')).get_data(as_text=True))
+
+    def test_stale_replica_reads_not_cached(self):
+        self.app.config['BLUELOG_PAGE_CACHE'] = 'memory'
+        page_cache.init_app(self.app)
+        guest = self.app.test_client()
+        url = url_for('blog.show_post', post_id=1)
+        guest.get(url)
+        self.assertEqual(guest.get(url).headers['X-Page-Cache'], 'HIT')
+
+        self.login()
+        self.client.post(url, data=dict(
+            author='Grey Li', email='grey@example.com', site='http://greyli.com', body='Fresh comment.'))
+        context_cache.clear()
+        # 副本还没有同步，读到的旧页面和模板上下文不写入缓存
+        for i in range(2):
+            response = guest.get(url)
+            self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+            self.assertNotIn('Fresh comment.', response.get_data(as_text=True))
+        self.assertEqual(context_cache.stats()['size'], 0)
+
+        snapshot_replica(self.app)
+        self.app.config['BLUELOG_REPLICA_STICKY_SECONDS'] = 0     # 副本已经同步
+        self.assertIn('Fresh comment.', guest.get(url).get_data(as_text=True))
+        self.assertEqual(guest.get(url).headers['X-Page-Cache'], 'HIT')
+        self.assertGreater(context_cache.stats()['size'], 0)